@@ -0,0 +1,112 @@
+import os, shutil, yaml
+import numpy as np
+import scipy.io
+
+
+class ChunkStore:
+    '''Append-only store for the data of a running sweep, as a directory of .npy chunks.
+    Each write saves only the slices along the sweep axis that were filled since the last write, so a backup costs
+    the size of the new rows instead of the whole data set. export_mat() assembles the .mat file.
+
+    Layout: index.yaml has the shape/dtype/axis/stop of every array, array data is in <key>/<start>_<stop>.npy and
+    arrays that are written whole (e.g. the sweep ranges) are in <key>.npy'''
+
+    def __init__(self, path, overwrite=True):
+        self.path = path
+        self.index = {}
+        self.static = {}  # last written copy of the arrays that are written whole
+
+        if overwrite and os.path.exists(path):
+            shutil.rmtree(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        elif os.path.exists(self.index_path()):
+            with open(self.index_path(), 'r') as infile:
+                self.index = yaml.safe_load(infile) or {}
+
+    def index_path(self):
+        return os.path.join(self.path, 'index.yaml')
+
+    def save_index(self):
+        # Write the index last and atomically so that it never lists a chunk that is not complete on disk
+        tmp = self.index_path() + '.tmp'
+        with open(tmp, 'w') as outfile:
+            outfile.write(yaml.safe_dump(self.index, default_flow_style=False))
+        os.replace(tmp, self.index_path())
+
+    def write(self, key, arr, stop=None, axis=0):
+        '''Save arr[..., start:stop, ...] along axis, where start is the stop of the previous write of key.
+        With stop=None the whole array is saved, but only if it changed since the last write.'''
+        arr = np.asarray(arr)
+        entry = {'shape': list(arr.shape), 'dtype': arr.dtype.str, 'axis': None if stop is None else axis, 'stop': 0}
+
+        old = self.index.get(key)
+        if old is None or any(old[k] != entry[k] for k in ['shape', 'dtype', 'axis']):
+            # New key or the array was reallocated (e.g. integrated): start over
+            self.remove_key(key)
+            old = entry
+        start = old['stop']
+
+        if stop is None:
+            if key in self.static and np.array_equal(self.static[key], arr, equal_nan=arr.dtype.kind in 'fc'):
+                return
+            np.save(os.path.join(self.path, '%s.npy' % key), arr)
+            self.static[key] = arr.copy()
+        else:
+            stop = min(stop, arr.shape[axis])
+            if stop <= start:
+                return
+            if not os.path.exists(os.path.join(self.path, key)):
+                os.makedirs(os.path.join(self.path, key))
+            sl = (slice(None),) * axis + (slice(start, stop),)
+            np.save(os.path.join(self.path, key, '%08d_%08d.npy' % (start, stop)), arr[sl])
+            entry['stop'] = stop
+
+        self.index[key] = entry
+        self.save_index()
+
+    def remove_key(self, key):
+        self.index.pop(key, None)
+        self.static.pop(key, None)
+        if os.path.exists(os.path.join(self.path, key)):
+            shutil.rmtree(os.path.join(self.path, key))
+        if os.path.exists(os.path.join(self.path, '%s.npy' % key)):
+            os.remove(os.path.join(self.path, '%s.npy' % key))
+
+    def load(self, key):
+        entry = self.index[key]
+        if entry['axis'] is None:
+            return np.load(os.path.join(self.path, '%s.npy' % key))
+
+        dtype = np.dtype(entry['dtype'])
+        arr = np.zeros(entry['shape'], dtype=dtype)
+        if dtype.kind in 'fc':
+            arr[:] = np.nan  # rows that were never written
+
+        axis = entry['axis']
+        for f in sorted(os.listdir(os.path.join(self.path, key))):
+            start, stop = [int(s) for s in f.split('.npy')[0].split('_')]
+            if stop <= entry['stop']:
+                arr[(slice(None),) * axis + (slice(start, stop),)] = np.load(os.path.join(self.path, key, f))
+        return arr
+
+    def load_all(self):
+        return dict((key, self.load(key)) for key in self.index)
+
+    def export_mat(self, matpath):
+        scipy.io.savemat(matpath, mdict=self.load_all())
+
+    def remove(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.index = {}
+        self.static = {}
+
+
+def recover_mat(path, matpath=None):
+    '''Export the .mat file of a sweep that did not finish, e.g. recover_mat('~/Documents/data_mat/ESR_123.chunks')'''
+    path = os.path.expanduser(path)
+    if matpath is None:
+        matpath = path.split('.chunks')[0] + '.mat'
+    ChunkStore(path, overwrite=False).export_mat(matpath)
+    return matpath
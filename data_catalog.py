@@ -0,0 +1,182 @@
+import os, time, sqlite3
+from contextlib import closing
+
+
+class DataCatalog:
+    '''SQLite catalog of the experiments saved in data_mat, so that the next wavenum and the browsers do not have to
+    list and parse the whole directory.
+    The catalog is updated by file_utils.save_data / the save queue for every save. If the directory was changed by
+    something else (its modification time differs from the one recorded after our last update), sync() adds the
+    missing files by parsing the directory listing once; otherwise nothing is listed. Our updates pass the
+    modification time from before they wrote (see file_utils.catalog_mtime) and only record the new one if nothing
+    else had changed the directory since the last record, so that a file written by something else is not hidden.
+    The database is kept next to data_mat, not in it, so that its journal files do not change the modification time
+    of data_mat.'''
+
+    columns = ['wavenum', 'filename', 'exptype', 'pulsename', 'sample', 'timestamp', 'nvnum', 'var1', 'var2']
+
+    def __init__(self, datadir=os.path.join('~', 'Documents', 'data_mat'), path=None):
+        self.datadir = os.path.expanduser(datadir)
+        if path is None:
+            path = os.path.join(os.path.dirname(self.datadir), 'data_mat_catalog.sqlite')
+        self.path = path
+
+        with closing(self.connect()) as con, con:
+            con.execute('CREATE TABLE IF NOT EXISTS experiments (wavenum INTEGER, filename TEXT PRIMARY KEY, '
+                        'exptype TEXT, pulsename TEXT, sample TEXT, timestamp REAL, nvnum INTEGER, var1 TEXT, '
+                        'var2 TEXT)')
+            con.execute('CREATE INDEX IF NOT EXISTS idx_wavenum ON experiments (wavenum)')
+            con.execute('CREATE INDEX IF NOT EXISTS idx_exptype ON experiments (exptype)')
+            con.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL)')
+
+    def connect(self):
+        # A new connection for every operation, so that the catalog can be used from any thread
+        return sqlite3.connect(self.path, timeout=10)
+
+    def add(self, filename, sweep_params=None, timestamp=None, mtime_before=None):
+        # mtime_before: dir_mtime() from before the files of filename were written, None if unknown
+        row = parse_filename(filename)
+        if row is None:
+            return
+        row['timestamp'] = time.time() if timestamp is None else timestamp
+        row.update(parse_sweep_params(sweep_params))
+
+        with closing(self.connect()) as con, con:
+            con.execute('INSERT OR REPLACE INTO experiments (%s) VALUES (%s)' %
+                        (', '.join(self.columns), ', '.join('?' * len(self.columns))),
+                        [row.get(c) for c in self.columns])
+            self.advance_mtime(con, mtime_before)
+
+    def next_wavenum(self):
+        return self.max_wavenum() + 1
+
+    def max_wavenum(self):
+        with closing(self.connect()) as con:
+            val = con.execute('SELECT MAX(wavenum) FROM experiments').fetchone()[0]
+        return 0 if val is None else val
+
+    def query(self, exptype=None, pulsename=None, sample=None, nvnum=None, var=None, since=None, until=None,
+              limit=None):
+        '''Rows (as dicts) of the experiments matching all of the given conditions, newest first.
+        exptype matches the beginning of the filename prefix (e.g. 'PLxpos' for confocal xy and xyz maps), var either
+        sweep variable, since/until the timestamp (time.time() seconds).'''
+        conds = []
+        args = []
+        if exptype is not None:
+            conds.append('exptype LIKE ?')
+            args.append(exptype + '%')
+        for col, val in [('pulsename', pulsename), ('sample', sample), ('nvnum', nvnum)]:
+            if val is not None:
+                conds.append('%s = ?' % col)
+                args.append(val)
+        if var is not None:
+            conds.append('(var1 = ? OR var2 = ?)')
+            args.extend([var, var])
+        if since is not None:
+            conds.append('timestamp >= ?')
+            args.append(since)
+        if until is not None:
+            conds.append('timestamp <= ?')
+            args.append(until)
+
+        sql = 'SELECT %s FROM experiments' % ', '.join(self.columns)
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        sql += ' ORDER BY wavenum DESC'
+        if limit is not None:
+            sql += ' LIMIT %d' % limit
+
+        with closing(self.connect()) as con:
+            return [dict(zip(self.columns, r)) for r in con.execute(sql, args)]
+
+    def latest(self, exptype=None):
+        # Full path of the newest .mat file of exptype, None if there is none
+        rows = self.query(exptype=exptype, limit=1)
+        if not rows:
+            return None
+        return os.path.join(self.datadir, rows[0]['filename'] + '.mat')
+
+    def sync(self, force=False):
+        # Add the files that were saved without updating the catalog. Returns the number of files added.
+        mtime = self.dir_mtime()  # before listing, so that a file written during the scan is found next time
+        with closing(self.connect()) as con:
+            if not force and self.get_meta(con, 'dir_mtime') == mtime:
+                return 0
+            known = set(r[0] for r in con.execute('SELECT filename FROM experiments'))
+
+        names = os.listdir(self.datadir)
+
+        rows = []
+        for f in names:
+            # .chunks are the backups of sweeps that have not been exported to .mat yet
+            for ext in ['.mat', '.chunks']:
+                if f.endswith(ext) and f[:-len(ext)] not in known:
+                    row = parse_filename(f[:-len(ext)])
+                    if row is not None:
+                        row['timestamp'] = os.path.getmtime(os.path.join(self.datadir, f))
+                        rows.append(row)
+                        known.add(row['filename'])
+
+        with closing(self.connect()) as con, con:
+            con.executemany('INSERT OR IGNORE INTO experiments (%s) VALUES (%s)' %
+                            (', '.join(self.columns), ', '.join('?' * len(self.columns))),
+                            [[row.get(c) for c in self.columns] for row in rows])
+            self.set_meta(con, 'dir_mtime', mtime)
+        return len(rows)
+
+    def mark_synced(self, mtime_before):
+        # Call after changing data_mat without adding an experiment (e.g. removing a backup), to avoid a rescan.
+        # mtime_before: dir_mtime() from before the change
+        with closing(self.connect()) as con, con:
+            self.advance_mtime(con, mtime_before)
+
+    def advance_mtime(self, con, mtime_before):
+        # record the modification time after our change, if the directory was in sync before it
+        if mtime_before is not None and self.get_meta(con, 'dir_mtime') == mtime_before:
+            self.set_meta(con, 'dir_mtime', self.dir_mtime())
+
+    def is_taken(self, wavenum):
+        # True if data_mat has a .mat or .chunks of wavenum under one of the experiment types seen so far, catalogued
+        # or not
+        with closing(self.connect()) as con:
+            exptypes = [r[0] for r in con.execute('SELECT DISTINCT exptype FROM experiments')]
+        for exptype in exptypes:
+            for ext in ['.mat', '.chunks']:
+                if os.path.exists(os.path.join(self.datadir, '%s_%d%s' % (exptype, wavenum, ext))):
+                    return True
+        return False
+
+    def dir_mtime(self):
+        return os.stat(self.datadir).st_mtime
+
+    def get_meta(self, con, key):
+        row = con.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, con, key, value):
+        con.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+
+def parse_filename(filename):
+    # dataname_# => wavenum and exptype (dataname), None if the name does not follow the format
+    parts = filename.split('_')
+    if len(parts) < 2 or not parts[-1].isdigit():
+        return None
+    return {'filename': filename, 'wavenum': int(parts[-1]), 'exptype': '_'.join(parts[:-1])}
+
+
+def parse_sweep_params(sweep_params):
+    row = {}
+    if not sweep_params:
+        return row
+
+    row['sample'] = sweep_params.get('sample')
+    if 'Confocal' in sweep_params and 'nvnum' in sweep_params['Confocal']:
+        row['nvnum'] = int(sweep_params['Confocal']['nvnum'])
+    if 'Sweep' in sweep_params:
+        sweep = sweep_params['Sweep']
+        row['pulsename'] = sweep.get('pulsename') or None  # the selected pulse sequence, '' for none
+        row['var1'] = sweep.get('var1_name')
+        if sweep.get('chxbx_2desr'):
+            row['var2'] = sweep.get('var2_name')
+    return row
@@ -0,0 +1,163 @@
+import os
+import struct
+import numpy as np
+
+
+class DriftModel:
+    '''Kalman filter of the xyz drift velocity of the sample, learned from the tracker results.
+
+    Consecutive tracks of the same NV measure the drift velocity (pos - last pos) / dt, so that the positions of
+    different NVs in batch runs do not have to be known. Each axis is a velocity random walk of spectral density q
+    (um^2/s^3), and the tracked positions have a noise of r (um^2).
+    The PL of each NV after its tracks (at the optimum) is modelled as an exponential decay (e.g. bleaching, or focus
+    and laser drifts that the xyz tracking does not see), whose rate per NV is a random walk of spectral density q_pl
+    (1/s^3), measured with a noise of r_pl on log(PL).
+    The predicted PL loss of an NV since its last track is that of a Gaussian spot of the tracker widths (um, updated
+    from the tracker fits) displaced by the predicted drift, including its uncertainty, and of the PL decay.
+    Velocities more than gate standard deviations away from the estimate are rejected (e.g. a different spot under the
+    same nvnum), unless max_rejects of them follow each other, which restarts the estimate. nvnum 0 is the manual
+    spot, which changes whenever it is moved, so it is never used to learn the velocity.'''
+
+    def __init__(self, q=1e-13, r=1e-4, width=(0.15, 0.15, 0.5), gate=4.0, max_rejects=3, q_pl=3e-14, r_pl=2.5e-3):
+        self.q = q
+        self.r = r
+        self.q_pl = q_pl
+        self.r_pl = r_pl
+        self.width = np.array(width, dtype=float)
+        self.gate = gate
+        self.max_rejects = max_rejects
+        self.reset()
+
+    def reset(self):
+        self.t = None  # time of the velocity estimate
+        self.v = np.zeros(3)  # um/s
+        self.Pv = np.full(3, 1e-6)  # variance of v
+        self.pos = {}  # nvnum -> position found by the last track
+        self.last = {}  # nvnum -> time of the last track
+        self.pl = {}  # nvnum -> PL after the last track
+        self.decay = {}  # nvnum -> (PL decay rate (1/s), its variance)
+        self.updates = 0
+        self.rejects = 0  # consecutive rejected velocities
+
+    def ready(self):
+        # enough repeated tracks to know the velocity
+        return self.updates >= 3
+
+    def update(self, t, nvnum, pos, width=None, pl=None):
+        # add the position (x, y, z) found by a track of NV nvnum at time t (s). Returns False if it was rejected.
+        pos = np.asarray(pos, dtype=float)
+        if not np.all(np.isfinite(pos)):
+            return False
+        if self.t is not None:
+            self.Pv += self.q * max(t - self.t, 0.0)
+        self.t = t
+
+        accepted = True
+        dt = t - self.last.get(nvnum, t)
+        if dt > 0 and nvnum > 0:
+            z = (pos - self.pos[nvnum]) / dt
+            S = self.Pv + 2 * self.r / dt**2
+            if np.any(np.abs(z - self.v) > self.gate * np.sqrt(S)):
+                self.rejects += 1
+                accepted = False
+                if self.rejects >= self.max_rejects:
+                    # the drift has changed: start over from the current velocity
+                    self.v = z
+                    self.Pv = np.full(3, 1e-6)
+                    self.rejects = 0
+            else:
+                K = self.Pv / S
+                self.v += K * (z - self.v)
+                self.Pv *= 1 - K
+                self.updates += 1
+                self.rejects = 0
+
+        if width is not None:
+            width = np.asarray(width, dtype=float)
+            ok = np.isfinite(width) & (width > 0)
+            self.width[ok] = 0.8 * self.width[ok] + 0.2 * width[ok]
+        self.pos[nvnum] = pos
+        self.last[nvnum] = t
+        if pl is not None and np.isfinite(pl) and pl > 0:
+            if dt > 0 and nvnum > 0 and accepted and nvnum in self.pl:
+                self.update_decay(nvnum, dt, np.log(self.pl[nvnum] / pl) / dt)
+            self.pl[nvnum] = pl
+        return accepted
+
+    def update_decay(self, nvnum, dt, z):
+        # z: PL decay rate (1/s) measured by two tracks of NV nvnum dt apart
+        k, P = self.decay.get(nvnum, (0.0, 1e-8))
+        P += self.q_pl * dt
+        S = P + 2 * self.r_pl / dt**2
+        if abs(z - k) > self.gate * np.sqrt(S):
+            return  # e.g. blinking, or a change of the laser power
+        K = P / S
+        self.decay[nvnum] = (k + K * (z - k), P * (1 - K))
+
+    def decay_rate(self, nvnum):
+        # PL decay rate (1/s) of NV nvnum, 0 if it is not known
+        return self.decay.get(nvnum, (0.0, 0.0))[0]
+
+    def velocity(self):
+        # um/s per axis
+        return self.v.copy()
+
+    def predict(self, t, nvnum):
+        # position of NV nvnum at time t, None if it was never tracked
+        if nvnum not in self.pos:
+            return None
+        return self.pos[nvnum] + self.v * (t - self.last[nvnum])
+
+    def pl_loss(self, t, nvnum):
+        # expected fraction of the PL lost to drift and PL decay since the last track of NV nvnum
+        if nvnum not in self.last:
+            return 1.0
+        dt = max(t - self.last[nvnum], 0.0)
+        mean = self.v * dt
+        var = self.Pv * dt**2 + self.q * dt**3 / 3 + self.r
+        drift = np.sum((mean**2 + var) / (2 * self.width**2))
+        return 1 - np.exp(-drift - max(self.decay_rate(nvnum), 0.0) * dt)
+
+    def time_to_loss(self, loss, nvnum, tmax=24 * 3600):
+        # time (s) after the last track at which the predicted PL loss reaches loss
+        t0 = self.last.get(nvnum)
+        if t0 is None:
+            return 0.0
+        lo, hi = 0.0, float(tmax)
+        if self.pl_loss(t0 + hi, nvnum) < loss:
+            return hi
+        for _ in range(40):
+            mid = (lo + hi) / 2
+            if self.pl_loss(t0 + mid, nvnum) < loss:
+                lo = mid
+            else:
+                hi = mid
+        return hi
+
+    def load_log(self, filename):
+        '''Replay a binary tracker log (written by mainexp.tracker_updatelog): records of int length, then
+        the time stamp (native unsigned long), nvnum, x, y, z, p532, pl and the laser piezo values.'''
+        if not os.path.exists(filename):
+            return 0
+        n = 0
+        with open(filename, 'rb') as f:
+            data = f.read()
+        head = struct.calcsize('i')
+        fields = [('L', struct.calcsize('L')), ('i', struct.calcsize('i'))] + [('f', struct.calcsize('f'))] * 5
+        offset = 0
+        while offset + head <= len(data):
+            length = struct.unpack_from('i', data, offset)[0]
+            offset += head
+            record = data[offset:offset + length]
+            offset += length
+            if len(record) < sum(size for _, size in fields):
+                break
+            vals = []
+            pos = 0
+            for fmt, size in fields:
+                vals.append(struct.unpack_from(fmt, record, pos)[0])
+                pos += size
+            stamp, nvnum, x, y, z, p532, pl = vals
+            self.update(float(stamp), nvnum, [x, y, z], pl=pl / 1e3)
+            n += 1
+        return n
@@ -122,27 +122,29 @@ class SeqAPD(ExpThread.ExpThread):
         self.mainexp.ctrtrig.wait_until_done()
         self.mainexp.ctrtrig.stop()
 
-        n_read = 0
         t_update = 0.1
 
-        self.mainexp.seqapd_pl = np.array([])
+        # The trace is filled into preallocated arrays and seqapd_pl/seqapd_t are views of the part read so far
+        pl = np.zeros(numpnts)
+        t = np.arange(numpnts) * seqapd_acqtime
+        n_pl = 0
+        self.mainexp.seqapd_pl = pl[:0]
+        self.mainexp.seqapd_t = t[:0]
 
-        last_counter = 0  # Actual counter value, which monotonically counts up and need to be diff to get count rate
+        # The counter monotonically counts up, read_diff takes care of differencing it between reads
+        self.mainexp.ctrapd.reset_diff()
 
-        while not self.cancel and n_read < numpnts+1:
+        while not self.cancel and self.mainexp.ctrapd.samples_read < numpnts+1:
             time.sleep(t_update)
             # try to read twice as many samples as python time will always be slower
             # (assume it doesn't take more than 2*t_update)
-            ctr_raw = self.mainexp.ctrapd.get_counts(int(t_update / seqapd_acqtime * 2))
-            if n_read != 0:
-                ctr_diff = np.diff(np.append([last_counter], ctr_raw))
-            else:
-                ctr_diff = np.diff(ctr_raw)
-            if len(ctr_raw):
-                n_read += len(ctr_raw)
-                last_counter = ctr_raw[-1]
-                self.mainexp.seqapd_pl = np.append(self.mainexp.seqapd_pl, ctr_diff)
-                self.mainexp.seqapd_t = np.arange(len(self.mainexp.seqapd_pl)) * seqapd_acqtime
+            ctr_diff = self.mainexp.ctrapd.read_diff(int(t_update / seqapd_acqtime * 2))
+            if len(ctr_diff):
+                n = min(len(ctr_diff), numpnts - n_pl)
+                pl[n_pl:n_pl + n] = ctr_diff[:n]
+                n_pl += n
+                self.mainexp.seqapd_pl = pl[:n_pl]
+                self.mainexp.seqapd_t = t[:n_pl]
                 self.signal_seqapd_updateplots.emit()
 
         if hasattr(PyDAQmx.DAQmxFunctions, 'DAQWarning'):
@@ -4,6 +4,80 @@ import numpy as np
 import warnings
 
 from . import ExpThread
+import scan_patterns
+import focus_surface
+
+PLOT_UPDATE_LIVE = 33  # redraw interval of live scans (ms), about the display refresh rate
+
+
+class FrameAverager:
+    '''Average of the last depth frames of a live scan, written row by row into out (e.g. a view of confocal_pl).
+    The frames are kept in a circular buffer with a running sum and count of the finite values, so a new row costs
+    O(row) and nothing is reallocated between frames. With ema > 0 the average is an exponential moving average
+    instead (weight ema for the new frame), which needs no buffer and suits an endless live view.'''
+
+    def __init__(self, out, depth=1, ema=0.0):
+        self.out = out
+        self.ema = ema
+        self.depth = 0
+        self.frames = 0  # frames started so far
+        self.set_depth(depth)
+
+    def set_depth(self, depth):
+        # keeps the most recent frames that still fit
+        depth = max(int(depth), 1)
+        if depth == self.depth:
+            return
+        nx, ny = self.out.shape
+        buf = np.full((depth, nx, ny), np.nan)
+        if self.depth:
+            keep = min(depth, self.depth, self.frames)
+            for i in range(keep):
+                buf[keep - 1 - i] = self.buf[(self.slot - i) % self.depth]
+            self.frames = keep
+        self.buf = buf
+        self.depth = depth
+        self.slot = (self.frames - 1) % depth
+        self.sum = np.nansum(buf, axis=0)
+        self.count = np.sum(np.isfinite(buf), axis=0)
+
+    def new_frame(self):
+        # the oldest frame makes room for the next one
+        self.frames += 1
+        if self.ema > 0:
+            return
+        self.slot = (self.slot + 1) % self.depth
+        old = self.buf[self.slot]
+        finite = np.isfinite(old)
+        self.sum[finite] -= old[finite]
+        self.count -= finite
+        old[:] = np.nan
+
+    def set_row(self, index, vals):
+        if self.ema > 0:
+            row = self.out[:, index]
+            if self.frames <= 1:
+                self.out[:, index] = vals
+            else:
+                self.out[:, index] = np.where(np.isfinite(row), (1 - self.ema) * row + self.ema * vals, vals)
+            return
+
+        old = self.buf[self.slot, :, index]
+        finite = np.isfinite(old)
+        self.sum[finite, index] -= old[finite]
+        self.count[finite, index] -= 1
+
+        self.buf[self.slot, :, index] = vals
+        finite = np.isfinite(vals)
+        self.sum[finite, index] += vals[finite]
+        self.count[finite, index] += 1
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.out[:, index] = np.where(self.count[:, index] > 0, self.sum[:, index] / self.count[:, index], np.nan)
+
+    def full(self):
+        # True once depth frames were started (always for ema)
+        return self.ema > 0 or self.frames >= self.depth
 
 
 class Confocal(ExpThread.ExpThread):
@@ -13,6 +87,9 @@ class Confocal(ExpThread.ExpThread):
 
     signal_confocal_initplot = pyqtSignal()
     signal_confocal_updateplot = pyqtSignal(int)
+    signal_confocal_liveplot_start = pyqtSignal(int)
+    signal_confocal_liveplot_stop = pyqtSignal()
+    signal_confocal_get_nvlist = pyqtSignal()
 
     def __init__(self, mainexp, wait_condition):
         super().__init__(mainexp, wait_condition)
@@ -22,6 +99,7 @@ class Confocal(ExpThread.ExpThread):
         self.ctrapd = mainexp.ctrapd
         self.ctrclk = mainexp.ctrclk
         self.ctrtrig = mainexp.ctrtrig
+        self.ctrapd2 = getattr(mainexp, 'ctrapd2', None)  # second counter for the MW-on counts of ESR contrast scans
 
         self.acqtime = 0.001
 
@@ -38,15 +116,41 @@ class Confocal(ExpThread.ExpThread):
         self.autoZ = False
         self.isESR = False  # Use for alternating ESR on-off. There should be a better place to put this though.
         self.isLive = False
-        self.confocal_live_stacks = []
+        self.confocal_live_stacks = None  # FrameAverager of live scans
         self.confocal_live_avg = 1
+        self.confocal_live_ema = 0.0  # > 0: exponential moving average with this weight instead of confocal_live_avg
+
+        # Trajectory of fast scans, see scan_patterns: 'meander', 'raster', 'spiral', 'lissajous' or 'nvlist' (XY only:
+        # regions of scan_roi_size um around the NVs in the nvlist)
+        self.scan_pattern = 'meander'
+        self.scan_settle = 0  # samples at the start of every line for the galvos to settle
+        self.scan_flyback = 0  # samples between raster lines
+        self.scan_roi_size = 2.0
+        self.scan_transit = 0.1  # s, to move the scanners to the start of the next z slice as part of the trajectory
+        self.pattern = None
+        self.nvlist = []  # x, y of the NVs for the 'nvlist' pattern, copied from table_nvlist by the GUI thread
+
+        # Hardware-timed scans for all modes, z-stacks and ESR contrast. False: line by line with sweep1d
+        self.fast_scan = True
+        # ESR contrast of fast scans: the PulseBlaster alternates MW off (gating ctrapd) and MW on (gating ctrapd2)
+        # every esr_period, so that every pixel measures both instead of scanning every line twice
+        self.esr_period = 20e-6
+        self.esr_deadtime = 1e-6  # s at the start of each half that is not counted, while the MW switches
         # Connect signals
         self.signal_confocal_grab_screenshots.connect(self.mainexp.confocal_grab_screenshots)
 
         self.signal_confocal_initplot.connect(mainexp.confocal_initplot)
         self.signal_confocal_updateplot.connect(mainexp.confocal_updateplot)
+        self.signal_confocal_liveplot_start.connect(mainexp.plt_confocal_scheduler.start)
+        self.signal_confocal_liveplot_stop.connect(mainexp.plt_confocal_scheduler.stop)
+        self.signal_confocal_get_nvlist.connect(mainexp.confocal_get_nvlist)
 
-        self.plane_coef = [0, 0, 1, 5]  # coefficients for Ax + By + Cz = D for autoZ
+        # autoZ focal surface, fit to the points of table_confocalZ and the recent z tracking results (see
+        # Tracker.focus_points): 'plane', 'quadratic' or 'tps' (thin-plate spline, see focus_surface)
+        self.focus_model = 'plane'
+        self.focus_smoothing = 0.0
+        self.focus_max_age = 3600  # s, older tracker points are not used
+        self.focus = focus_surface.FocusSurface(self.focus_model)
 
     def setup_ctr(self):
         self.ctrapd.reset()
@@ -73,7 +177,10 @@ class Confocal(ExpThread.ExpThread):
         self.ctrclk.set_freq(1/self.acqtime)
         self.ctrclk.start()
 
-    def setup_ctr_2d(self):
+    def setup_ctr_2d(self, numsamples=None):
+        if numsamples is None:
+            numsamples = len(self.var1)*len(self.var2) + 1
+
         self.ctrapd.reset()
         self.ctrclk.reset()
         self.ctrtrig.set_time(0.001)
@@ -82,7 +189,7 @@ class Confocal(ExpThread.ExpThread):
 
         self.galpie.set_sample_clock(self.mainexp.inst_params['instruments']['ctrclk']['addr_out'],
                                      PyDAQmx.DAQmx_Val_Rising,
-                                     len(self.var1)*len(self.var2) + 1)
+                                     numsamples)
         self.galpie.set_start_trigger(self.mainexp.inst_params['instruments']['ctrtrig']['addr_out'],
                                       PyDAQmx.DAQmx_Val_Rising)
 
@@ -90,14 +197,30 @@ class Confocal(ExpThread.ExpThread):
         self.ctrapd.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
         self.ctrapd.set_sample_clock(self.mainexp.inst_params['instruments']['ctrclk']['addr_out'],
                                      PyDAQmx.DAQmx_Val_Rising,
-                                     len(self.var1)*len(self.var2) + 1)
+                                     numsamples)
         self.ctrapd.set_arm_start_trigger(self.mainexp.inst_params['instruments']['ctrtrig']['addr_out'],
                                           PyDAQmx.DAQmx_Val_Rising)
 
+        if self.isESR:
+            # ctrapd only counts while the PulseBlaster gates it (MW off), ctrapd2 counts the same photons with MW on
+            addrs = self.mainexp.inst_params['instruments']
+            self.ctrapd.set_pause_trigger(addrs['ctrapd']['addr_gate'])
+
+            self.ctrapd2.reset()
+            self.ctrapd2.set_source(addrs['ctrapd']['addr_src'])
+            self.ctrapd2.set_sample_clock(addrs['ctrclk']['addr_out'], PyDAQmx.DAQmx_Val_Rising, numsamples)
+            self.ctrapd2.set_arm_start_trigger(addrs['ctrtrig']['addr_out'], PyDAQmx.DAQmx_Val_Rising)
+            self.ctrapd2.set_pause_trigger(addrs['ctrapd2']['addr_gate'])
+
         # creates a clock using pulses on self.ctrclk (output to PFI7)
         self.ctrclk.set_freq(1/self.acqtime)
         self.ctrclk.start()
 
+    def use_fast_scan(self):
+        # ESR contrast needs the second counter
+        return self.fast_scan and (not self.isESR or
+                                   (self.ctrapd2 is not None and 'ctrapd2' in self.mainexp.inst_params['instruments']))
+
     def prep_mainexp(self):
         self.mainexp.datasaved = False
 
@@ -131,8 +254,6 @@ class Confocal(ExpThread.ExpThread):
             self.var2 = np.linspace(mainexp.dbl_confocal_y_start.value(), mainexp.dbl_confocal_y_stop.value(),
                                     mainexp.int_confocal_y_numdivs.value() + 1)
 
-            self.plane_coef = [0, 0, 1, 5]  # default to 0*x + 0*y + 1*z = 5
-
             if not self.autoZ and mainexp.int_confocal_z_numdivs.value():
                 self.var3 = np.linspace(mainexp.dbl_confocal_z_start.value(), mainexp.dbl_confocal_z_stop.value(),
                                         mainexp.int_confocal_z_numdivs.value() + 1)
@@ -176,7 +297,7 @@ class Confocal(ExpThread.ExpThread):
         # self.mainexp.confocal_pl[:][:][:] = np.NaN
         self.mainexp.confocal_pl[:][:][:] = 1000.0
         # self.mainexp.confocal_pl[0][0][0] = 1.0
-        self.confocal_live_stacks = np.array([])
+        self.confocal_live_stacks = None
 
         self.signal_confocal_initplot.emit()
         self.signal_confocal_updateplot.emit(0)
@@ -200,8 +321,7 @@ class Confocal(ExpThread.ExpThread):
         ylist = np.linspace(y_i, y_f, len(xlist))
         zlist = np.linspace(z_i, z_f, len(xlist))
 
-        self.galpie.set_positions([self.var1_id, self.var2_id, self.var3_id],
-                                  [xlist.tolist(), ylist.tolist(), zlist.tolist()])
+        self.galpie.set_positions([self.var1_id, self.var2_id, self.var3_id], [xlist, ylist, zlist])
         # set arm start on the tasks that are hardware-timed so they are ready to be triggered
         self.galpie.start()
         self.ctrapd.start()
@@ -221,11 +341,23 @@ class Confocal(ExpThread.ExpThread):
         return list(ctr_read)
 
     def sweep2d(self):
-        # Not doing stacks, not using any Z piezo. Not running MW. For now....
-        if len(self.var3) == 1 and not self.autoZ and self.mode == 0 and not self.isESR:
+        if self.use_fast_scan():
             self.galpie.reset()
-            self.galpie.set_position(self.var3_id, self.var3[0])
+            if not self.autoZ:
+                self.galpie.set_position(self.var3_id, self.var3[0])
+            else:
+                # the trajectory follows the focal surface, start from its first point
+                self.galpie.set_position(self.var3_id, self.calcZ(self.var1[0], self.var2[0]))
+                time.sleep(0.5)
+
+            if self.isESR:
+                self.mainexp.mw1.set_output(1)
+                self.mainexp.pb.set_cw_alternate(['green', 'ctr0'], ['green', 'mw1', 'ctr1'],
+                                                 self.esr_period, self.esr_deadtime)
             self.sweep2d_fast()
+            if self.isESR:
+                self.mainexp.mw1.set_output(0)
+                self.mainexp.pb.set_cw()
         else:
             # Define the indices separately, otherwise they will cause problems when passed into the signal
             index_z = 0
@@ -294,100 +426,130 @@ class Confocal(ExpThread.ExpThread):
                 self.mainexp.mw1.set_output(0)
                 self.mainexp.pb.set_cw()
 
+    def make_scan_pattern(self, z=None):
+        # z: position of the slice (var3). With autoZ, z is evaluated on the focal surface for every sample
+        if self.autoZ:
+            z = self.calcZ
+        elif z is None:
+            z = self.var3[0]
+        if self.scan_pattern == 'raster':
+            return scan_patterns.raster(self.var1, self.var2, z, flyback=self.scan_flyback, settle=self.scan_settle)
+        elif self.scan_pattern == 'spiral':
+            return scan_patterns.spiral(self.var1, self.var2, z, settle=self.scan_settle)
+        elif self.scan_pattern == 'lissajous':
+            return scan_patterns.lissajous(self.var1, self.var2, z, settle=self.scan_settle)
+        elif self.scan_pattern == 'nvlist' and self.mode == 0:
+            try:
+                return scan_patterns.roi(self.var1, self.var2, z, self.nvlist, self.scan_roi_size,
+                                         settle=self.scan_settle, transit=max(self.scan_flyback, 1))
+            except ValueError as e:
+                self.log('nvlist scan: %s. Scanning the whole range instead.' % e)
+        return scan_patterns.meander(self.var1, self.var2, z, settle=self.scan_settle)
+
     def sweep2d_fast(self):
-        rev = False
+        # the rows only mark themselves, the GUI timer draws them
+        self.signal_confocal_liveplot_start.emit(PLOT_UPDATE_LIVE)
 
-        exit_loop = False
-        while not exit_loop:
-            if len(self.confocal_live_stacks):
-                self.confocal_live_stacks = np.append(self.confocal_live_stacks,
-                                                      np.empty((self.var1.size, self.var2.size, 1)), axis=2)
-            else:
-                self.confocal_live_stacks = np.empty((self.var1.size, self.var2.size, 1))
-            self.confocal_live_stacks[:][:][-1] = np.NaN
-            if self.confocal_live_stacks.shape[2] > self.confocal_live_avg:
-                self.confocal_live_stacks = self.confocal_live_stacks[:, :, -self.confocal_live_avg:]
+        shown = 0  # slice shown in the plot
+        last_pos = None  # where the previous frame ended, in the coordinates of the pattern (var1, var2, var3)
+        transit = max(int(round(self.scan_transit / self.acqtime)), 1)
 
-            self.sweep2d_fast_single_frame(rev=rev)
-            rev = ~rev
+        if self.scan_pattern == 'nvlist':
+            self.signal_confocal_get_nvlist.emit()
+            self.wait_for_mainexp()
 
+        for index_z, z in enumerate(self.var3):
             if self.cancel:
-                exit_loop = True
-            else:
-                if not self.isLive:
-                    exit_loop = np.atleast_3d(self.confocal_live_stacks).shape[2] == self.confocal_live_avg
+                break
+            if index_z != shown:
+                shown = index_z
+                self.signal_confocal_updateplot.emit(shown)  # show the new slice while it is filled
+
+            # the trajectories of both directions are computed once for all frames of the slice
+            self.pattern = self.make_scan_pattern(z)
+            patterns = [self.pattern, self.pattern.reversed()]
+            rev = False
+
+            # averages the frames straight into the plotted array
+            self.confocal_live_stacks = FrameAverager(self.mainexp.confocal_pl[:, :, index_z], self.confocal_live_avg,
+                                                      ema=self.confocal_live_ema if self.isLive else 0.0)
+
+            exit_loop = False
+            while not exit_loop:
+                self.confocal_live_stacks.set_depth(self.confocal_live_avg)  # can be changed during live scans
+                self.confocal_live_stacks.new_frame()
+
+                pattern = patterns[1] if rev else patterns[0]
+                if last_pos is not None and not np.allclose(last_pos, pattern.pos[:, 0]):
+                    # move to the next slice within the trajectory instead of a step of the piezo
+                    pattern = pattern.approach(last_pos, transit)
+                self.sweep2d_fast_single_frame(pattern)
+                last_pos = pattern.pos[:, -1]
+                rev = not rev
+
+                if self.cancel:
+                    exit_loop = True
                 else:
-                    exit_loop = not self.mainexp.btn_confocal_live.isChecked() and \
-                                np.atleast_3d(self.confocal_live_stacks).shape[2] == self.confocal_live_avg
-
-    def sweep2d_fast_single_frame(self, rev=False):
-        if not self.cancel:
-            self.setup_ctr_2d()
-
-            # Build a sweep list
-            xlist = np.array([])
-            ylist = np.array([])
-            zlist = np.array([])
-
-            for i, y in enumerate(self.var2):
-                if not i % 2:
-                    xlist = np.append(xlist, self.var1)
-                else:
-                    xlist = np.append(xlist, np.flip(self.var1, axis=0))
-
-                ylist = np.append(ylist, np.ones(len(self.var1)) * y)
-                zlist = np.append(zlist, np.ones(len(self.var1)) * self.var3[0])
+                    if not self.isLive:
+                        exit_loop = self.confocal_live_stacks.full()
+                    else:
+                        exit_loop = not self.mainexp.btn_confocal_live.isChecked() and self.confocal_live_stacks.full()
 
-            if rev:
-                xlist = np.flip(xlist, axis=0)
-                ylist = np.flip(ylist, axis=0)
-                zlist = np.flip(zlist, axis=0)
+        self.signal_confocal_liveplot_stop.emit()
+        self.signal_confocal_updateplot.emit(shown)
 
-            xlist = np.append(xlist, xlist[-1])
-            ylist = np.append(ylist, ylist[-1])
-            zlist = np.append(zlist, zlist[-1])
+    def sweep2d_fast_single_frame(self, pattern):
+        if not self.cancel:
+            self.setup_ctr_2d(pattern.numsamples())
 
-            self.galpie.set_positions([self.var1_id, self.var2_id, self.var3_id],
-                                      [xlist.tolist(), ylist.tolist(), zlist.tolist()])
+            traj = np.empty((3, pattern.numsamples()))
+            traj[[self.var1_id, self.var2_id, self.var3_id]] = pattern.trajectory()
+            self.galpie.set_trajectory(traj)
 
             # set arm start on the tasks that are hardware-timed so they are ready to be triggered
             self.galpie.start()
             self.ctrapd.start()
+            if self.isESR:
+                self.ctrapd2.start()
             self.ctrtrig.start()
             self.ctrtrig.wait_until_done()
             self.ctrtrig.stop()
 
             self.mainexp.seqapd_pl = np.array([])
 
-            numpnts1 = len(self.var1)
-            numpnts2 = len(self.var2)
+            # counts and visits of every pixel in this frame (pixels can be visited several times, or not at all)
+            frame_sum = np.zeros(pattern.shape)
+            frame_hits = np.zeros(pattern.shape, dtype=np.int64)
 
-            last_counter = self.mainexp.ctrapd.get_counts(1)[0]
+            # The first sample is the starting count. read_diff carries the last count over to the next segment.
+            self.mainexp.ctrapd.reset_diff()
+            self.mainexp.ctrapd.read_diff(1)
+            if self.isESR:
+                self.ctrapd2.reset_diff()
+                self.ctrapd2.read_diff(1)
+                # each counter is gated for this fraction of every sample
+                duty = (self.esr_period / 2 - self.esr_deadtime) / self.esr_period
 
-            for index_y in range(numpnts2):
+            start = 0
+            for stop in pattern.segments:
                 if not self.cancel:
-                    # This will wait until the entire row is read
-                    ctr_raw = self.mainexp.ctrapd.get_counts(numpnts1)
-                    ctr_diff = np.diff(np.append([last_counter], ctr_raw)) / self.acqtime
-
-                    last_counter = ctr_raw[-1]
-
-                    # Forward meander scan (increasing yvals)
-                    if not rev:
-                        if not index_y % 2:
-                            self.confocal_live_stacks[:, index_y, -1] = ctr_diff
-                        else:
-                            self.confocal_live_stacks[:, index_y, -1] = np.flipud(ctr_diff)
-                        self.mainexp.confocal_pl[:, index_y, 0] = np.nanmean(self.confocal_live_stacks[:, index_y, :], axis=1)
-                    # Reverse meander scan (decreasing yvals)
-                    else:
-                        if not index_y % 2:
-                            self.confocal_live_stacks[:, -(index_y+1), -1] = np.flipud(ctr_diff)
-                        else:
-                            self.confocal_live_stacks[:, -(index_y+1), -1] = ctr_diff
-                        self.mainexp.confocal_pl[:, -(index_y+1), 0] = np.nanmean(self.confocal_live_stacks[:, -(index_y+1), :], axis=1)
-
-                    self.signal_confocal_updateplot.emit(0)
+                    # This will wait until the entire segment (e.g. a line) is read
+                    ctr_diff = self.mainexp.ctrapd.read_diff(stop - start) / self.acqtime
+                    if self.isESR:
+                        # contrast as in the line scans: MW off - MW on
+                        ctr_diff = (ctr_diff - self.ctrapd2.read_diff(stop - start) / self.acqtime) / duty
+                    rows = pattern.accumulate(ctr_diff, start, frame_sum, frame_hits)
+                    start = stop
+                    if rows is None:
+                        continue
+
+                    lo, hi = rows
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        vals = np.where(frame_hits[:, lo:hi] > 0, frame_sum[:, lo:hi] / frame_hits[:, lo:hi], np.nan)
+                    for row in range(lo, hi):
+                        if np.any(frame_hits[:, row]):
+                            self.confocal_live_stacks.set_row(row, vals[:, row - lo])
+                    self.mainexp.plt_confocal_scheduler.mark(['pl'], lo, hi)
 
             if hasattr(PyDAQmx.DAQmxFunctions, 'DAQWarning'):
                 with warnings.catch_warnings():
@@ -395,12 +557,13 @@ class Confocal(ExpThread.ExpThread):
 
                     self.mainexp.ctrclk.stop()
                     self.mainexp.ctrclk.reset()
-                    try:
-                        self.mainexp.ctrapd.stop()
-                    except PyDAQmx.DAQmxFunctions.DAQError:
-                        # It is normal for the PyDAQmx to throw an error when stopped prematurely
-                        pass
-                    self.mainexp.ctrapd.reset()
+                    for ctr in [self.mainexp.ctrapd] + ([self.ctrapd2] if self.isESR else []):
+                        try:
+                            ctr.stop()
+                        except PyDAQmx.DAQmxFunctions.DAQError:
+                            # It is normal for the PyDAQmx to throw an error when stopped prematurely
+                            pass
+                        ctr.reset()
 
             if self.isRunning():
                 self.wait_for_mainexp()
@@ -443,37 +606,44 @@ class Confocal(ExpThread.ExpThread):
 
     def plane_fit(self):
         """
-        a, b, c, d = planeFit(points)
-
-        return the coefficients of the plane equation ax + by + cz = d
-        from a list of three numpy vectors
+        Fits the autoZ focal surface (self.focus_model) by least squares to all points in table_confocalZ and to
+        the z tracking results of the last focus_max_age seconds.
         """
+        points = self.focus_table_points()
+        now = time.time()
+        points += [p[1:] for p in self.mainexp.thread_tracker.focus_points if now - p[0] < self.focus_max_age]
+
+        try:
+            self.focus = focus_surface.FocusSurface(self.focus_model, self.focus_smoothing).fit(points)
+        except (ValueError, np.linalg.LinAlgError) as e:
+            # no stale surface: calcZ keeps z at the tracker position until the next successful fit
+            self.focus = focus_surface.FocusSurface(self.focus_model, self.focus_smoothing)
+            self.log('autoZ: %s' % e)
+            self.mainexp.label_confocalZ_eq.setText(self.focus.describe())
+            return
+
+        if self.focus.model != self.focus_model:
+            self.log('autoZ: %d points are not enough for a %s fit, using a %s' %
+                     (len(points), self.focus_model, self.focus.model))
+        self.mainexp.label_confocalZ_eq.setText(self.focus.describe())
+
+    def focus_table_points(self):
+        # x, y, z rows of table_confocalZ, skipping incomplete rows
         table = self.mainexp.table_confocalZ
-        if table.rowCount() >= 3:
-            if table.rowCount() > 3:
-                self.log('More than  three points defined. Using only the first three.')
-
-            p0 = np.array([float(table.item(0, 0).text()), float(table.item(0, 1).text()), float(table.item(0, 2).text())])
-            p1 = np.array([float(table.item(1, 0).text()), float(table.item(1, 1).text()), float(table.item(1, 2).text())])
-            p2 = np.array([float(table.item(2, 0).text()), float(table.item(2, 1).text()), float(table.item(2, 2).text())])
-
-            v1 = p1 - p0
-            v2 = p2 - p0
-
-            norm = np.cross(v1, v2)
-
-            a = norm[0]
-            b = norm[1]
-            c = norm[2]
-
-            d = a * p0[0] + b * p0[1] + c * p0[2]
-
-            self.plane_coef = [a, b, c, d]
-            self.mainexp.label_confocalZ_eq.setText('z = %.3f + %.3fx + %.3fy' % (d / c, -a / c, -b / c))
+        points = []
+        for row in range(table.rowCount()):
+            try:
+                points.append([float(table.item(row, col).text()) for col in range(3)])
+            except (AttributeError, ValueError):
+                pass
+        return points
 
     def calcZ(self, x, y):
-        [a, b, c, d] = self.plane_coef
-        return (d - a*x - b*y)/c
+        # x, y can be arrays. Without a fit, z stays at the tracker position
+        if self.focus.model is None:
+            return np.full(np.shape(x), self.mainexp.dbl_tracker_zpos.value()) if np.ndim(x) else \
+                self.mainexp.dbl_tracker_zpos.value()
+        return self.focus(x, y)
 
     def run(self):
         self.cancel = False
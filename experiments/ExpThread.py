@@ -51,7 +51,11 @@ class ExpThread(QThread):
 
         sweep_params['sample'] = self.mainexp.linein_sample_name.text()
 
-        file_utils.save_data(filename, data_dict, graph=graph, fig=fig, sweep_params=sweep_params)
+        # Write on the save queue thread if it is running, so that the experiment does not wait for the disk
+        if hasattr(self.mainexp, 'save_queue') and self.mainexp.save_queue.isRunning():
+            self.mainexp.save_queue.put(filename, data_dict, graph=graph, fig=fig, sweep_params=sweep_params)
+        else:
+            file_utils.save_data(filename, data_dict, graph=graph, fig=fig, sweep_params=sweep_params)
 
         # Increment wavenum if it has not been incremented already
         if self.mainexp.wavenum < wavenum:
@@ -356,7 +356,7 @@ class PicoHarp(ExpThread.ExpThread):
         track_period = self.mainexp.dbl_tracker_period.value() * 60
         bool_period = self.mainexp.chkbx_picoharp_autotrack.isChecked()
 
-        if (time.time() - self.lasttracktime > track_period) and bool_period:
+        if bool_period and self.mainexp.thread_tracker.tracking_due(self.lasttracktime, track_period):
             self.mainexp.pb.set_cw()
             self.track()
 
@@ -365,6 +365,8 @@ class PicoHarp(ExpThread.ExpThread):
                 self.save()
 
             self.lasttracktime = time.time()
+        else:
+            self.mainexp.thread_tracker.feedforward(self)
 
     def track(self, numtrack=1):
         self.mainexp.thread_tracker.numtrack = numtrack
@@ -0,0 +1,169 @@
+from PyQt5.QtCore import QThread, pyqtSignal
+from collections import OrderedDict
+import os, copy, time, threading
+
+import file_utils
+
+
+class SaveQueue(QThread):
+    '''
+    Writes the data files on its own thread so that the experiment threads never wait for the disk or the network
+    share. put() takes a snapshot of the data, so the experiment can keep filling its arrays. A save that is still
+    waiting is replaced by a newer save of the same file (e.g. periodic backups of the same wavenum).
+    Remote writes that fail are retried in the background.
+    '''
+
+    signal_log = pyqtSignal(str)
+
+    def __init__(self, mainexp, localdir=os.path.join('~', 'Documents'), remotedir=r'Y:\Data\Confocal1'):
+        QThread.__init__(self)
+        self.localdir = localdir
+        self.remotedir = remotedir  # None: local saves only
+        # Whether remotedir has been reachable in this session. A share that was seen and is missing now is
+        # temporarily unavailable and its writes are retried; one that was never seen (e.g. a computer without it)
+        # is only logged, once, and the files are listed by stop()
+        self.remote_seen = False
+        self.remote_skipped = []
+
+        self.retry_period = 30.0  # seconds between attempts of a failed remote write
+        self.retry_max = 20
+        self.slow_save = 1.0  # log saves that take longer than this (seconds)
+
+        self.cond = threading.Condition()
+        self.pending = OrderedDict()  # filename -> snapshot waiting to be written locally and remotely
+        self.retries = OrderedDict()  # filename -> [snapshot, attempts, time of the next attempt] for remote writes
+        self.busy = False
+        self.stopping = False
+        self.n_saved = 0
+        self.n_coalesced = 0
+
+        self.signal_log.connect(mainexp.log)
+
+    def put(self, filename, data, graph=None, fig=None, sweep_params=None):
+        # QImage can be written from this thread, QPixmap only from the GUI thread
+        snapshot = {'data': copy.deepcopy(data),
+                    'graph': graph.toImage() if graph is not None else None,
+                    'fig': fig.toImage() if fig is not None else None,
+                    'sweep_params': copy.deepcopy(sweep_params)}
+
+        with self.cond:
+            if filename in self.pending:
+                self.n_coalesced += 1
+            self.pending[filename] = snapshot
+            self.pending.move_to_end(filename)
+            self.retries.pop(filename, None)  # superseded by the new version
+            self.cond.notify_all()
+
+    def backlog(self):
+        with self.cond:
+            return len(self.pending) + int(self.busy)
+
+    def flush(self, timeout=None):
+        # Wait until everything that was put has been written locally (failed remote writes are not waited for)
+        t_end = None if timeout is None else time.perf_counter() + timeout
+        with self.cond:
+            while self.pending or self.busy:
+                if t_end is not None and time.perf_counter() >= t_end:
+                    return False
+                self.cond.wait(None if t_end is None else t_end - time.perf_counter())
+        return True
+
+    def stop(self):
+        # Write what is pending and end the thread
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.wait()
+        if self.retries:
+            self.log('%d remote saves were not written: %s' % (len(self.retries), ', '.join(self.retries.keys())))
+        if self.remote_skipped:
+            self.log('%d files were only saved locally, %s was not available: %s' %
+                     (len(self.remote_skipped), self.remotedir, ', '.join(self.remote_skipped)))
+
+    def log(self, s):
+        self.signal_log.emit(s)
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopping and not self.retry_due():
+                    self.cond.wait(self.retry_wait())
+                if self.pending:
+                    filename, snapshot = self.pending.popitem(last=False)
+                    remote_only = False
+                elif self.retry_due():
+                    filename = min(self.retries, key=lambda f: self.retries[f][2])
+                    snapshot = self.retries[filename][0]
+                    remote_only = True
+                else:  # stopping
+                    break
+                self.busy = True
+
+            t_start = time.perf_counter()
+            try:
+                if not remote_only:
+                    try:
+                        mtime = file_utils.catalog_mtime()
+                        file_utils.save_files(self.localdir, filename, snapshot['data'], graph=snapshot['graph'],
+                                              fig=snapshot['fig'], sweep_params=snapshot['sweep_params'])
+                        msg = file_utils.catalog_add(filename, snapshot['sweep_params'], mtime)
+                        if msg:
+                            self.log(msg)
+                    except Exception as e:
+                        self.log('Saving %s failed: %s' % (filename, str(e)))
+                self.save_remote(filename, snapshot, remote_only)
+            finally:
+                dt = time.perf_counter() - t_start
+                with self.cond:
+                    self.busy = False
+                    self.n_saved += 1
+                    n_waiting = len(self.pending)
+                    self.cond.notify_all()
+
+            if dt > self.slow_save or n_waiting:
+                self.log('Saved %s in %.1f s (%d waiting, %d coalesced so far)' %
+                         (filename, dt, n_waiting, self.n_coalesced))
+
+    def save_remote(self, filename, snapshot, retry):
+        if not self.remotedir:
+            return
+        if not os.path.exists(self.remotedir):
+            if retry or self.remote_seen:
+                self.schedule_retry(filename, snapshot, 'remote directory is not available')
+            else:
+                if not self.remote_skipped:
+                    self.log('Remote directory %s is not available, saving locally only' % self.remotedir)
+                self.remote_skipped.append(filename)
+            return
+        self.remote_seen = True
+        try:
+            file_utils.save_files(self.remotedir, filename, snapshot['data'], graph=snapshot['graph'],
+                                  fig=snapshot['fig'], sweep_params=snapshot['sweep_params'])
+            if retry:
+                with self.cond:
+                    self.retries.pop(filename, None)
+                self.log('Saved %s remotely after retrying' % filename)
+        except Exception as e:
+            self.schedule_retry(filename, snapshot, str(e))
+
+    def schedule_retry(self, filename, snapshot, reason):
+        with self.cond:
+            if filename in self.pending:
+                return  # a newer version will be written anyway
+            attempts = self.retries[filename][1] + 1 if filename in self.retries else 1
+            if attempts > self.retry_max:
+                self.retries.pop(filename, None)
+                self.log('Gave up saving %s remotely: %s' % (filename, reason))
+                return
+            self.retries[filename] = [snapshot, attempts, time.perf_counter() + self.retry_period]
+        self.log('Saving %s remotely failed (attempt %d), retrying in %d s: %s' %
+                 (filename, attempts, self.retry_period, reason))
+
+    def retry_due(self):
+        return any(r[2] <= time.perf_counter() for r in self.retries.values()) and not self.stopping
+
+    def retry_wait(self):
+        # time until the next retry is due, None to wait for put()
+        if not self.retries:
+            return None
+        return max(0.0, min(r[2] for r in self.retries.values()) - time.perf_counter())
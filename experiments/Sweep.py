@@ -1,9 +1,10 @@
 from PyQt5.QtCore import pyqtSignal
-import time, datetime, warnings
+import time, datetime, warnings, os
+import concurrent.futures
 import numpy as np
 import PyDAQmx
 
-import fitters
+import fitters, file_utils, chunk_store
 from . import ExpThread
 
 
@@ -19,6 +20,129 @@ def round_tau(num, div=8e-9):
     return div * np.round(num.astype(float)/div)
 
 
+class NewctrAccumulator:
+    '''Sums the newctr counts into the counters defined by ctrticks, one chunk of the raw (cumulative) counts at a time.
+    ctr_sum holds the total of each counter over the completed reps, ctr_all the value of each rep if keep_traces.'''
+
+    def __init__(self, ctrticks, reps, keep_traces=False):
+        self.ctrticks = np.array(ctrticks, dtype=int)
+        self.numticks = len(set(self.ctrticks.flatten()))
+        self.reps = int(reps)
+        self.keep_traces = keep_traces
+
+        self.n_reps = 0  # number of completed reps
+        self.ctr_sum = np.zeros(len(self.ctrticks))
+        self.ctr_all = None
+        if keep_traces:
+            self.ctr_all = np.empty((len(self.ctrticks), self.reps))
+            self.ctr_all[:] = np.nan
+
+        self.last_counter = None  # last raw count of the previous chunk
+        self.pending = np.zeros(0, dtype=np.int64)  # counts of the rep that is not complete yet
+
+    def add(self, ctr_raw):
+        if not len(ctr_raw):
+            return
+        ctr_raw = np.asarray(ctr_raw, dtype=np.uint32)
+        if self.last_counter is not None:
+            ctr_raw = np.concatenate(([self.last_counter], ctr_raw))
+        self.last_counter = ctr_raw[-1]
+
+        # uint32 difference takes care of the counter rolling over
+        ctr_diff = np.concatenate((self.pending, np.diff(ctr_raw).astype(np.int64)))
+        n = len(ctr_diff) // self.numticks
+        self.fold(ctr_diff[:n * self.numticks].reshape(n, self.numticks))
+        self.pending = ctr_diff[n * self.numticks:]
+
+    def finish(self):
+        # Call after reading all the samples. The counts after the very last tick are never read, so complete the
+        # last rep without them.
+        if len(self.pending) == self.numticks - 1:
+            self.fold(np.append(self.pending, 0).reshape(1, self.numticks))
+        self.pending = np.zeros(0, dtype=np.int64)
+
+    def fold(self, ticks):
+        # ticks: (n, numticks) counts between consecutive ticks for each rep
+        n = min(len(ticks), self.reps - self.n_reps)
+        if n <= 0:
+            return
+        ctr = np.stack([np.sum(ticks[:n, start:stop], axis=1) for start, stop in self.ctrticks], axis=1)
+
+        self.ctr_sum += np.sum(ctr, axis=0)
+        if self.keep_traces:
+            self.ctr_all[:, self.n_reps:self.n_reps + n] = ctr.T
+        self.n_reps += n
+
+    def pl(self, sigref):
+        [sig, ref] = sigref
+        return self.ctr_sum[sig] / self.ctr_sum[ref]
+
+
+class TimetraceAccumulator:
+    '''Sums consecutive timetrace traces of numpnts points (numpnts + 1 samples each, the first one being the count at
+    the trigger) from the differenced counter stream of DAQmxCounterInput.read_diff, one chunk at a time.
+    ctr_total holds the total of each point over the n_traces completed traces since the last next_row().'''
+
+    def __init__(self, numpnts):
+        self.numpnts = int(numpnts)
+        self.n_diff = 0  # number of differences added, i.e. index of the last sample (the first sample is 0)
+        self.first_trace = 0
+        self.n_traces = 0
+        self.ctr_total = np.zeros(self.numpnts)
+
+    def add(self, ctr_diff, max_traces=None):
+        # Add the differences up to the end of trace max_traces (counted from next_row()). Returns the number used.
+        n = len(ctr_diff)
+        if max_traces is not None:
+            last_sample = (self.first_trace + max_traces) * (self.numpnts + 1) - 1
+            n = max(0, min(n, last_sample - self.n_diff))
+
+        # Position of each sample within its trace. Position 0 is the count at the next trigger, not part of a trace
+        pos = (self.n_diff + 1 + np.arange(n)) % (self.numpnts + 1)
+        keep = pos != 0
+        self.ctr_total += np.bincount(pos[keep] - 1, weights=ctr_diff[:n][keep], minlength=self.numpnts)
+
+        self.n_diff += n
+        self.n_traces = (self.n_diff + 1) // (self.numpnts + 1) - self.first_trace
+        return n
+
+    def next_row(self):
+        self.first_trace += self.n_traces
+        self.n_traces = 0
+        self.ctr_total = np.zeros(self.numpnts)
+
+
+class SweepPrefetcher:
+    '''Runs one task at a time on a worker thread, e.g. preparing the next sweep point while the current one acquires'''
+
+    def __init__(self):
+        self.executor = None
+        self.future = None
+
+    def submit(self, fn, *args):
+        if self.executor is None:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.future = self.executor.submit(fn, *args)
+
+    def join(self):
+        # Wait for the last task to finish. Returns the time spent waiting.
+        if self.future is None:
+            return 0.0
+        t_start = time.perf_counter()
+        try:
+            self.future.result()
+        except Exception as e:
+            print('Prefetch failed: %s' % str(e))  # The point gets prepared again when it is set
+        self.future = None
+        return time.perf_counter() - t_start
+
+    def shutdown(self):
+        self.join()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
 class Sweep(ExpThread.ExpThread):
 
     signal_sweep_grab_screenshots = pyqtSignal()
@@ -62,7 +186,10 @@ class Sweep(ExpThread.ExpThread):
         self.isINV = False              # cycle the inv parameter (typically for pi/2 phase cycling)
         self.isINV2 = False             # cycle the inv2 parameter (typically for conditioning DEER on/off)
         self.fastPLE = False            # run a fast analog sweep for PLE
+        self.fastlist = False           # step the MW source through a frequency list with ctrclk for CW ESR
         self.newctr_2d = False          # acquire the counter data with tick marks and record every trace
+        self.newctr_chunk = 100000      # number of samples to read at a time while the pulseblaster is running
+        self.pipeline = True            # prepare the next sweep point while the current one acquires
         self.pl_norm = False            # normalize PL data
 
         # PL normalization
@@ -100,8 +227,8 @@ class Sweep(ExpThread.ExpThread):
         # ESR Signals
         self.signal_sweep_esr_initplots.connect(mainexp.sweep_esr_initplots)
         self.signal_sweep_esr_updateplots.connect(mainexp.sweep_esr_updateplots)
-        self.signal_sweep_esr_updateplots_start.connect(mainexp.plt_esr_update_timer.start)
-        self.signal_sweep_esr_updateplots_stop.connect(mainexp.plt_esr_update_timer.stop)
+        self.signal_sweep_esr_updateplots_start.connect(mainexp.plt_esr_scheduler.start)
+        self.signal_sweep_esr_updateplots_stop.connect(mainexp.plt_esr_scheduler.stop)
 
         # # PLE Signals
         self.signal_sweep_ple_initplots.connect(mainexp.sweep_ple_initplots)
@@ -117,7 +244,13 @@ class Sweep(ExpThread.ExpThread):
         self.signal_sweep_setval_manual_prompt.connect(mainexp.exp_params_setval_manual_prompt)
 
         self.print_row_timings = False
+        self.dt_wait = 0.0  # total time spent waiting past the expected end of the gate/sequence (for row timings)
+        self.dt_stall = 0.0  # total time spent waiting for the prefetch thread (for row timings)
+        self.prefetcher = SweepPrefetcher()
 
+        # Autosave backups while the sweep is running only write the rows filled since the last backup
+        self.rows_done = None  # number of completed rows (2D) or points (1D), None if the sweep does not keep track
+        self.chunk_store = None
 
     def run(self):
         self.cancel = False  # Flag that gets set to True if user clicks the stop button
@@ -125,6 +258,8 @@ class Sweep(ExpThread.ExpThread):
         self.mainexp.task_handler.cancel = False  # Enables TaskHandler so that Sweep can call setval()
 
         self.lasttracktime = -1.0  # this will force tracking on the first point
+        self.rows_done = None
+        self.chunk_store = None
 
         self.run_script('sweep_init.py')
 
@@ -152,6 +287,7 @@ class Sweep(ExpThread.ExpThread):
         self.isINV = 'inv' in self.mainexp.exp_params['Pulse'].keys() and self.mainexp.chkbx_inv.isChecked()
         self.isINV2 = 'inv2' in self.mainexp.exp_params['Pulse'].keys() and self.mainexp.chkbx_inv2.isChecked()
         self.fastPLE = self.isPLE and self.mainexp.chkbx_PLE_fast.isChecked()
+        self.fastlist = not self.isPLE and not self.use_pb and self.mainexp.chkbx_esr_fastlist.isChecked()
         self.newctr_2d = self.newctr and self.mainexp.chkbx_newctr_2d.isChecked()
         self.pl_norm = self.mainexp.chkbx_plnorm.isChecked()
 
@@ -248,6 +384,14 @@ class Sweep(ExpThread.ExpThread):
         mainexp.esr_rngy = self.sweeprng2
         self.delay2 = mainexp.var2_delay.value()
 
+        if self.fastlist:
+            if self.is2D:
+                self.log('Warning: Fast list sweep is only available for 1D scans. Doing slow scan.')
+                self.fastlist = False
+            elif self.get_fastlist_source() is None:
+                self.log('Warning: Cannot do fast list sweep with variable %s. Doing slow scan.' % self.var1)
+                self.fastlist = False
+
         # Disable 2D scan for newctr for now
         if self.newctr and self.is2D:
             self.log(
@@ -416,7 +560,10 @@ class Sweep(ExpThread.ExpThread):
             if not self.isPLE or not self.fastPLE:
                 self.setup_ctr_esr()
                 if not self.is2D:
-                    self.sweep_esr_1d()
+                    if not self.fastlist:
+                        self.sweep_esr_1d()
+                    else:
+                        self.sweep_esr_1d_fastlist()
                 else:
                     self.sweep_esr_2d()
             else:
@@ -448,34 +595,63 @@ class Sweep(ExpThread.ExpThread):
             else:
                 self.setup_ctr_newctr()
 
+    # The counter setups use pooled tasks (DAQmxChannel.use_config) so that setting up again after track() only
+    # switches tasks instead of clearing and reconfiguring them
+    def setup_ctr_gated(self, ctr, src, gate):
+        def configure(ch):
+            ch.set_source(src)
+            ch.set_pause_trigger(gate)
+        ctr.use_config(('gated', src, gate), configure)
+
     def setup_ctr_cw(self):
-        self.ctr0.reset()
-        self.ctr0.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
-        self.ctrtrig.reset()
-        self.ctr0.set_pause_trigger(self.mainexp.inst_params['instruments']['ctrtrig']['addr_out'])
+        addrs = self.mainexp.inst_params['instruments']
+        self.setup_ctr_gated(self.ctr0, addrs['ctrapd']['addr_src'], addrs['ctrtrig']['addr_out'])
+        self.ctrtrig.set_time(self.delay1)
 
     def setup_ctr_pulse(self):
-        self.ctr0.reset()
-        self.ctr1.reset()
-        self.ctr2.reset()
-        self.ctr3.reset()
-        self.ctr0.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
-        self.ctr0.set_pause_trigger(self.mainexp.inst_params['instruments']['ctrapd']['addr_gate'])
-        self.ctr1.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
-        self.ctr1.set_pause_trigger(self.mainexp.inst_params['instruments']['ctrapd2']['addr_gate'])
-        self.ctr2.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
-        self.ctr2.set_pause_trigger(self.mainexp.inst_params['instruments']['ctrapd3']['addr_gate'])
-        self.ctr3.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
-        self.ctr3.set_pause_trigger(self.mainexp.inst_params['instruments']['ctrapd4']['addr_gate'])
+        addrs = self.mainexp.inst_params['instruments']
+        self.setup_ctr_gated(self.ctr0, addrs['ctrapd']['addr_src'], addrs['ctrapd']['addr_gate'])
+        self.setup_ctr_gated(self.ctr1, addrs['ctrapd']['addr_src'], addrs['ctrapd2']['addr_gate'])
+        self.setup_ctr_gated(self.ctr2, addrs['ctrapd']['addr_src'], addrs['ctrapd3']['addr_gate'])
+        self.setup_ctr_gated(self.ctr3, addrs['ctrapd']['addr_src'], addrs['ctrapd4']['addr_gate'])
 
     def setup_ctr_newctr(self):
         # Use only ctr0. The clocks are defined by pulseblaster on ctr0 (a.k.a. ctrapd addr_gate)
-        self.ctr0.reset()
         numticks = len(set(np.array(self.pb.newctr_ctrticks).flatten()))
         reps = np.uint32(self.pb.params['reps'])
-        self.ctr0.set_sample_clock(self.mainexp.inst_params['instruments']['ctrapd']['addr_gate'],
-                                   PyDAQmx.DAQmx_Val_Rising, numticks*reps)
-        self.ctr0.set_read_all_samples(True)
+        gate = self.mainexp.inst_params['instruments']['ctrapd']['addr_gate']
+
+        def configure(ch):
+            ch.set_sample_clock(gate, PyDAQmx.DAQmx_Val_Rising, numticks*reps)
+            # get_esr_data_newctr_stream() only reads the samples that are already available
+            ch.set_read_all_samples(False)
+        self.ctr0.use_config(('newctr', gate, numticks*reps), configure)
+
+    def setup_ctr_fastlist(self):
+        # ctrclk steps the MW source (ctrclk addr_out must be wired to the trigger input of the source) and clocks
+        # ctr0 at the same time. One extra tick for reading the starting count.
+        numpnts = len(self.sweeprng1) + 1
+        self.ctr0.reset()
+        self.ctrclk.reset()
+        self.ctr0.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
+        self.ctr0.set_sample_clock(self.mainexp.inst_params['instruments']['ctrclk']['addr_out'],
+                                   PyDAQmx.DAQmx_Val_Rising, numpnts)
+
+        self.ctrclk.set_freq(1.0 / self.delay1)
+        self.ctrclk.set_finite_samples(numpnts)
+
+    def get_fastlist_source(self):
+        # MW source swept by var1 if it can load the whole sweep range as a list, otherwise None
+        if not (self.var1.startswith('mw') and self.var1.endswith('freq')):
+            return None
+        mw = getattr(self.mainexp, self.var1[:-4], None)
+        if mw is None or not getattr(mw, 'freq_list_max', 0) or not hasattr(mw, 'freq_list_error'):
+            return None
+        error = mw.freq_list_error(self.sweeprng1)
+        if error:
+            self.log(error)
+            return None
+        return mw
 
     def set_print_row_timings(self, state):
         # TODO: should this use a signal instead?
@@ -487,6 +663,7 @@ class Sweep(ExpThread.ExpThread):
             self.ctrtrig.set_time(delay)
             self.ctrtrig.start()
             flag_cancel = self.ctrtrig.wait_until_done_thd(self)
+            self.dt_wait += self.ctrtrig.wait_overhead
             if flag_cancel == 0:
                 self.ctrtrig.stop()
                 pl = self.ctr0.get_count() / delay
@@ -506,6 +683,7 @@ class Sweep(ExpThread.ExpThread):
 
             self.pb.set_program(autostart=1)
             flag_cancel = self.pb.wait_until_finished_thd(self)
+            self.dt_wait += self.pb.wait_overhead
 
             if flag_cancel == 0:
                 sig = self.ctr0.get_count()
@@ -549,68 +727,63 @@ class Sweep(ExpThread.ExpThread):
     def get_esr_data_newctr(self, delay):
         time.sleep(delay)
 
-        ctr_raw = self.get_esr_data_newctr_raw()
-
-        ctrticks = self.pb.newctr_ctrticks
-
-        reps = np.uint32(self.pb.params['reps'])
-        numctr = len(ctrticks)
-        numticks = len(set(np.array(ctrticks).flatten()))
-        [sig, ref] = self.pb.newctr_sigref  # index of the counters to divide as sig/ref => PL
-
-        ctr_diff = np.diff(ctr_raw)
+        acc = self.get_esr_data_newctr_stream()
+        pl = acc.pl(self.pb.newctr_sigref)  # index of the counters to divide as sig/ref => PL
 
-        ticks = [[]] * numticks
-
-        for i in range(numticks-1):
-            ticks[i] = ctr_diff[i::numticks]
-
-        ctr_all = np.zeros((numctr, reps))
-
-        for i in range(numctr):
-            for j in range(ctrticks[i][0], ctrticks[i][1]):
-                ctr_all[i][:] += ticks[j]
-
-        pl = np.sum(ctr_all[sig][:]) / np.sum(ctr_all[ref][:])
-
-        return [ctr_all, pl]
+        if not self.newctr_2d:
+            return [acc.ctr_sum, pl]
+        else:
+            return [acc.ctr_all, pl]
 
-    def get_esr_data_newctr_raw(self, itr=0):
+    def get_esr_data_newctr_stream(self, itr=0):
+        # Drain the counter in chunks while the pulseblaster is running and sum them up as they come in.
+        # If cancelled, the reps that are already read are kept.
         numticks = len(set(np.array(self.pb.newctr_ctrticks).flatten()))  # Assume all ticks must be used
         reps = np.uint32(self.pb.params['reps'])
+        numpnts = int(numticks * reps)
+
+        acc = NewctrAccumulator(self.pb.newctr_ctrticks, reps, keep_traces=self.newctr_2d)
 
         self.ctr0.start()
 
         self.pb.set_program()
 
-        # wait for pb to finish
-        self.pb.wait_until_finished_thd(self)
+        n_read = 0
+        while not self.cancel and n_read < numpnts:
+            # Check pulseblaster first. If it is finished, all the samples are already in the buffer.
+            pb_running = self.pb.pb_read_status() == 4
+            n_avail = self.ctr0.get_avail_samples()
 
-        # Now that pulseblaster is finished. No more counter ticks should be received.
-        # Just read out everything and check if the number of ticks are correct.
-        # ctr_raw = self.ctr0.get_counts(num_ticks * np.uint32(self.pb.params['reps']))
-        ctr_raw = self.ctr0.get_counts(numticks * reps)
+            if n_avail >= self.newctr_chunk or (n_avail and not pb_running):
+                ctr_raw = self.ctr0.read_counts(min(n_avail, self.newctr_chunk, numpnts - n_read))
+                acc.add(ctr_raw)
+                n_read += len(ctr_raw)
+            elif not pb_running:
+                break
+            else:
+                time.sleep(0.01)
 
-        #  not needed since we are forcing the readout on all the counters after waiting for pulseblaster
-        # self.ctr0.wait_until_done()
         try:
             self.ctr0.stop()
         except PyDAQmx.DAQmxFunctions.DAQError:
-            if len(ctr_raw) != (numticks * reps):
-                print('Did not acquire all the samples. Need to rerun the experiment.')
-                if itr < 2:
-                    return self.get_esr_data_newctr_raw(itr=itr+1)
-                else:
-                    self.log('Failed to acquire all samples twice. You are doing something wrong!')
+            pass  # This is normal if we are stopping before all the samples are acquired
+
+        if not self.cancel and n_read != numpnts:
+            print('Did not acquire all the samples. Need to rerun the experiment.')
+            if itr < 2:
+                return self.get_esr_data_newctr_stream(itr=itr+1)
             else:
-                self.log('Unknown counter error!')
+                self.log('Failed to acquire all samples twice. You are doing something wrong!')
 
-        return ctr_raw
+        if n_read == numpnts:
+            acc.finish()
+        return acc
 
     def sweep_esr_1d(self):
         t_start_sweep = time.perf_counter()
         dt_tracking = 0.0
         dt_data = 0.0
+        self.dt_wait = 0.0
         xvar = self.var1
         # check if the endpoints are valid pulse parameters
         errorstring = ''
@@ -640,18 +813,24 @@ class Sweep(ExpThread.ExpThread):
         self.mainexp.label_sweep_time_est.setText('Est. Time %d seconds.' % est_total_time)
         self.mainexp.esr_pause = False
 
+        self.dt_stall = 0.0
+        dt_acq = 0.0
         index = 0
+        self.rows_done = 0
         for x in self.sweeprng1:
             if not self.cancel:
                 if index == 0:
                     warnings.simplefilter('ignore', RuntimeWarning)
 
+                self.dt_stall += self.prefetcher.join()
+
                 t_start_track = time.perf_counter()
                 self.track_if_needed()
                 t_end_track = time.perf_counter()
                 dt_tracking += t_end_track - t_start_track
 
-                self.setval_wrapper(xvar, x)
+                next_x = self.sweeprng1[index + 1] if index + 1 < len(self.sweeprng1) else None
+                self.setval_pipelined(xvar, x, next_x)
 
                 if not self.cancel:
                     if not self.isPLE:
@@ -662,6 +841,7 @@ class Sweep(ExpThread.ExpThread):
                             data = self.get_esr_data(self.delay1)
                             t_end_data = time.perf_counter()
                             dt_data += t_end_data - t_start_data
+                            dt_acq += self.acq_time()
                             if not self.use_pb:
                                 self.esr_update_1d_cw(data, index)
                             else:
@@ -675,8 +855,7 @@ class Sweep(ExpThread.ExpThread):
                             data = self.get_esr_data_newctr(self.delay1)
                             t_end_data = time.perf_counter()
                             dt_data += t_end_data - t_start_data
-                            if not self.newctr_2d:
-                                data = [np.sum(data[0], axis=1), data[1]]
+                            dt_acq += self.acq_time()
                             self.esr_update_1d_newctr(data, index)
 
                     else:
@@ -695,12 +874,19 @@ class Sweep(ExpThread.ExpThread):
                         self.ple_update_1d(data, ref, index)
 
             index += 1
+            self.rows_done = index
+
+        self.dt_stall += self.prefetcher.join()
+        self.verify_setvals()
+        self.mainexp.task_handler.signal_taskhandler_update_params_table.emit()
 
         t_end_sweep = time.perf_counter()
         dt_sweep = t_end_sweep - t_start_sweep
         dt_sweep_no_tracking = dt_sweep - dt_tracking
         if self.print_row_timings:
             print("total sweep1d duration = {:.3f} s".format(dt_sweep))
+            print("duty cycle = {:.2%} ({:.3f} s acquiring, {:.3f} s waiting for prefetch)".format(
+                dt_acq / dt_sweep, dt_acq, self.dt_stall))
             print("estimated sweep duration = {:.3f} s ({:.2%} total, {:.2%} no tracking)".format(
                 est_total_time,
                 est_total_time/dt_sweep,
@@ -710,6 +896,8 @@ class Sweep(ExpThread.ExpThread):
                 dt_data,
                 dt_data/dt_sweep,
                 dt_data/dt_sweep_no_tracking))
+            print("wait overhead duration = {:.3f} s ({:.2%} total, {:.3f} ms per point)".format(
+                self.dt_wait, self.dt_wait/dt_sweep, self.dt_wait/len(self.sweeprng1)*1e3))
             dt_other = dt_sweep - (dt_data + dt_tracking)
             print("other duration = {:.3f} s ({:.2%} total, {:.2%} no tracking)".format(
                 dt_other, dt_other / dt_sweep, dt_other / dt_sweep_no_tracking))
@@ -718,10 +906,71 @@ class Sweep(ExpThread.ExpThread):
             self.pb.stop()
             self.pb.set_cw()
 
+    def sweep_esr_1d_fastlist(self):
+        # CW ESR with the frequency list loaded into the MW source. Same idea as Confocal.sweep2d_fast: the whole
+        # sweep is a single hardware-timed acquisition instead of a GPIB write and a gated count for every point.
+        t_start_sweep = time.perf_counter()
+        numpnts = len(self.sweeprng1)
+        mw = self.get_fastlist_source()
+
+        self.mainexp.label_sweep_time_est.setText('Est. Time %d seconds.' % (self.delay1 * numpnts))
+        self.mainexp.esr_pause = False
+        warnings.simplefilter('ignore', RuntimeWarning)
+
+        t_start_track = time.perf_counter()
+        self.track_if_needed()
+        dt_tracking = time.perf_counter() - t_start_track
+
+        if not self.cancel:
+            t_start_setup = time.perf_counter()
+            if mw is None or not mw.set_freq_list(self.sweeprng1):
+                self.log('Warning: Cannot load the frequency list. Doing slow scan.')
+                self.fastlist = False
+                self.sweep_esr_1d()
+                return
+            self.setup_ctr_fastlist()
+            dt_setup = time.perf_counter() - t_start_setup
+            time.sleep(self.delay2)
+
+            t_start_data = time.perf_counter()
+            self.ctr0.start()
+            self.ctrclk.start()
+
+            # Read in chunks of about 0.1 s to update the plots and check for cancel
+            chunk = int(min(numpnts, max(1, np.ceil(0.1 / self.delay1))))
+            self.ctr0.reset_diff()
+            self.ctr0.read_diff(1)  # starting count
+            index = 0
+            while index < numpnts and not self.cancel:
+                n = min(chunk, numpnts - index)
+                self.esr_update_1d_cw_chunk(self.ctr0.read_diff(n) / self.delay1, index)
+                index += n
+            dt_data = time.perf_counter() - t_start_data
+
+            try:
+                self.ctr0.stop()
+            except PyDAQmx.DAQmxFunctions.DAQError:
+                pass  # This is normal if we are stopping before it finishes
+            self.ctrclk.stop()
+            mw.set_freq_cw()
+
+            if self.print_row_timings:
+                dt_sweep = time.perf_counter() - t_start_sweep
+                print("total fast list sweep duration = {:.3f} s".format(dt_sweep))
+                print("tracking duration = {:.3f} s ({:.2%} total)".format(dt_tracking, dt_tracking / dt_sweep))
+                print("list setup duration = {:.3f} s ({:.2%} total)".format(dt_setup, dt_setup / dt_sweep))
+                print("data duration = {:.3f} s ({:.2%} total, {:.2%} dwell)".format(
+                    dt_data, dt_data / dt_sweep, self.delay1 * index / dt_data))
+
+        if self.cancel:
+            self.pb.stop()
+            self.pb.set_cw()
+
     def sweep_esr_2d(self):
         t_start_sweep = time.perf_counter()
         dt_tracking = 0.0
         dt_data = 0.0
+        self.dt_wait = 0.0
         xvar = self.var1
         yvar = self.var2
 
@@ -775,11 +1024,17 @@ class Sweep(ExpThread.ExpThread):
         if not self.cancel:
             index2 = 0
 
+            self.dt_stall = 0.0
+            self.rows_done = 0
             for y in self.sweeprng2:
                 t_start_row = time.perf_counter()
                 dt_data_row = 0.
                 dt_tracking_row = 0.
+                dt_acq_row = 0.
+                dt_wait_start_row = self.dt_wait
+                dt_stall_start_row = self.dt_stall
                 if not self.cancel:
+                    self.dt_stall += self.prefetcher.join()
                     self.setval_wrapper(yvar, y)
                     time.sleep(self.delay2)
 
@@ -791,15 +1046,18 @@ class Sweep(ExpThread.ExpThread):
                         index1 = 0
 
 
-                    for x in sweeprng1:
+                    for i, x in enumerate(sweeprng1):
                         if not self.cancel:
+                            self.dt_stall += self.prefetcher.join()
+
                             t_start_track = time.perf_counter()
                             self.track_if_needed()
                             t_end_track = time.perf_counter()
                             dt_tracking += t_end_track - t_start_track
                             dt_tracking_row += t_end_track - t_start_track
 
-                            self.setval_wrapper(xvar, x)
+                            next_x = sweeprng1[i + 1] if i + 1 < len(sweeprng1) else None
+                            self.setval_pipelined(xvar, x, next_x)
 
                             if not self.cancel:
                                 if not self.isPLE:
@@ -808,6 +1066,7 @@ class Sweep(ExpThread.ExpThread):
                                     t_end_data = time.perf_counter()
                                     dt_data += t_end_data - t_start_data
                                     dt_data_row += t_end_data - t_start_data
+                                    dt_acq_row += self.acq_time()
                                     if not self.use_pb:
                                         self.esr_update_2d_cw(data, index1, index2)
                                     else:
@@ -841,14 +1100,23 @@ class Sweep(ExpThread.ExpThread):
                             index1 += 1
 
                     self.lasttracktime = -1.0  # force tracking on the first point in the next row
+                    self.dt_stall += self.prefetcher.join()
+                    self.rows_done = index2 + 1
+                    self.verify_setvals()
+                    self.mainexp.task_handler.signal_taskhandler_update_params_table.emit()
                 t_end_row = time.perf_counter()
                 dt_row = t_end_row - t_start_row
                 dt_row_no_tracking = dt_row - dt_tracking_row
                 if self.print_row_timings:
                     print("row duration = {:.3f} s".format(dt_row))
+                    print("row duty cycle = {:.2%} ({:.3f} s acquiring, {:.3f} s waiting for prefetch)".format(
+                        dt_acq_row / dt_row, dt_acq_row, self.dt_stall - dt_stall_start_row))
                     print("row tracking duration = {:.3f} s ({:.2%} total)".format(dt_tracking_row, dt_tracking_row / dt_row))
                     print("row data duration = {:.3f} s ({:.2%} total, {:.2%} no tracking)".format(
                         dt_data_row, dt_data_row / dt_row, dt_data_row / dt_row_no_tracking))
+                    dt_wait_row = self.dt_wait - dt_wait_start_row
+                    print("row wait overhead duration = {:.3f} s ({:.2%} total, {:.3f} ms per point)".format(
+                        dt_wait_row, dt_wait_row / dt_row, dt_wait_row / len(self.sweeprng1) * 1e3))
                     dt_other_row = dt_row - (dt_data_row + dt_tracking_row)
                     print("row other duration = {:.3f} s ({:.2%} total, {:.2%} no tracking)".format(
                         dt_other_row, dt_other_row / dt_row, dt_other_row / dt_row_no_tracking))
@@ -865,6 +1133,7 @@ class Sweep(ExpThread.ExpThread):
                 print("tracking duration = {:.3f} s ({:.2%} total)".format(dt_tracking, dt_tracking / dt_sweep))
                 print("data duration = {:.3f} s ({:.2%} total, {:.2%} no tracking)".format(
                     dt_data, dt_data / dt_sweep, dt_data / dt_sweep_no_tracking))
+                print("wait overhead duration = {:.3f} s ({:.2%} total)".format(self.dt_wait, self.dt_wait / dt_sweep))
                 dt_other = dt_sweep - (dt_data + dt_tracking)
                 print("other duration = {:.3f} s ({:.2%} total, {:.2%} no tracking)".format(
                     dt_other, dt_other / dt_sweep, dt_other / dt_sweep_no_tracking))
@@ -916,33 +1185,23 @@ class Sweep(ExpThread.ExpThread):
             for i in range(np.uint32(self.pb.params['reps'])):
                 if not self.cancel:
                     # Get data in chunks equal to the trace length
-                    ctr_raw = self.ctr0.get_counts(len(self.sweeprng1) + 1)
-                    ctr_read = np.diff(ctr_raw)
-                    ctr_total += ctr_read
+                    self.ctr0.reset_diff()
+                    ctr_total += self.ctr0.read_diff(len(self.sweeprng1) + 1)
                     ctr_avg = ctr_total/(i+1)
                     pl = ctr_avg/self.delay1*1000
                     self.esr_update_1d_timetrace(ctr_total, pl)
 
         else:  # Read data as they are available
-            n_read = 0
-            ctr_buffer = np.array([])
-            i = 0
-
-            while not self.cancel and n_read < numpnts:
-                ctr_raw = self.ctr0.get_counts(self.ctr0.cont_buffer_size)
-                n_read += len(ctr_raw)
-                ctr_buffer = np.append(ctr_buffer, ctr_raw)
+            acc = TimetraceAccumulator(len(self.sweeprng1))
+            self.ctr0.reset_diff()
 
-                while len(ctr_buffer) >= (len(self.sweeprng1) + 1):
-                    ctr_read = np.diff(ctr_buffer[0:len(self.sweeprng1) + 1])
-                    ctr_buffer = ctr_buffer[len(self.sweeprng1) + 1:]
-                    ctr_total += ctr_read
-                    i += 1
+            while not self.cancel and self.ctr0.samples_read < numpnts:
+                acc.add(self.ctr0.read_diff(self.ctr0.read_chunk))
 
-                ctr_avg = ctr_total/i
+                ctr_avg = acc.ctr_total/acc.n_traces
                 pl = ctr_avg/self.delay1*1000
 
-                self.esr_update_1d_timetrace(ctr_total, pl)
+                self.esr_update_1d_timetrace(acc.ctr_total, pl)
 
         if not self.cancel:
             self.ctr0.stop()
@@ -1015,31 +1274,30 @@ class Sweep(ExpThread.ExpThread):
                     for i in range(np.uint32(self.pb.params['reps'])):
                         if not self.cancel:
                             # Get data in chunks equal to the trace length
-                            ctr_raw = self.ctr0.get_counts(len(self.sweeprng1) + 1)
-                            ctr_read = np.diff(ctr_raw)
-                            ctr_total += ctr_read
+                            self.ctr0.reset_diff()
+                            ctr_total += self.ctr0.read_diff(len(self.sweeprng1) + 1)
                             ctr_avg = ctr_total / (i + 1)
                             pl = ctr_avg / self.delay1 * 1000
 
                     self.esr_update_2d_timetrace(ctr_total, pl, index2)
         else:  # Read data as they are available
-            n_read = 0
-            ctr_buffer = np.array([])
+            reps = np.uint32(self.pb.params['reps'])
+            acc = TimetraceAccumulator(len(self.sweeprng1))
+            self.ctr0.reset_diff()
             index2 = 0
 
-            while not self.cancel and n_read < numpnts:
-                ctr_raw = self.ctr0.get_counts(self.ctr0.cont_buffer_size)
-                n_read += len(ctr_raw)
-                ctr_buffer = np.append(ctr_buffer, ctr_raw)
-
-                while len(ctr_buffer) >= numpnts_1d and index2 < len(self.sweeprng2):
-                    ctr_1d_reps = np.reshape(ctr_buffer[0:numpnts_1d], (-1, len(self.sweeprng1) + 1))
-                    ctr_total = np.sum(np.diff(ctr_1d_reps, axis=-1), axis=0)
-                    pl = ctr_total / np.uint32(self.pb.params['reps']) / self.delay1 * 1000
+            while not self.cancel and self.ctr0.samples_read < numpnts:
+                ctr_diff = self.ctr0.read_diff(self.ctr0.read_chunk)
 
-                    ctr_buffer = ctr_buffer[numpnts_1d:]
-                    self.esr_update_2d_timetrace(ctr_total, pl, index2)
-                    index2 += 1
+                # Split the chunk at the end of each row (reps traces)
+                n_used = 0
+                while n_used < len(ctr_diff) and index2 < len(self.sweeprng2):
+                    n_used += acc.add(ctr_diff[n_used:], max_traces=reps)
+                    if acc.n_traces == reps:
+                        pl = acc.ctr_total / reps / self.delay1 * 1000
+                        self.esr_update_2d_timetrace(acc.ctr_total, pl, index2)
+                        acc.next_row()
+                        index2 += 1
 
         if not self.cancel:
             self.ctr0.stop()
@@ -1074,9 +1332,8 @@ class Sweep(ExpThread.ExpThread):
                 for i in range(np.uint32(self.pb.params['reps'])):
                     if not self.cancel:
                         # Get data in chunks equal to the trace length
-                        ctr_raw = self.ctr0.get_counts(len(self.sweeprng1) + 1)
-                        ctr_read = np.diff(ctr_raw)
-                        ctr_total += ctr_read
+                        self.ctr0.reset_diff()
+                        ctr_total += self.ctr0.read_diff(len(self.sweeprng1) + 1)
                         ctr_avg = ctr_total / (i + 1)
                         pl = ctr_avg / self.delay1 * 1000
 
@@ -1183,7 +1440,8 @@ class Sweep(ExpThread.ExpThread):
         self.ctrtrig.stop()
 
         # Read the first point anyway
-        ctr_raw = self.ctr0.get_counts(1)
+        self.ctr0.reset_diff()
+        self.ctr0.read_diff(1)
         ai_read = self.ai.get_voltages(1)
 
         # Delete the first ai reading
@@ -1195,19 +1453,18 @@ class Sweep(ExpThread.ExpThread):
         n_read = 1
         t_update = 0.1
         numpnts1 = len(self.sweeprng1)
-        last_counter = ctr_raw[-1]  # Actual counter value, monotonically counts up, need to be diff
 
         self.ctr0.set_read_all_samples(True)
         self.ai.set_read_all_samples(True)
 
         while not self.cancel and n_read < len(vlist):
             time.sleep(t_update)
-            # Just try to read the entire array.
-            ctr_raw = self.ctr0.get_counts(numpnts1)
-            if len(ctr_raw):
+            # Just try to read the entire array. The counts are differenced against the last count read.
+            ctr_diff = self.ctr0.read_diff(numpnts1)
+            if len(ctr_diff):
                 # Read ai for the same amount for synchronized display
-                ai_read = self.ai.get_voltages(len(ctr_raw))
-                ctr_diff = np.diff(np.append([last_counter], ctr_raw)) / self.delay1
+                ai_read = self.ai.get_voltages(len(ctr_diff))
+                ctr_diff = ctr_diff / self.delay1
 
                 tlb = getattr(self.mainexp, self.tlb_id)
                 ai_read_scaled = ai_read * tlb.scale + tlb.offset
@@ -1231,8 +1488,7 @@ class Sweep(ExpThread.ExpThread):
                     for ch in range(n_chan):
                         self.mainexp.esrtrace_ref[ch * numpnts1 + start:ch * numpnts1 + end, yindex] = ai_read_scaled
 
-                n_read += len(ctr_raw)
-                last_counter = ctr_raw[-1]
+                n_read += len(ctr_diff)
 
         if hasattr(PyDAQmx.DAQmxFunctions, 'DAQWarning'):
             with warnings.catch_warnings():
@@ -1297,8 +1553,10 @@ class Sweep(ExpThread.ExpThread):
         self.pb.start()
 
         # Read the first point anyway
-        ctr0_raw = self.ctr0.get_counts(1)
-        ctr1_raw = self.ctr1.get_counts(1)
+        self.ctr0.reset_diff()
+        self.ctr1.reset_diff()
+        self.ctr0.read_diff(1)
+        self.ctr1.read_diff(1)
         ai_read = self.ai.get_voltages(1)
 
         # Delete the first ai reading
@@ -1310,8 +1568,6 @@ class Sweep(ExpThread.ExpThread):
         n_read = 1
         t_update = 0.1
         numpnts1 = len(self.sweeprng1)
-        last_counter0 = ctr0_raw[-1]  # Actual counter value, monotonically counts up, need to be diff
-        last_counter1 = ctr1_raw[-1]  # Actual counter value, monotonically counts up, need to be diff
 
         self.ctr0.set_read_all_samples(True)
         self.ctr1.set_read_all_samples(True)
@@ -1319,17 +1575,14 @@ class Sweep(ExpThread.ExpThread):
 
         while not self.cancel and n_read < len(vlist):
             time.sleep(t_update)
-            # Just try to read the entire array.
-            ctr0_raw = self.ctr0.get_counts(numpnts1)
-            if len(ctr0_raw):
+            # Just try to read the entire array. The counts are differenced against the last count read.
+            ctr0_diff = self.ctr0.read_diff(numpnts1)
+            if len(ctr0_diff):
                 # Read ai for the same amount for synchronized display
-                ctr1_raw = self.ctr1.get_counts(len(ctr0_raw))
-                ai_read = self.ai.get_voltages(len(ctr0_raw))
+                ctr1_diff = self.ctr1.read_diff(len(ctr0_diff))
+                ai_read = self.ai.get_voltages(len(ctr0_diff))
                 n_chan = len(self.ai.dev.split(','))
 
-                ctr0_diff = np.diff(np.append([last_counter0], ctr0_raw))
-                ctr1_diff = np.diff(np.append([last_counter1], ctr1_raw))
-
                 tlb = getattr(self.mainexp, self.tlb_id)
                 ai_read_scaled = ai_read * tlb.scale + tlb.offset
 
@@ -1353,9 +1606,7 @@ class Sweep(ExpThread.ExpThread):
                     for ch in range(n_chan):
                         self.mainexp.esrtrace_ref[ch * numpnts1 + start:ch * numpnts1 + end, yindex] = ai_read_scaled
 
-                n_read += len(ctr0_raw)
-                last_counter0 = ctr0_raw[-1]
-                last_counter1 = ctr1_raw[-1]
+                n_read += len(ctr0_diff)
 
         if hasattr(PyDAQmx.DAQmxFunctions, 'DAQWarning'):
             with warnings.catch_warnings():
@@ -1438,6 +1689,62 @@ class Sweep(ExpThread.ExpThread):
         if not self.cancel:
             self.mainexp.task_handler.setval(var_name, val, log=False)
 
+    def can_pipeline(self, var_name):
+        # Pulse parameters are set without TaskHandler, which refreshes the params table every point. Instruments go
+        # through setval_wrapper: there is nothing to build ahead for them
+        if not self.pipeline or self.isPLE:
+            return False
+        return self.is_param_type(var_name, 'Pulse')
+
+    def setval_pipelined(self, var_name, val, next_val=None):
+        # Set var_name for the current point, then build the pulse program of next_val on the prefetch thread while
+        # this point settles and acquires.
+        if not self.can_pipeline(var_name):
+            self.setval_wrapper(var_name, val)
+            return
+
+        self.dt_stall += self.prefetcher.join()
+        if self.cancel:
+            return
+
+        # same path as TaskHandler.setval: logging, exp_params read back, errors, apart from the params table.
+        # get_esr_data loads the program, which the prefetch thread has already built
+        self.mainexp.exp_params_setval(var_name, val, log=False)
+
+        if self.use_pb and next_val is not None:
+            self.prefetcher.submit(self.prefetch, var_name, next_val)
+
+    def verify_setvals(self):
+        # The instrument getters return the cached value that was set (GPIBdev.cache_set). Read the swept settings
+        # back once per row: a mismatch is logged, and exp_params (and the saved data) take the value read back.
+        for var_name in [self.var1, self.var2] if self.is2D else [self.var1]:
+            if not self.is_param_type(var_name, 'Instrument') or var_name not in self.mainexp.getval:
+                continue
+            getter = self.mainexp.getval[var_name]
+            dev = getattr(getter, '__self__', None)
+            if not hasattr(dev, 'cache_verify'):
+                continue
+            try:
+                for key, setval, readval in dev.cache_verify():
+                    self.log('Warning: %s (%s) read back as %s, but %s was set. The points of this row may be wrong.'
+                             % (var_name, key, str(readval), str(setval)))
+                self.mainexp.exp_params['Instrument'][var_name] = getter()
+            except Exception as e:
+                self.log('Cannot read back %s: %s' % (var_name, str(e)))
+
+    def prefetch(self, var_name, next_val):
+        # Runs on the prefetch thread: builds the program of the next point into the program cache
+        params = dict(self.pb.params)
+        params[var_name] = float(next_val)
+        self.pb.compile_program(params)
+
+    def acq_time(self):
+        # Time the current point spends acquiring data, for the duty cycle
+        if self.use_pb and np.isfinite(self.pb.expected_duration()):
+            return self.pb.expected_duration()
+        else:
+            return self.delay1
+
     def need_to_track(self):
         # Update the track_period and bool_period - this allows changing parameters while scan is running
         track_period = self.mainexp.dbl_tracker_period.value() * 60
@@ -1447,7 +1754,7 @@ class Sweep(ExpThread.ExpThread):
         if track_period > 1:
             track_period = track_period + 10
 
-        return (time.time() - self.lasttracktime > track_period) and bool_period
+        return bool_period and self.mainexp.thread_tracker.tracking_due(self.lasttracktime, track_period)
 
     def track_if_needed(self):
         if self.need_to_track():
@@ -1456,9 +1763,11 @@ class Sweep(ExpThread.ExpThread):
 
             # backup experiment, except at the beginning when it is empty
             if self.mainexp.chkbx_autosave.isChecked() and self.lasttracktime > -1.0:
-                self.save_exp()
+                self.checkpoint_exp()
 
             self.lasttracktime = time.time()
+        else:
+            self.mainexp.thread_tracker.feedforward(self)
 
     def track(self, numtrack=1):
         self.mainexp.thread_tracker.numtrack = numtrack
@@ -1477,6 +1786,7 @@ class Sweep(ExpThread.ExpThread):
             self.cleanup_ple()
 
     def cleanup_esr(self):
+        self.prefetcher.shutdown()
         self.signal_sweep_esr_updateplots_stop.emit()
         self.signal_sweep_esr_updateplots.emit()
         self.wait_for_mainexp()
@@ -1484,8 +1794,26 @@ class Sweep(ExpThread.ExpThread):
         self.mainexp.log('%s finished at %s' % (self.mainexp.label_filename.text(),
                                                 datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
 
+        t_save = time.time()
+        saved = False
         if self.mainexp.chkbx_autosave.isChecked():
-            self.save_exp()
+            try:
+                self.save_exp()
+                saved = True
+            except Exception as e:
+                self.log('Saving failed: %s' % str(e))
+        if self.chunk_store is not None:
+            if self.mainexp.save_queue.isRunning():
+                self.mainexp.save_queue.flush()
+            # the chunks are the only copy of the sweep until its .mat has been written
+            mat = self.chunk_store.path[:-len('.chunks')] + '.mat'
+            if saved and os.path.exists(mat) and os.path.getmtime(mat) >= t_save - 1:
+                mtime = file_utils.catalog_mtime()
+                self.chunk_store.remove()
+                file_utils.catalog_mark_synced(mtime)
+            else:
+                self.log('Sweep backup kept in %s' % self.chunk_store.path)
+            self.chunk_store = None
 
         self.mainexp.set_gui_btn_enable('all', True)
         self.mainexp.set_gui_input_enable('exp', True)
@@ -1504,6 +1832,9 @@ class Sweep(ExpThread.ExpThread):
         self.ctr3.reset()
         self.ctrclk.reset()
         self.ctrtrig.reset()
+        if self.print_row_timings:
+            for ch in [self.ctr0, self.ctr1, self.ctr2, self.ctr3, self.ctrclk, self.ctrtrig]:
+                ch.print_config_stats()
 
         # if one of the sweep variable in a 2d sweep is itr, integrate it (conditioning is done in integrate_esr())
         self.integrate_esr()
@@ -1611,22 +1942,60 @@ class Sweep(ExpThread.ExpThread):
         self.ctrclk.reset()
         self.ctrtrig.reset()
 
-    def save_exp(self, ext=False):
-        time.sleep(0.1)  # fix the issue of the graph not finish updating
+    def save_exp(self, ext=False, screenshots=True):
+        # Backups while the sweep is running skip the screenshots, which are taken again at the end
+        if not screenshots:
+            graph = None
+            fig = None
+        else:
+            time.sleep(0.1)  # fix the issue of the graph not finish updating
 
-        if self.isRunning() and not ext:
-            self.signal_sweep_grab_screenshots.emit()
-            self.wait_for_mainexp()
-            time.sleep(0.1)
-        else:  # For use when save_exp is called from a button
-            self.mainexp.sweep_grab_screenshots()
+            if self.isRunning() and not ext:
+                self.signal_sweep_grab_screenshots.emit()
+                self.wait_for_mainexp()
+                time.sleep(0.1)
+            else:  # For use when save_exp is called from a button
+                self.mainexp.sweep_grab_screenshots()
 
-        graph = self.mainexp.pixmap_sweep_graph
-        fig = self.mainexp.pixmap_sweep_fig
+            graph = self.mainexp.pixmap_sweep_graph
+            fig = self.mainexp.pixmap_sweep_fig
 
         self.mainexp.export_sweep_settings(sweep_var=True)
 
         filename = self.mainexp.label_filename.text()
+        sweep_params = self.get_sweep_params()
+        data_dict = self.get_data_dict()
+
+        self.save_data(filename, data_dict, graph=graph, fig=fig, sweep_params=sweep_params)
+
+    def checkpoint_exp(self):
+        # Backup of a running sweep: write only the rows filled since the last backup into a chunk store next to the
+        # .mat file. save_exp writes the full .mat at the end of the sweep and the chunk store is removed.
+        # Use chunk_store.recover_mat() on the .chunks directory if the sweep never finished.
+        if self.isPLE or self.rows_done is None:
+            self.save_exp(screenshots=False)
+            return
+
+        filename = self.mainexp.label_filename.text()
+        path = os.path.expanduser(os.path.join('~', 'Documents', 'data_mat', filename + '.chunks'))
+
+        if self.chunk_store is None or self.chunk_store.path != path:
+            mtime = file_utils.catalog_mtime()
+            self.chunk_store = chunk_store.ChunkStore(path)
+            sweep_params = self.get_sweep_params()
+            file_utils.dict2yaml(sweep_params, os.path.join(path, '%s.yaml' % filename))
+            msg = file_utils.catalog_add(filename, sweep_params, mtime)  # the wavenum is taken even if the sweep never finishes
+            if msg:
+                self.log(msg)
+
+        for key, val in self.get_data_dict().items():
+            if key in ['xvals', 'yvals', 'wmFreq']:
+                self.chunk_store.write(key, val)
+            else:
+                # rows are the last axis of the 1d/2d traces and the 2nd axis of the newctr traces
+                self.chunk_store.write(key, val, self.rows_done, axis=min(1, np.ndim(val) - 1))
+
+    def get_sweep_params(self):
         exp_name = self.mainexp.cbox_exp_name.currentText()
 
         # Start Building Metadata file
@@ -1680,6 +2049,9 @@ class Sweep(ExpThread.ExpThread):
 
         sweep_params['sample'] = self.mainexp.linein_sample_name.text()
 
+        return sweep_params
+
+    def get_data_dict(self):
         # Start Building Data File
         data_dict = {'pl': self.mainexp.esrtrace_pl}
 
@@ -1703,7 +2075,7 @@ class Sweep(ExpThread.ExpThread):
         if self.mainexp.thread_sweep.is2D:
             data_dict.update({'yvals': self.mainexp.esr_rngy})
 
-        self.save_data(filename, data_dict, graph=graph, fig=fig, sweep_params=sweep_params)
+        return data_dict
 
     def dofit(self, ext=False):
         fitter_name = self.mainexp.cbox_fittype.currentText()
@@ -1757,13 +2129,22 @@ class Sweep(ExpThread.ExpThread):
 
     # Data manipulation
 
+    # The esr_update_* functions tell the plot scheduler which esrtrace_* arrays (and which points or rows of them)
+    # changed, so that the GUI only redraws those.
+
     def esr_update_1d_cw(self, val, index):
         self.mainexp.esrtrace_pl[index] = val
+        self.mainexp.plt_esr_scheduler.mark(['pl'], index, index + 1)
+
+    def esr_update_1d_cw_chunk(self, vals, index):
+        self.mainexp.esrtrace_pl[index:index + len(vals)] = vals
+        self.mainexp.plt_esr_scheduler.mark(['pl'], index, index + len(vals))
 
     def esr_update_1d_pulse(self, sig, ref, pl, index):
         self.mainexp.esrtrace_sig[index] = sig
         self.mainexp.esrtrace_ref[index] = ref
         self.mainexp.esrtrace_pl[index] = pl
+        self.mainexp.plt_esr_scheduler.mark(['sig', 'ref', 'pl'], index, index + 1)
 
     def esr_update_1d_inv2(self, sig, ref, pl, sig2, ref2, pl2, index):
         self.mainexp.esrtrace_sig[index] = sig
@@ -1772,11 +2153,13 @@ class Sweep(ExpThread.ExpThread):
         self.mainexp.esrtrace_sig2[index] = sig2
         self.mainexp.esrtrace_ref2[index] = ref2
         self.mainexp.esrtrace_pl2[index] = pl2
+        self.mainexp.plt_esr_scheduler.mark(['sig', 'ref', 'pl', 'sig2', 'ref2', 'pl2'], index, index + 1)
 
     def esr_update_1d_timetrace(self, total, pl):
         self.mainexp.esrtrace_ref = np.zeros(len(total))
         self.mainexp.esrtrace_sig = total
         self.mainexp.esrtrace_pl = pl
+        self.mainexp.plt_esr_scheduler.mark(['sig', 'ref', 'pl'])
 
     def esr_update_1d_newctr(self, data, index):
         self.mainexp.esrtrace_pl[index] = data[1]
@@ -1790,14 +2173,18 @@ class Sweep(ExpThread.ExpThread):
         else:
             for i in range(numctr):
                 self.mainexp.esrtrace_newctr[i][index][:] = data[0][i][:]
+        self.mainexp.plt_esr_scheduler.mark(['pl'], index, index + 1)
+        self.mainexp.plt_esr_scheduler.mark(['newctr'])
 
     def esr_update_2d_cw(self, val, x, y):
         self.mainexp.esrtrace_pl[x][y] = val
+        self.mainexp.plt_esr_scheduler.mark(['pl'], y, y + 1)
 
     def esr_update_2d_pulse(self, sig, ref, pl, x, y):
         self.mainexp.esrtrace_sig[x][y] = sig
         self.mainexp.esrtrace_ref[x][y] = ref
         self.mainexp.esrtrace_pl[x][y] = pl
+        self.mainexp.plt_esr_scheduler.mark(['sig', 'ref', 'pl'], y, y + 1)
 
     def esr_update_2d_inv2(self, sig, ref, pl, sig2, ref2, pl2, x, y):
         self.mainexp.esrtrace_sig[x][y] = sig
@@ -1806,11 +2193,13 @@ class Sweep(ExpThread.ExpThread):
         self.mainexp.esrtrace_sig2[x][y] = sig2
         self.mainexp.esrtrace_ref2[x][y] = ref2
         self.mainexp.esrtrace_pl2[x][y] = pl2
+        self.mainexp.plt_esr_scheduler.mark(['sig', 'ref', 'pl', 'sig2', 'ref2', 'pl2'], y, y + 1)
 
     def esr_update_2d_timetrace(self, total, pl, index):
         for i in range(len(pl)):
             self.mainexp.esrtrace_pl[i][index] = pl[i]
             self.mainexp.esrtrace_sig[i][index] = total[i]
+        self.mainexp.plt_esr_scheduler.mark(['sig', 'pl'], index, index + 1)
 
     def ple_update_1d(self, pl, ref, index):
         self.mainexp.esrtrace_pl[index] = pl
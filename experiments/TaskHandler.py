@@ -56,7 +56,8 @@ class TaskHandler(ExpThread.ExpThread):
 
             time.sleep(0.1)
 
-    def confocal(self, *args, avg=1):
+    def confocal(self, *args, avg=1, pattern=None):
+        # pattern: trajectory of this scan (see Confocal.scan_pattern), e.g. 'nvlist' to only scan around the NVs
         if not self.cancel:
             if len(args):
                 if len(args) == 7:
@@ -71,9 +72,14 @@ class TaskHandler(ExpThread.ExpThread):
                 else:
                     raise Exception('expect 6 arguments: x1, x2, sizeX, y1, y2, sizeY, acqtime')
 
+            prev_pattern = self.mainexp.thread_confocal.scan_pattern
+            if pattern is not None:
+                self.mainexp.thread_confocal.scan_pattern = pattern
+
             self.mainexp.tab_main.setCurrentIndex(0)  # set to confocal
             self.mainexp.confocal_start()
             self.mainexp.thread_confocal.wait()
+            self.mainexp.thread_confocal.scan_pattern = prev_pattern
 
             time.sleep(0.1)
 
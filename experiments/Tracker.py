@@ -1,9 +1,11 @@
 from PyQt5.QtCore import pyqtSignal
 import fitters
+import scan_patterns
 import numpy as np
-import time, PyDAQmx
+import time, PyDAQmx, os, struct
 from . import ExpThread
 import datetime
+import drift_model
 
 class Tracker(ExpThread.ExpThread):
 
@@ -12,6 +14,7 @@ class Tracker(ExpThread.ExpThread):
     signal_tracker_updateplot_freq = pyqtSignal(str)
     signal_tracker_updatelog = pyqtSignal(float, float)
     signal_tracker_updatecursor = pyqtSignal()
+    signal_tracker_feedforward = pyqtSignal(float, float, float)
 
     def __init__(self, mainexp):  # Tracker does not need wait_condition
         super().__init__(mainexp)
@@ -23,6 +26,40 @@ class Tracker(ExpThread.ExpThread):
 
         self.fitter = fitters.fit_tracker()
         self.fitter_z = fitters.fit_tracker_z()
+        self.fitter_2d = fitters.fit_tracker_2d()
+        self.fitter_3d = fitters.fit_tracker_3d()
+
+        # 'sequential': line scans in x, y, then z. 'xy': one xy grid scan with a 2D Gaussian fit, then z.
+        # 'xyz': the xy grid at track_z_planes z planes in a single scan with a 3D Gaussian fit
+        self.track_mode = 'sequential'
+        self.track_grid_numdivs = 8  # grid of the xy(z) scans, in both x and y
+        self.track_z_planes = 3
+        self.track_z_transit = 0.05  # s, to move the z piezo between planes within the trajectory
+
+        # 'curve_fit', or a closed-form estimate ('logparabola' or 'centroid', see fitters.fit_tracker.quickfit) with
+        # curve_fit only when the estimate fails its quality checks
+        self.fit_mode = 'logparabola'
+        self.fit_seeds = {}  # nvnum -> {direction: fit parameters of the last track}, to seed the next fit
+        # fits, curve_fit fallbacks and fit time (s) per direction, and of the xy(z) grid fits
+        self.fit_stats = [[0, 0, 0.0] for _ in range(4)]
+        self.print_fit_timings = False
+        self.fit_widths = np.full(3, np.nan)  # widths of the last successful fits, for the drift model
+
+        # Drift model learned from the tracks (see drift_model), warm started from today's tracker log.
+        # drift_adaptive: sweeps only track when the predicted PL loss exceeds drift_max_loss, or after
+        # drift_max_factor tracker periods. drift_feedforward: move to the predicted position between tracks
+        self.drift = drift_model.DriftModel()
+        self.drift_adaptive = False
+        self.drift_max_loss = 0.05
+        self.drift_max_factor = 4
+        self.drift_feedforward = False
+        self.drift_ff_step = 0.02  # um, smallest feed-forward move
+        log_file = os.path.join(os.path.expanduser(os.path.join('~', 'Documents', 'exp_log')),
+                                datetime.datetime.now().strftime('%Y-%m-%d.log'))
+        try:
+            self.drift.load_log(log_file)
+        except (OSError, struct.error) as e:
+            print('Could not read the tracker log %s: %s' % (log_file, e))
 
         self.numtrack = 1  # number of times to track on a spot
         self.logdata = True  # record to the history the position, laser power, PL (only record at the end of multiple tracks)
@@ -39,10 +76,16 @@ class Tracker(ExpThread.ExpThread):
 
         self.tracker_finished_func = None  # Function(s) to be executed after tracking (to resume something)
 
+        # (time, x, y, z) of every successful z track in this session, used to fit the autoZ focal surface
+        # (see Confocal.plane_fit)
+        self.focus_points = []
+        self.fit_ok = False  # whether the last track_pos fit found the peak inside of the range
+
         self.signal_tracker_updateplot.connect(mainexp.tracker_updateplot)
         self.signal_tracker_updateplot_freq.connect(mainexp.tracker_updateplot_freq)
         self.signal_tracker_updatelog.connect(mainexp.tracker_updatelog)
         self.signal_tracker_updatecursor.connect(mainexp.map_updatecursor)
+        self.signal_tracker_feedforward.connect(mainexp.tracker_feedforward)
 
     def update_mainexp(self):
         mainexp = self.mainexp
@@ -70,32 +113,47 @@ class Tracker(ExpThread.ExpThread):
         # one more point added at end because we do np.diff which reduces vector size by 1
         scanrng = np.append(scanrng, scanrng[-1])
 
-        # reset the counters and ao
-        self.galpie.reset()
-        self.ctrapd.reset()
-        self.ctrclk.reset()
-        self.ctrtrig.reset()
-
         if direction == 2:
-            self.galpie.set_position(2, scanrng[0])
+            self.galpie.set_position(2, scanrng[0])  # resets galpie if it is set up for a sweep
             time.sleep(self.piezo_delay)
 
+        n = len(scanrng)
+        self.setup_scan(n)
+        # sweep this direction over scanrng
+        self.galpie.set_positions(direction, scanrng)
+        ctr_read = self.acquire_scan(n)
+
+        # output the tracker counters in the unit of kcps
+        return [scanrng[0:-1], (ctr_read/1000)]
+
+    def setup_scan(self, n):
+        # Hardware-timed scan of n clock ticks for sweep_pos and sweep_pattern. The tasks are the same for every
+        # direction and every tracking run, so they are pooled (see DAQmxChannel.use_config) instead of being reset
+        # and configured again each time. Write the positions to galpie afterwards, then call acquire_scan(n)
+        clk = self.mainexp.inst_params['instruments']['ctrclk']['addr_out']
+        trig = self.mainexp.inst_params['instruments']['ctrtrig']['addr_out']
+        src = self.mainexp.inst_params['instruments']['ctrapd']['addr_src']
+
         # set up the swept voltage analog channel
-        self.galpie.set_sample_clock(self.mainexp.inst_params['instruments']['ctrclk']['addr_out'],
-                                     PyDAQmx.DAQmx_Val_Rising, len(scanrng))
-        self.galpie.set_start_trigger(self.mainexp.inst_params['instruments']['ctrtrig']['addr_out'],
-                                      PyDAQmx.DAQmx_Val_Rising)
+        def configure_galpie(ch):
+            ch.set_sample_clock(clk, PyDAQmx.DAQmx_Val_Rising, n)
+            ch.set_start_trigger(trig, PyDAQmx.DAQmx_Val_Rising)
+        self.galpie.use_config(('tracker', clk, trig, n), configure_galpie)
 
         # setup the counters to acquire and gate properly
-        self.mainexp.ctrapd.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
-        self.ctrapd.set_sample_clock(self.mainexp.inst_params['instruments']['ctrclk']['addr_out'],
-                              PyDAQmx.DAQmx_Val_Rising, len(scanrng))
-        self.ctrapd.set_arm_start_trigger(self.mainexp.inst_params['instruments']['ctrtrig']['addr_out'],
-                                   PyDAQmx.DAQmx_Val_Rising)
-        self.ctrclk.set_freq(1 / self.tracker_acqtime)
-
-        # sweep this direction over scanrng
-        self.galpie.set_positions(direction, scanrng)
+        def configure_ctrapd(ch):
+            ch.set_source(src)
+            ch.set_sample_clock(clk, PyDAQmx.DAQmx_Val_Rising, n)
+            ch.set_arm_start_trigger(trig, PyDAQmx.DAQmx_Val_Rising)
+        self.ctrapd.use_config(('tracker', src, clk, trig, n), configure_ctrapd)
+
+        def configure_ctrclk(ch):
+            ch.set_freq(1 / self.tracker_acqtime)
+        self.ctrclk.use_config(('freq', 1 / self.tracker_acqtime), configure_ctrclk)
+        self.ctrtrig.set_time(self.ctrtrig.trigtime)
+
+    def acquire_scan(self, n):
+        # run the scan set up by setup_scan(n), returns the count rates (cps) of the n - 1 samples
         self.galpie.start()
 
         # start the counters, and measure
@@ -105,7 +163,7 @@ class Tracker(ExpThread.ExpThread):
         self.ctrtrig.wait_until_done()
         self.ctrtrig.stop()
 
-        ctr_raw = self.ctrapd.get_counts(len(scanrng))
+        ctr_raw = self.ctrapd.get_counts(n)
         # continually incrementing counter, so np.diff (which reduces size by 1)
         ctr_read = np.diff(ctr_raw) / self.tracker_acqtime
 
@@ -114,16 +172,195 @@ class Tracker(ExpThread.ExpThread):
         self.galpie.stop()
         self.ctrclk.stop()
         self.ctrapd.stop()
+        return ctr_read
 
-        # output the tracker counters in the unit of kcps
-        return [scanrng[0:-1], (ctr_read/1000)]
+    def fit_peak(self, direction, xvals, data):
+        # Fit the tracker Gaussian, seeded by the last track of the same NV. Raises RuntimeError if curve_fit fails
+        seed = self.fit_seeds.get(self.mainexp.exp_params['Confocal']['nvnum'], {}).get(direction)
+        stats = self.fit_stats[direction]
+        t0 = time.perf_counter()
+        try:
+            if self.fit_mode != 'curve_fit':
+                self.fitter.set_data(data, xvals=xvals)
+                try:
+                    return self.fitter.quickfit(self.fit_mode, sigma_ref=None if seed is None else abs(seed[2]))
+                except RuntimeError:
+                    stats[1] += 1
+
+            self.fitter.set_data(data, xvals=xvals)
+            if seed is not None:
+                self.fitter.set_guess(list(seed))
+            else:
+                self.fitter.extguess = False
+            return self.fitter.dofit()
+        finally:
+            self.fitter.extguess = False  # the fitter is shared with track_tlb and track_wavemeter
+            stats[0] += 1
+            stats[2] += time.perf_counter() - t0
+
+    def fit_grid(self, fitter, grid, data):
+        # Like fit_peak for the xy(z) grid scans, with fitter_2d or fitter_3d. Raises RuntimeError if curve_fit fails
+        seed = self.fit_seeds.get(self.mainexp.exp_params['Confocal']['nvnum'], {}).get('grid%d' % grid.shape[0])
+        stats = self.fit_stats[3]
+        t0 = time.perf_counter()
+        try:
+            if self.fit_mode != 'curve_fit':
+                fitter.set_data(data, xvals=grid)
+                try:
+                    return fitter.quickfit(self.fit_mode,
+                                           sigma_ref=None if seed is None else np.abs(seed[1 + grid.shape[0]:-1]))
+                except RuntimeError:
+                    stats[1] += 1
+
+            fitter.set_data(data, xvals=grid)
+            if seed is not None:
+                fitter.set_guess(list(seed))
+            else:
+                fitter.extguess = False
+            return fitter.dofit()
+        finally:
+            fitter.extguess = False
+            stats[0] += 1
+            stats[2] += time.perf_counter() - t0
+
+    def fit_stats_text(self):
+        text = []
+        for name, (n, fallbacks, dt) in zip(['x', 'y', 'z', 'grid'], self.fit_stats):
+            if n:
+                text.append('%s: %d fits, %.2f ms each, %.0f%% curve_fit' % (name, n, dt / n * 1e3,
+                                                                            fallbacks / n * 100))
+        return '; '.join(text)
+
+    def grid_pattern(self, ndim):
+        '''Trajectory of the xy(z) tracking scan around tracker_pos: a meander over the xy grid, at one z or at
+        track_z_planes z planes (alternating directions, moving up in z like the z line scan).
+        Returns pos (3, n), the grid pixel of every sample (-1 for the z transits) and the grid positions of the pixels
+        (ndim, npix).'''
+        nxy = self.track_grid_numdivs + 1
+        axes = [np.linspace(self.tracker_pos[d] - self.tracker_rng[d], self.tracker_pos[d] + self.tracker_rng[d],
+                            nxy if d < 2 else self.track_z_planes) for d in range(ndim)]
+        zvals = axes[2] if ndim == 3 else [self.tracker_pos[2]]
+        transit = max(int(round(self.track_z_transit / self.tracker_acqtime)), 1)
+
+        pos = []
+        pixel = []
+        plane = scan_patterns.meander(axes[0], axes[1], 0.0)
+        for k, z in enumerate(zvals):
+            p = plane if k % 2 == 0 else plane.reversed()
+            ppos = p.pos.copy()
+            ppos[2] = z
+            if pos:
+                pos.append(scan_patterns.linear_path(pos[-1][:, -1], ppos[:, 0], transit))
+                pixel.append(np.full(transit, -1, dtype=np.int64))
+            pos.append(ppos)
+            pixel.append(np.where(p.pixel >= 0, p.pixel + k * nxy * nxy, -1))
+
+        # pixel k * nxy * nxy + ix * nxy + iy
+        zz, xx, yy = np.meshgrid(zvals, axes[0], axes[1], indexing='ij')
+        grid = np.array([xx.reshape(-1), yy.reshape(-1), zz.reshape(-1)])[:ndim]
+        return np.hstack(pos), np.concatenate(pixel), grid, axes
+
+    def sweep_pattern(self, pos, pixel, npix):
+        # one hardware-timed scan of the trajectory pos, returns the PL (kcps) of each of the npix pixels
+        traj = np.hstack([pos, pos[:, -1:]])  # park at the end while the last sample is counted
+        n = traj.shape[1]
+        self.setup_scan(n)
+        self.galpie.set_trajectory(traj)
+        ctr_read = self.acquire_scan(n)
+
+        valid = pixel >= 0
+        sums = np.bincount(pixel[valid], weights=ctr_read[valid], minlength=npix)
+        hits = np.bincount(pixel[valid], minlength=npix)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(hits > 0, sums / hits, np.nan) / 1000
+
+    def track_grid(self, found):
+        '''Track x, y (and z) with one grid scan and a 2D (3D) Gaussian fit, see track_mode.
+        Updates found and the tracker plots (cuts through the new center) and returns the directions that are left to
+        track with line scans.'''
+        ndim = 3 if self.track_mode == 'xyz' and self.tracker_rng[2] > 0.001 else 2
+        pos, pixel, grid, axes = self.grid_pattern(ndim)
+
+        if ndim == 3:
+            self.galpie.set_position(2, pos[2, 0])  # start at the bottom like the z line scan
+            time.sleep(self.piezo_delay)
+        data = self.sweep_pattern(pos, pixel, grid.shape[1])
+
+        fitter = self.fitter_3d if ndim == 3 else self.fitter_2d
+        newpos = np.array(self.tracker_pos[:ndim], dtype=float)
+        try:
+            fp = self.fit_grid(fitter, grid, data)
+            center = fitter.get_peakcenter()
+            tol = 1.5  # how far out of scanning range the optimal point can be
+            fit_ok = all(abs(center[d] - self.tracker_pos[d]) <= self.tracker_rng[d] * tol for d in range(ndim))
+            if fit_ok:
+                newpos = np.round(center * 1000.0) / 1000.0
+                self.fit_widths[:ndim] = np.abs(fitter.get_peakwidth())
+                self.fit_seeds.setdefault(self.mainexp.exp_params['Confocal']['nvnum'], {})['grid%d' % ndim] = fp
+        except RuntimeError:
+            fit_ok = False
+        self.fit_ok = fit_ok
+
+        self.galpie.set_position([0, 1], list(newpos[:2]))
+        if ndim == 3:
+            self.set_pos(2, newpos[2])
+
+        dir_name = ['xpos', 'ypos', 'zpos']
+        # data is in (z, x, y) order
+        cube = data.reshape(-1, len(axes[0]), len(axes[1])).transpose(1, 2, 0)
+        for direction in range(ndim):
+            # the line through the grid point nearest to the new center, and the fit along it
+            index = [np.argmin(np.abs(axes[d] - newpos[d])) for d in range(ndim)] + [0] * (3 - ndim)
+            index[direction] = slice(None)
+            line = np.tile(newpos[:, None], (1, len(axes[direction])))
+            line[direction] = axes[direction]
+
+            self.mainexp.trace_tracker_xvals[direction] = axes[direction]
+            self.mainexp.trace_tracker_yvals[direction] = np.array(cube[tuple(index)])
+            self.mainexp.trace_tracker_yfit[direction] = fitter.model(line, *fitter.fp) if fit_ok else \
+                np.ones(len(axes[direction])) * np.nanmean(data)
+            getattr(self.mainexp, 'dbl_tracker_%s' % dir_name[direction]).setValue(newpos[direction])
+            self.mainexp.exp_params['Confocal'][dir_name[direction]] = float(newpos[direction])
+            found[direction] = newpos[direction]
+            self.signal_tracker_updateplot.emit(direction)
+
+        if ndim == 3 and fit_ok:
+            self.focus_points.append((time.time(), found[0], found[1], found[2]))
+        return [2] if ndim == 2 else []
+
+    def tracking_due(self, lasttracktime, track_period):
+        '''Whether a sweep that tracks every track_period s should track now. With drift_adaptive, it only tracks
+        when the drift model predicts more than drift_max_loss of the PL to be lost, or after drift_max_factor
+        periods.'''
+        now = time.time()
+        if not self.drift_adaptive or not self.drift.ready() or track_period <= 1:
+            return now - lasttracktime > track_period
+        if now - lasttracktime > track_period * self.drift_max_factor:
+            return True
+        return self.drift.pl_loss(now, self.mainexp.exp_params['Confocal']['nvnum']) > self.drift_max_loss
+
+    def feedforward(self, thread):
+        # Between tracks: follow the drift predicted by the drift model. Called from the experiment thread, which
+        # waits for the GUI thread to move (mainexp.tracker_feedforward).
+        if not self.drift_feedforward or not self.drift.ready():
+            return
+        pos = self.drift.predict(time.time(), self.mainexp.exp_params['Confocal']['nvnum'])
+        if pos is None:
+            return
+
+        current = np.array([self.mainexp.exp_params['Confocal'][name] for name in ['xpos', 'ypos', 'zpos']])
+        if np.max(np.abs(pos - current)) < self.drift_ff_step:
+            return
+
+        pos = np.round(pos * 1000.0) / 1000.0
+        self.signal_tracker_feedforward.emit(pos[0], pos[1], pos[2])
+        thread.wait_for_mainexp()
 
     def track_pos(self, direction):
         [xvals, data] = self.sweep_pos(direction)
 
         try:
-            self.fitter.set_data(data, xvals=xvals)
-            fp = self.fitter.dofit()
+            fp = self.fit_peak(direction, xvals, data)
             fitdata = self.fitter.get_fitcurve()
             peakcenter = fp[1]
             peakwidth = np.abs(fp[2])
@@ -137,12 +374,17 @@ class Tracker(ExpThread.ExpThread):
                 # print('Optimal Point outside of %f times the range' % tol)
                 # print('Setting to mid range')
                 newpos = np.mean(xvals)
+                self.fit_ok = False
             else:
                 newpos = peakcenter
+                self.fit_ok = True
+                self.fit_widths[direction] = abs(fp[2])
+                self.fit_seeds.setdefault(self.mainexp.exp_params['Confocal']['nvnum'], {})[direction] = fp
         except RuntimeError:
             # When the least-squares minimization fails.
             # print('optimal parameters not found, setting to mid range')
             newpos = self.tracker_pos[direction]
+            self.fit_ok = False
             fitdata = np.ones(self.tracker_numdivs + 1) * np.mean(data)
 
         save_to_file = True
@@ -236,16 +478,18 @@ class Tracker(ExpThread.ExpThread):
 
     def get_pl(self):
         if self.tracker_pltime > 0.001:
-            # Reset the counter back to single shot mode
-            self.ctrapd.reset()
-            self.ctrapd.set_source(self.mainexp.inst_params['instruments']['ctrapd']['addr_src'])
+            # Switch the counter back to single shot mode
+            src = self.mainexp.inst_params['instruments']['ctrapd']['addr_src']
+            gate = self.mainexp.inst_params['instruments']['ctrtrig']['addr_out']
+
+            def configure(ch):
+                ch.set_source(src)
+                ch.set_pause_trigger(gate)
+            self.ctrapd.use_config(('gated', src, gate), configure)
             self.ctrclk.reset()
-            self.ctrtrig.reset()
-
-            self.ctrapd.set_pause_trigger(self.mainexp.inst_params['instruments']['ctrtrig']['addr_out'])
+            self.ctrtrig.set_time(self.tracker_pltime)
 
             self.ctrapd.start()
-            self.ctrtrig.set_time(self.tracker_pltime)
             self.ctrtrig.start()
             self.ctrtrig.wait_until_done()
             self.ctrtrig.stop()
@@ -431,16 +675,27 @@ class Tracker(ExpThread.ExpThread):
 
     def run(self):
         self.update_mainexp()
+        self.fit_widths[:] = np.nan
 
         self.run_script('tracker_init.py')
 
         dir_name = ['xpos', 'ypos', 'zpos']
+        found = list(self.tracker_pos)
+        found_ok = [False] * 3
 
         for _ in range(self.numtrack):
             self.galpie.set_position([0, 1, 2], self.tracker_pos)
             time.sleep(self.piezo_delay)
+            found = list(self.tracker_pos)
+            found_ok = [False] * 3  # the fits that found the peak, only those tracks teach the drift model
+
+            directions = range(3)
+            if self.track_mode != 'sequential' and min(self.tracker_rng[:2]) > 0.001:
+                directions = self.track_grid(found)
+                for direction in range(3):
+                    found_ok[direction] = direction not in directions and self.fit_ok
 
-            for direction in range(3):
+            for direction in directions:
                 if self.tracker_rng[direction] > 0.001:  # if the range is  nonzero
                     [xvals, data, fitdata, pos] = self.track_pos(direction)
                     self.set_pos(direction, pos)
@@ -450,6 +705,11 @@ class Tracker(ExpThread.ExpThread):
                     self.mainexp.trace_tracker_yfit[direction] = np.array(fitdata)
                     getattr(self.mainexp, 'dbl_tracker_%s' % dir_name[direction]).setValue(pos)
                     self.mainexp.exp_params['Confocal'][dir_name[direction]] = float(pos)
+                    found[direction] = pos
+                    found_ok[direction] = self.fit_ok
+
+                    if direction == 2 and self.fit_ok:
+                        self.focus_points.append((time.time(), found[0], found[1], pos))
                 else:  # spit out empty arrays to plot to make it obvious that it's not tracking
                     numpnts = self.tracker_numdivs + 1
                     self.mainexp.trace_tracker_xvals[direction] = np.empty(numpnts)*np.NaN
@@ -496,6 +756,7 @@ class Tracker(ExpThread.ExpThread):
 
             self.signal_tracker_updateplot_freq.emit('ctlfreq')
 
+        pl = None
         if self.logdata:
             pl = self.get_pl()
             try:
@@ -506,8 +767,15 @@ class Tracker(ExpThread.ExpThread):
         else:
             self.logdata = True
 
+        if min(self.tracker_rng) > 0.001 and all(found_ok):
+            self.drift.update(time.time(), self.mainexp.exp_params['Confocal']['nvnum'], found, width=self.fit_widths,
+                              pl=pl)
+
         self.signal_tracker_updatecursor.emit()
 
+        if self.print_fit_timings:
+            print(self.fit_stats_text())
+
         self.numtrack = 1
 
         self.mainexp.ctrapd.reset()
@@ -8,4 +8,5 @@ from . import Batch
 from . import Terminal
 from . import APD
 from . import PicoHarp
-from . import SatCurve
\ No newline at end of file
+from . import SatCurve
+from . import SaveQueue
\ No newline at end of file
@@ -1,6 +1,10 @@
-import os, yaml, scipy.io, pickle, csv
+import os, yaml, scipy.io, pickle, csv, sqlite3
 from PyQt5 import QtGui
 
+import data_catalog
+
+catalog = None  # data_catalog.DataCatalog of ~/Documents/data_mat, see get_catalog()
+
 
 def dict2yaml(expt_dict, filename='exp_params.yaml'):
     with open(filename, 'w') as outfile:
@@ -28,42 +32,107 @@ def save_data(filename, data, graph=None, fig=None, sweep_params=None, remotedir
     else:
         saveremote = False
 
-    if True:
-        scipy.io.savemat(os.path.expanduser(os.path.join('~', 'Documents', 'data_mat', filename+'.mat')), mdict=data)
-        if saveremote:
-            scipy.io.savemat(os.path.expanduser(os.path.join(remotedir, 'data_mat', filename + '.mat')),
-                             mdict=data)
-    if graph is not None:
-        graph.save(os.path.expanduser(os.path.join('~', 'Documents', 'graphs_mat', '%s.png' % filename)), 'png')
-        if saveremote:
-            graph.save(os.path.expanduser(os.path.join(remotedir, 'graphs_mat', '%s.png' % filename)), 'png')
+    mtime = catalog_mtime()
+    save_files(os.path.join('~', 'Documents'), filename, data, graph=graph, fig=fig, sweep_params=sweep_params)
+    catalog_add(filename, sweep_params, mtime)
+    if saveremote:
+        save_files(remotedir, filename, data, graph=graph, fig=fig, sweep_params=sweep_params)
+
+    # if tracker_tab is not None:
+    #     tracker_tab.save(os.path.expanduser(os.path.join('~', 'Documents', 'figs_mat', '%s.png' % filename)), 'png')
 
+
+def save_files(rootdir, filename, data, graph=None, fig=None, sweep_params=None):
+    '''write the .mat, graph and fig .png and .yaml of filename into the data_mat, graphs_mat and figs_mat folders of
+    rootdir. graph and fig can be QPixmap or QImage'''
+    rootdir = os.path.expanduser(rootdir)
+
+    if data is not None:
+        scipy.io.savemat(os.path.join(rootdir, 'data_mat', filename + '.mat'), mdict=data)
+    if graph is not None:
+        graph.save(os.path.join(rootdir, 'graphs_mat', '%s.png' % filename), 'png')
     if fig is not None:
-        fig.save(os.path.expanduser(os.path.join('~', 'Documents', 'figs_mat', '%s.png' % filename)), 'png')
-        if saveremote:
-            fig.save(os.path.expanduser(os.path.join(remotedir, 'figs_mat', '%s.png' % filename)), 'png')
+        fig.save(os.path.join(rootdir, 'figs_mat', '%s.png' % filename), 'png')
     if sweep_params is not None:
-        dict2yaml(sweep_params, os.path.expanduser(os.path.join('~', 'Documents', 'data_mat', '%s.yaml' % filename)))
-        if saveremote:
-            dict2yaml(sweep_params,
-                      os.path.expanduser(os.path.join(remotedir, 'data_mat', '%s.yaml' % filename)))
+        dict2yaml(sweep_params, os.path.join(rootdir, 'data_mat', '%s.yaml' % filename))
 
-    # if tracker_tab is not None:
-    #     tracker_tab.save(os.path.expanduser(os.path.join('~', 'Documents', 'figs_mat', '%s.png' % filename)), 'png')
 
 def savemat(path, data):
     scipy.io.savemat(path, mdict=data)
 
 
+def get_catalog():
+    global catalog
+    if catalog is None:
+        catalog = data_catalog.DataCatalog()
+    return catalog
+
+
+def catalog_mtime():
+    # modification time of data_mat, to take before writing to it for catalog_add and catalog_mark_synced
+    try:
+        return get_catalog().dir_mtime()
+    except (sqlite3.Error, OSError):
+        return None
+
+
+def catalog_add(filename, sweep_params=None, mtime_before=None):
+    # Record a file saved locally in the catalog. Saving must not fail because of the catalog: returns the error
+    # message for the caller to log, '' if the file was added.
+    try:
+        get_catalog().add(filename, sweep_params, mtime_before=mtime_before)
+    except (sqlite3.Error, OSError) as e:
+        msg = 'Could not add %s to the data catalog: %s' % (filename, str(e))
+        print(msg)
+        return msg
+    return ''
+
+
+def catalog_mark_synced(mtime_before):
+    try:
+        get_catalog().mark_synced(mtime_before)
+    except (sqlite3.Error, OSError) as e:
+        print('Could not update the data catalog: %s' % str(e))
+
+
+def latest_data(exptype=None):
+    # Newest .mat of exptype (e.g. 'PLxpos' for confocal maps) to preselect in file dialogs, else the data_mat folder
+    try:
+        path = get_catalog().latest(exptype)
+    except (sqlite3.Error, OSError):
+        path = None
+    if path is None or not os.path.exists(path):
+        return os.path.expanduser(os.path.join('~', 'Documents', 'data_mat'))
+    return path
+
+
 def getwavenum():
+    try:
+        cat = get_catalog()
+        cat.sync()
+        wavenum = cat.max_wavenum()
+        if cat.is_taken(wavenum + 1):
+            # written without updating the catalog and not noticed by sync(), never reuse it
+            print('Data catalog is out of date. Scanning data_mat.')
+            cat.sync(force=True)
+            wavenum = cat.max_wavenum()
+        return wavenum
+    except (sqlite3.Error, OSError) as e:
+        print('Data catalog is not available (%s). Scanning data_mat instead.' % str(e))
+        return scan_wavenum()
+
+
+def scan_wavenum():
     eppath = os.path.expanduser(os.path.join('~', 'Documents', 'data_mat'))
     # filelist = [f for f in os.listdir(eppath) if os.path.isfile(os.path.join(eppath, f))]
     filelist = [f for f in os.listdir(eppath)] # to speed up
     numlist = []
     for f in filelist:
-        if '.mat' in f:
-            filename = f.split('.mat')[0]
-            numlist.extend([int(s) for s in filename.split('_') if s.isdigit()])
+        # .chunks are the backups of sweeps that have not been exported to .mat yet
+        for ext in ['.mat', '.chunks']:
+            if ext in f:
+                filename = f.split(ext)[0]
+                numlist.extend([int(s) for s in filename.split('_') if s.isdigit()])
 
     if not numlist:
         return 0
@@ -2,7 +2,7 @@ from scipy.optimize import curve_fit
 import numpy as np
 import inspect
 from scipy.stats import chi2
-from scipy.special import wofz
+from scipy.special import wofz, erf
 
 
 class Fitter:
@@ -119,6 +119,32 @@ class GenericFit:
 
         return self.fp
 
+    def fit_amplitude(self, x, y, shape_params, max_chisq=2.0):
+        '''
+        Last step of the closed-form estimates (quickfit) of model(x, amp, *shape_params, offset) with a squared
+        amplitude: with the shape fixed (e.g. center and width), amplitude and offset are a linear least-squares fit to
+        all points. Raises RuntimeError (like a failed dofit) if there is no peak, or if the residuals are more than
+        max_chisq times the noise of the data (estimated from the point to point differences). Sets and returns fp.
+        '''
+        shape = self.model(x, 1.0, *shape_params, 0.0)
+        amp, offset = np.linalg.lstsq(np.column_stack([shape, np.ones_like(y)]), y, rcond=None)[0]
+        if amp <= 0:
+            raise RuntimeError('quickfit: no peak')
+
+        fp = np.concatenate([[np.sqrt(amp)], shape_params, [offset]])
+        # shot noise: the variance is proportional to the PL, scaled to the noise of the typical point
+        fitcurve = self.model(x, *fp)
+        noise = (1.4826 * np.median(np.abs(np.diff(y) - np.median(np.diff(y))))) ** 2 / 2
+        var = noise * np.clip(fitcurve / np.median(y), 1, None) if np.median(y) > 0 else noise
+        chisq = np.sum((y - fitcurve) ** 2 / np.maximum(var, 1e-12)) / (len(y) - len(fp))
+        if chisq > max_chisq:
+            raise RuntimeError('quickfit: reduced chi^2 = %.2f' % chisq)
+
+        self.fp = fp
+        self.cov = np.array([])
+        self.err = np.full(len(fp), np.nan)
+        return self.fp
+
     def set_guess(self, guess):
         # if the user feels intelligent, give option
         # to set initial guess outside the function
@@ -262,6 +288,60 @@ class fit_tracker(GenericFit):
         self.guess = [amplitude, peakcenter, sigma, mean]
         return self.guess
 
+    def quickfit(self, method='logparabola', frac=0.3, max_chisq=2.0, sigma_ref=None):
+        '''
+        Closed-form estimate of the Gaussian, without curve_fit:
+        'logparabola': weighted least-squares parabola through the log of the background subtracted peak
+        'centroid': weighted centroid and second moment of the background subtracted peak
+        Only the points above frac of the peak are used. Raises RuntimeError (like a failed dofit) when the estimate
+        fails the quality checks: center inside of the scan, width between half a step and the scan range (and
+        within a factor of 2 of sigma_ref, e.g. the width of the last track), and residuals of the fit curve at most
+        max_chisq times the noise of the data (estimated from the point to point differences).
+        '''
+        finite = np.isfinite(self.data)
+        x = np.asarray(self.xvals, dtype=float)[finite]
+        y = np.asarray(self.data, dtype=float)[finite]
+        if len(y) < 5:
+            raise RuntimeError('quickfit: not enough points')
+
+        offset = np.percentile(y, 10)
+        yb = y - offset
+        i0 = np.argmax(yb)
+        peak = yb[i0]
+        if peak <= 0:
+            raise RuntimeError('quickfit: no peak')
+
+        # contiguous points around the maximum that are above frac of the peak
+        above = yb > frac * peak
+        lo = i0 - np.argmin(above[i0::-1]) + 1 if not np.all(above[:i0 + 1]) else 0
+        hi = i0 + np.argmin(above[i0:]) if not np.all(above[i0:]) else len(y)
+        if hi - lo < 3:
+            raise RuntimeError('quickfit: peak is too narrow')
+        xr, yr = x[lo:hi], yb[lo:hi]
+
+        if method == 'centroid':
+            x0 = np.sum(yr * xr) / np.sum(yr)
+            var = np.sum(yr * (xr - x0) ** 2) / np.sum(yr)
+            # the second moment of a Gaussian cut at frac of its peak is smaller than sigma^2
+            k = np.sqrt(2 * np.log(1 / frac))
+            ratio = 1 - 2 * k * np.exp(-k ** 2 / 2) / np.sqrt(2 * np.pi) / erf(k / np.sqrt(2))
+            sigma = np.sqrt(var / ratio)
+        else:
+            # Poisson noise: the error of log(y) is ~ 1/sqrt(y)
+            c2, c1, c0 = np.polyfit(xr, np.log(yr), 2, w=np.sqrt(yr))
+            if c2 >= 0:
+                raise RuntimeError('quickfit: no maximum')
+            sigma = np.sqrt(-1 / (2 * c2))
+            x0 = -c1 / (2 * c2)
+
+        step = np.abs(np.diff(x)).min() if len(x) > 1 else 0
+        if not (x.min() <= x0 <= x.max()) or not (step / 2 <= sigma <= x.max() - x.min()):
+            raise RuntimeError('quickfit: peak outside of the scan')
+        if sigma_ref is not None and not (sigma_ref / 2 <= sigma <= sigma_ref * 2):
+            raise RuntimeError('quickfit: width changed')
+
+        return self.fit_amplitude(x, y, [x0, sigma], max_chisq)
+
     def get_peakcenter(self):
         '''
         specific function used by the nv tracker
@@ -273,6 +353,132 @@ class fit_tracker(GenericFit):
         return self.fp[2]
 
 
+class fit_tracker_2d(GenericFit):
+    '''
+    used by the tracker to find the center of the NV from a single xy scan
+    xvals: (2, n) array of the x, y positions of the n points
+    '''
+    def __init__(self, data=None, xvals=None):
+        super().__init__(data, xvals)
+
+    def model(self, xy, amp, x0, y0, sigma_x, sigma_y, offset):
+        # gaussian constrained to positive amp guesses by squaring the amplitude
+        return amp**2 * np.exp(-(xy[0]-x0)**2/(2*sigma_x**2) - (xy[1]-y0)**2/(2*sigma_y**2)) + offset
+
+    def dofit(self, *args, **kwargs):
+        # the nan points are columns of xvals
+        keep = np.isfinite(self.data)
+        self.xvals = self.xvals[:, keep]
+        self.data = self.data[keep]
+
+        if not self.extguess:
+            self.get_guess()
+
+        self.fp, self.cov = curve_fit(self.model, self.xvals, self.data, bounds=self.bounds, sigma=self.yerr,
+                                      p0=self.guess, maxfev=self.maxfev)
+        self.err = np.sqrt(np.diag(self.cov))
+        return self.fp
+
+    def get_moments(self):
+        # center and width of the background subtracted data, per axis
+        w = np.clip(self.data - np.percentile(self.data, 20), 0, None)
+        if not np.any(w > 0):
+            w = np.ones_like(self.data)
+        center = np.sum(w * self.xvals, axis=1) / np.sum(w)
+        sigma = np.sqrt(np.sum(w * (self.xvals - center[:, None])**2, axis=1) / np.sum(w))
+        span = np.ptp(self.xvals, axis=1)
+        return center, np.where(sigma > 0, sigma, span / 4)
+
+    def get_guess(self):
+        center, sigma = self.get_moments()
+        offset = np.percentile(self.data, 20)
+        amplitude = np.sqrt(max(self.data.max() - offset, 0))
+        self.guess = [amplitude, center[0], center[1], sigma[0], sigma[1], offset]
+        return self.guess
+
+    def quickfit(self, method='logparabola', frac=0.3, max_chisq=2.0, sigma_ref=None):
+        '''
+        Closed-form estimate of the Gaussian, without curve_fit (see fit_tracker.quickfit): the projection of the grid
+        on each axis (the mean over the other axes) is a Gaussian plus a constant as well, which gives the center and
+        width along that axis. With those fixed, amplitude and offset are a linear least-squares fit to all points.
+        Axes with fewer than 5 points (e.g. the track_z_planes of the xyz tracking) get the parabola through the log of
+        the 3 points around the maximum instead, above the background of the whole grid.
+        sigma_ref: widths per axis, e.g. of the last track. Raises RuntimeError when a projection or the residuals fail
+        the quality checks.
+        '''
+        keep = np.isfinite(self.data)
+        xvals = np.asarray(self.xvals, dtype=float)[:, keep]
+        data = np.asarray(self.data, dtype=float)[keep]
+        ndim = xvals.shape[0]
+
+        line = fit_tracker()
+        center = np.empty(ndim)
+        sigma = np.empty(ndim)
+        for d in range(ndim):
+            axis, index = np.unique(xvals[d], return_inverse=True)
+            proj = np.bincount(index, weights=data) / np.bincount(index)
+            if len(axis) >= 5:
+                line.set_data(proj, xvals=axis)
+                fp = line.quickfit(method, frac=frac, max_chisq=max_chisq,
+                                   sigma_ref=None if sigma_ref is None else sigma_ref[d])
+                center[d], sigma[d] = fp[1], fp[2]
+            else:
+                center[d], sigma[d] = self.three_point(axis, proj - np.percentile(data, 10))
+                if sigma_ref is not None and not (sigma_ref[d] / 2 <= sigma[d] <= sigma_ref[d] * 2):
+                    raise RuntimeError('quickfit: width changed')
+
+        return self.fit_amplitude(xvals, data, np.concatenate([center, sigma]), max_chisq)
+
+    @staticmethod
+    def three_point(x, y):
+        # center and width of the Gaussian through the 3 points around the maximum of the background subtracted y
+        if len(y) < 3:
+            raise RuntimeError('quickfit: not enough points')
+        i = min(max(np.argmax(y), 1), len(y) - 2)
+        xr, yr = x[i - 1:i + 2], y[i - 1:i + 2]
+        if np.any(yr <= 0):
+            raise RuntimeError('quickfit: no peak')
+        c2, c1, c0 = np.polyfit(xr, np.log(yr), 2)
+        if c2 >= 0:
+            raise RuntimeError('quickfit: no maximum')
+        sigma = np.sqrt(-1 / (2 * c2))
+        x0 = -c1 / (2 * c2)
+
+        step = np.abs(np.diff(x)).min()
+        if not (x.min() <= x0 <= x.max()) or not (step / 2 <= sigma <= x.max() - x.min()):
+            raise RuntimeError('quickfit: peak outside of the scan')
+        return x0, sigma
+
+    def get_peakcenter(self):
+        return self.fp[1:3]
+
+    def get_peakwidth(self):
+        return self.fp[3:5]
+
+
+class fit_tracker_3d(fit_tracker_2d):
+    '''
+    used by the tracker to find the center of the NV from a single (sparse) xyz scan
+    xvals: (3, n) array of the x, y, z positions of the n points
+    '''
+    def model(self, xyz, amp, x0, y0, z0, sigma_x, sigma_y, sigma_z, offset):
+        return amp**2 * np.exp(-(xyz[0]-x0)**2/(2*sigma_x**2) - (xyz[1]-y0)**2/(2*sigma_y**2)
+                               - (xyz[2]-z0)**2/(2*sigma_z**2)) + offset
+
+    def get_guess(self):
+        center, sigma = self.get_moments()
+        offset = np.percentile(self.data, 20)
+        amplitude = np.sqrt(max(self.data.max() - offset, 0))
+        self.guess = [amplitude, center[0], center[1], center[2], sigma[0], sigma[1], sigma[2], offset]
+        return self.guess
+
+    def get_peakcenter(self):
+        return self.fp[1:4]
+
+    def get_peakwidth(self):
+        return self.fp[4:7]
+
+
 class fit_tracker_z(GenericFit):
     '''
     currently used by the tracker to find the center of the NV using PL
@@ -0,0 +1,110 @@
+import numpy as np
+
+
+class FocusSurface:
+    '''Focal surface z(x, y) of the sample for autoZ, least-squares fit to N (x, y, z) focus points.
+
+    kind: 'plane' (z = c0 + c1 x + c2 y, at least 3 points), 'quadratic' (plus x^2, xy, y^2 terms, at least 6
+        points) or 'tps' (thin-plate spline through the points on top of a plane, at least 3 points).
+    smoothing: regularization of the thin-plate spline (um^2). 0 interpolates the points exactly, larger values
+        trade the fit at the points for a smoother surface (and infinity gives back the plane).
+    With fewer points than the kind needs, the next simpler model is used, down to a constant z for 1-2 points.
+    The surface is evaluated on arrays, so that a whole scan trajectory is computed in one call.'''
+
+    min_points = {'tps': 3, 'quadratic': 6, 'plane': 3, 'constant': 1}
+
+    def __init__(self, kind='plane', smoothing=0.0):
+        if kind not in self.min_points:
+            raise ValueError('Unknown focus surface: %s' % kind)
+        self.kind = kind
+        self.smoothing = smoothing
+        self.model = None  # kind of the last fit, None before a fit
+        self.points = np.zeros((0, 3))
+        self.center = np.zeros(2)
+        self.scale = 1.0
+        self.coef = None
+        self.weights = None
+        self.residual = np.nan  # rms residual (um) at the fit points
+
+    def fit(self, points):
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        points = points[np.all(np.isfinite(points), axis=1)] if points.size else np.zeros((0, 3))
+
+        order = ['tps', 'quadratic', 'plane', 'constant']
+        candidates = order[order.index(self.kind):] if self.kind != 'tps' else ['tps', 'constant']
+        model = next((m for m in candidates if len(points) >= self.min_points[m]), None)
+        if model is None:
+            raise ValueError('No focus points to fit')
+
+        # work in centered, scaled coordinates to keep the quadratic terms well conditioned
+        self.points = points
+        self.center = points[:, :2].mean(axis=0)
+        self.scale = np.max(np.abs(points[:, :2] - self.center)) or 1.0
+        u, v = self.normalize(points[:, 0], points[:, 1])
+        z = points[:, 2]
+        self.model = model
+        self.weights = None
+
+        if model == 'tps':
+            n = len(points)
+            p = self.basis(u, v, 'plane')
+            a = np.zeros((n + 3, n + 3))
+            a[:n, :n] = self.kernel(u[:, None] - u[None, :], v[:, None] - v[None, :]) + \
+                self.smoothing / self.scale ** 2 * np.eye(n)
+            a[:n, n:] = p
+            a[n:, :n] = p.T
+            sol = np.linalg.lstsq(a, np.concatenate([z, np.zeros(3)]), rcond=None)[0]
+            self.weights = sol[:n]
+            self.coef = sol[n:]
+        else:
+            self.coef = np.linalg.lstsq(self.basis(u, v, model), z, rcond=None)[0]
+
+        self.residual = np.sqrt(np.mean((self(points[:, 0], points[:, 1]) - z) ** 2))
+        return self
+
+    def normalize(self, x, y):
+        return (np.asarray(x, dtype=np.float64) - self.center[0]) / self.scale, \
+               (np.asarray(y, dtype=np.float64) - self.center[1]) / self.scale
+
+    @staticmethod
+    def basis(u, v, model):
+        one = np.ones_like(u)
+        if model == 'constant':
+            return one[..., None]
+        if model == 'quadratic':
+            return np.stack([one, u, v, u * u, u * v, v * v], axis=-1)
+        return np.stack([one, u, v], axis=-1)
+
+    @staticmethod
+    def kernel(du, dv):
+        # thin-plate spline radial function r^2 log r, 0 at r = 0
+        r2 = du * du + dv * dv
+        return 0.5 * r2 * np.log(np.where(r2 > 0, r2, 1.0))
+
+    def __call__(self, x, y):
+        if self.model is None:
+            raise RuntimeError('Focus surface has not been fit')
+        u, v = self.normalize(x, y)
+        if self.model == 'tps':
+            z = self.basis(u, v, 'plane') @ self.coef
+            pu, pv = self.normalize(self.points[:, 0], self.points[:, 1])
+            z = z + self.kernel(u[..., None] - pu, v[..., None] - pv) @ self.weights
+        else:
+            z = self.basis(u, v, self.model) @ self.coef
+        return z if np.ndim(z) else float(z)
+
+    def describe(self):
+        # short text for the autoZ label
+        if self.model is None:
+            return 'no focus surface'
+        if self.model in ['constant', 'plane']:
+            c = np.zeros(3)
+            c[:len(self.coef)] = self.coef
+            # back to z = c0 + c1 x + c2 y in um
+            c1, c2 = c[1] / self.scale, c[2] / self.scale
+            c0 = c[0] - c1 * self.center[0] - c2 * self.center[1]
+            text = 'z = %.3f + %.3fx + %.3fy' % (c0, c1, c2)
+        else:
+            text = '%s, z(%.1f, %.1f) = %.3f' % (self.model, self.center[0], self.center[1],
+                                                 self(self.center[0], self.center[1]))
+        return text + ' (%d pts, rms %.3f)' % (len(self.points), self.residual)
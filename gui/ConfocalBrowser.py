@@ -213,7 +213,7 @@ class ConfocalBrowser(QtWidgets.QMainWindow, confocal_browser.Ui_MainWindow):
     def confocal_1_browse(self):
         documents_path = os.path.expanduser(os.path.join('~', 'Documents', 'data_mat'))
         fd = QtGui.QFileDialog(directory=documents_path)
-        targetfile = fd.getOpenFileName(filter='mat files (*.mat)')[0]
+        targetfile = fd.getOpenFileName(directory=fu.latest_data('PLxpos'), filter='mat files (*.mat)')[0]
 
         if targetfile != '':
             matfile = scipy.io.loadmat(targetfile)
@@ -226,7 +226,7 @@ class ConfocalBrowser(QtWidgets.QMainWindow, confocal_browser.Ui_MainWindow):
     def confocal_2_browse(self):
         documents_path = os.path.expanduser(os.path.join('~', 'Documents', 'data_mat'))
         fd = QtGui.QFileDialog(directory=documents_path)
-        targetfile = fd.getOpenFileName(filter='mat files (*.mat)')[0]
+        targetfile = fd.getOpenFileName(directory=fu.latest_data('PLxpos'), filter='mat files (*.mat)')[0]
 
         if targetfile != '':
             matfile = scipy.io.loadmat(targetfile)
@@ -0,0 +1,107 @@
+import warnings
+import numpy as np
+import pyqtgraph as pg
+
+
+class LiveImageItem(pg.ImageItem):
+    '''ImageItem for images that are filled row by row (live confocal scans).
+    The rendered ARGB frame is kept, and update_rows() only maps the new rows (image[:, lo:hi], column-major like
+    ImageItem) through the levels and lookup table. Anything that changes the mapping (levels, lookup table, a new
+    image) still re-renders the whole frame through render().'''
+
+    def __init__(self, *args, **kargs):
+        self.argb = None
+        super().__init__(*args, **kargs)
+
+    def render(self):
+        if self.image is None or self.image.ndim != 2 or self.levels is None or np.ndim(self.levels) != 1:
+            self.argb = None
+            return super().render()
+
+        self.argb = self.map_rows(0, self.image.shape[1])
+        # the QImage shares the memory of argb, so writing rows into argb updates it
+        self.qimage = pg.functions.makeQImage(self.argb, alpha=True, copy=False, transpose=False)
+        self._renderRequired = False
+        self._unrenderable = False
+
+    def map_rows(self, lo, hi):
+        lut = self.lut
+        if callable(lut):
+            lut = lut(self.image)
+        argb, alpha = pg.functions.makeARGB(np.ascontiguousarray(self.image[:, lo:hi].T), lut=lut, levels=self.levels)
+        return argb
+
+    def update_rows(self, lo, hi):
+        if self.argb is None or self.qimage is None or getattr(self, '_renderRequired', False) \
+                or self.argb.shape[:2] != self.image.shape[::-1]:
+            # a full render is due anyway
+            self.qimage = None
+            self._renderRequired = True
+        else:
+            self.argb[lo:hi] = self.map_rows(lo, hi)
+        self.update()
+
+
+class RowHistogram:
+    '''Histogram and min/max of an image that is filled row by row (rows are image[:, i]), updated one row at a time.
+    Rows can be overwritten (e.g. live averaging): the counts of every row are kept so that a new row replaces its
+    old contribution. The bins are only recomputed for all rows when a value falls outside of them.'''
+
+    def __init__(self, nbins=100, margin=0.1):
+        self.nbins = nbins
+        self.margin = margin  # extra range added on both sides when the bins have to grow
+        self.edges = None
+        self.counts = np.zeros((0, nbins))
+        self.row_min = np.array([])
+        self.row_max = np.array([])
+
+    def reset(self, image):
+        nrows = image.shape[1]
+        self.edges = None
+        self.counts = np.zeros((nrows, self.nbins))
+        self.row_min = np.full(nrows, np.nan)
+        self.row_max = np.full(nrows, np.nan)
+        self.update(image, 0, nrows)
+
+    def update(self, image, lo, hi):
+        if self.counts.shape[0] != image.shape[1]:
+            self.reset(image)
+            return
+
+        rows = image[:, lo:hi]
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # rows that have no data yet
+            self.row_min[lo:hi] = np.nanmin(rows, axis=0)
+            self.row_max[lo:hi] = np.nanmax(rows, axis=0)
+
+        mn, mx = self.levels()
+        if mn is None:
+            return
+        if self.edges is None or mn < self.edges[0] or mx > self.edges[-1]:
+            span = mx - mn if mx > mn else max(abs(mx), 1.0)
+            self.edges = np.linspace(mn - self.margin * span, mx + self.margin * span, self.nbins + 1)
+            lo, hi = 0, image.shape[1]
+            rows = image
+        self.counts[lo:hi] = self.bincount(rows)
+
+    def bincount(self, rows):
+        # counts of each row (column of rows) in one bincount call
+        nrows = rows.shape[1]
+        vals = rows.T
+        finite = np.isfinite(vals)
+        idx = ((vals[finite] - self.edges[0]) / (self.edges[-1] - self.edges[0]) * self.nbins).astype(int)
+        idx = np.clip(idx, 0, self.nbins - 1) + np.nonzero(finite)[0] * self.nbins
+        return np.bincount(idx, minlength=nrows * self.nbins).reshape(nrows, self.nbins)
+
+    def levels(self):
+        # (min, max) of the image, (None, None) if it has no data yet
+        if not np.any(np.isfinite(self.row_min)):
+            return None, None
+        return np.nanmin(self.row_min), np.nanmax(self.row_max)
+
+    def histogram(self):
+        # bin centers and counts
+        if self.edges is None:
+            return None, None
+        return (self.edges[:-1] + self.edges[1:]) / 2, self.counts.sum(axis=0)
+
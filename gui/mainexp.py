@@ -258,6 +258,9 @@ class Ui_MainWindow(object):
         self.chkbx_PLE_fast = QtWidgets.QCheckBox(self.tab_exp)
         self.chkbx_PLE_fast.setGeometry(QtCore.QRect(80, 635, 101, 17))
         self.chkbx_PLE_fast.setObjectName("chkbx_PLE_fast")
+        self.chkbx_esr_fastlist = QtWidgets.QCheckBox(self.tab_exp)
+        self.chkbx_esr_fastlist.setGeometry(QtCore.QRect(290, 635, 101, 17))
+        self.chkbx_esr_fastlist.setObjectName("chkbx_esr_fastlist")
         self.chkbx_newctr_2d = QtWidgets.QCheckBox(self.tab_exp)
         self.chkbx_newctr_2d.setGeometry(QtCore.QRect(180, 635, 101, 17))
         self.chkbx_newctr_2d.setObjectName("chkbx_newctr_2d")
@@ -897,6 +900,7 @@ class Ui_MainWindow(object):
         self.btn_exp_save.setShortcut(_translate("MainWindow", "Ctrl+S"))
         self.chkbx_2dexp_meander.setText(_translate("MainWindow", "meander"))
         self.chkbx_PLE_fast.setText(_translate("MainWindow", "fast PLE sweep"))
+        self.chkbx_esr_fastlist.setText(_translate("MainWindow", "fast list sweep"))
         self.chkbx_newctr_2d.setText(_translate("MainWindow", "individual traces"))
         self.label_filename.setText(_translate("MainWindow", "label_filename"))
         self.label_nvlist.setText(_translate("MainWindow", "NV #"))
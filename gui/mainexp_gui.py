@@ -22,6 +22,8 @@ import threading
 # import UI files
 import mainexp as mainwindow
 import mainexp_widgets
+import plot_scheduler
+import live_image
 
 
 def my_excepthook(type, value, tback):
@@ -440,7 +442,8 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
         # todo: organize
         self.plt_esr_update_timer = QtCore.QTimer()
-        self.plt_esr_update_timer.timeout.connect(self.sweep_esr_updateplots)
+        self.plt_esr_update_timer.timeout.connect(self.sweep_esr_refreshplots)
+        self.plt_esr_scheduler = plot_scheduler.PlotScheduler(self.plt_esr_update_timer)
         self.plt_ple_update_timer = QtCore.QTimer()
         self.plt_ple_update_timer.timeout.connect(self.sweep_ple_updateplots)
 
@@ -457,6 +460,8 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         self.thread_seqapd = exp.APD.SeqAPD(self, self.wait_seqapd)
         self.thread_satcurve = exp.SatCurve.SatCurve(self, self.wait_satcurve)
         self.thread_picoharp = exp.PicoHarp.PicoHarp(self, self.wait_picoharp)
+        self.save_queue = exp.SaveQueue.SaveQueue(self)
+        self.save_queue.start()
 
         '''GUI CONTROLS'''
         # Define yellow-hot colormap
@@ -495,7 +500,10 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         for name in ['confocal', 'map']:
             setattr(self, 'vb_%s' % name, pg.ViewBox())
             setattr(self, 'plt_%s' % name, pg.PlotItem(viewBox=getattr(self, 'vb_%s' % name)))
-            setattr(self, 'qtimg_%s' % name, pg.ImageItem())
+            if name == 'confocal':
+                setattr(self, 'qtimg_%s' % name, live_image.LiveImageItem())
+            else:
+                setattr(self, 'qtimg_%s' % name, pg.ImageItem())
             getattr(self, 'vb_%s' % name).addItem(getattr(self, 'qtimg_%s' % name))
 
         '''CONFOCAL PLOTS'''
@@ -503,6 +511,13 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         self.glw_confocal.addItem(self.plt_confocal, 0, 0)
         self.hlw_confocal = mainexp_widgets.CustomLUTWidget(image=self.qtimg_confocal)
         self.hlw_confocal.gradient.setColorMap(cm)
+        self.hlw_confocal.item.external_histogram = True  # fed row by row from confocal_hist
+        self.confocal_hist = live_image.RowHistogram()
+
+        # live scans mark the rows they fill; redraw them at most at the display refresh rate
+        self.plt_confocal_update_timer = QtCore.QTimer()
+        self.plt_confocal_update_timer.timeout.connect(self.confocal_refreshplot)
+        self.plt_confocal_scheduler = plot_scheduler.PlotScheduler(self.plt_confocal_update_timer)
 
         self.grid_confocal.addWidget(self.glw_confocal, 0, 0)
         self.grid_confocal.addWidget(self.hlw_confocal, 0, 1)
@@ -653,6 +668,7 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
         '''EXPERIMENT PARAMETERS'''
         # Tree view
+        self.params_table_updating = False  # set while update_params_table writes values into the model
         self.tree_exp_params.setModel(QtGui.QStandardItemModel())
         self.tree_exp_params.setAlternatingRowColors(True)
         self.tree_exp_params.setSortingEnabled(True)
@@ -744,7 +760,7 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         for name in ['pl', 'sig', 'ref', 'pl2', 'sig2', 'ref2']:
             setattr(self, 'vb_%s' % name, pg.ViewBox())
             setattr(self, 'plt2d_%s' % name, pg.PlotItem(viewBox=getattr(self, 'vb_%s' % name)))
-            setattr(self, 'qtimg_%s' % name, pg.ImageItem())
+            setattr(self, 'qtimg_%s' % name, live_image.LiveImageItem())  # 2d sweeps are filled row by row
             getattr(self, 'vb_%s' % name).addItem(getattr(self, 'qtimg_%s' % name))
             getattr(self, 'vb_%s' % name).setContentsMargins(0.01, 0.01, 0.01, 0.01)
 
@@ -1145,7 +1161,8 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         if not manual:
             sweep_params = dict(
                 (k, v) for k, v in self.exp_params.items())  # cannot just assign a new dict ref
-            sweep_params['Sweep'] = {'var1_name': self.var1_name.currentText(),
+            sweep_params['Sweep'] = {'pulsename': exp_name,
+                                     'var1_name': self.var1_name.currentText(),
                                      'var1_start': self.var1_start.value(),
                                      'var1_start_unit': self.var1_stop_unit.currentText(),
                                      'var1_stop': self.var1_stop.value(),
@@ -1300,6 +1317,9 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
             # todo: check why picoharp_start is necessary
 
     def exp_params_paramsChanged(self, item):
+        if self.params_table_updating:
+            return  # values written by update_params_table, not edited by the user
+
         paramtype = item.parent().text()
         parent = self.exp_params[paramtype]
         name = item.parent().child(item.row(), 0).text()
@@ -1321,7 +1341,7 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
             elif name in self.exp_params['Instrument'].keys():
                 self.setval[name](val)
                 if 'ctlfreq' not in name:
-                    self.exp_params['Instrument'][name] = self.getval[name]()  # query the instrument to make sure it's set
+                    self.exp_params['Instrument'][name] = self.getval[name]()  # cached value if the instrument keeps one (GPIBdev)
                 else:
                     self.exp_params['Instrument']['ctlfreqpiezo'] = self.getval['ctlfreqpiezo']()
                     self.exp_params['Instrument']['ctlfreqwm'] = self.getval['ctlfreqwm']()
@@ -1378,6 +1398,9 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
     def update_params_table(self, refresh_params_inputs=False):
         # updates the parameter table
         # called when ESR Experiment changed
+        if not refresh_params_inputs and self.update_params_values():
+            return
+
         # store checkbox states
         chkbox_state = {}
 
@@ -1440,6 +1463,35 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
         self.export_gui_settings()
 
+    def update_params_values(self):
+        # Only rewrite the values that changed if the table already has all the parameters (e.g. during a sweep).
+        # Returns False if the parameters changed and the table has to be rebuilt.
+        model = self.tree_exp_params.model()
+        items = {}
+        for i in range(model.rowCount()):
+            item_paramtype = model.item(i)
+            for j in range(item_paramtype.rowCount()):
+                items[(item_paramtype.text(), item_paramtype.child(j, 0).text())] = item_paramtype.child(j, 1)
+
+        if set(items.keys()) != set((x, y) for x in self.exp_params for y in self.exp_params[x]):
+            return False
+
+        changed = False
+        self.params_table_updating = True
+        try:
+            for (x, y), item in items.items():
+                text = str(self.exp_params[x][y])
+                if item.text() != text:
+                    item.setText(text)
+                    changed = True
+        finally:
+            self.params_table_updating = False
+
+        if changed:
+            self.update_params_label()
+            self.export_gui_settings()
+        return True
+
     def update_params_display(self, *args):
         for i in range(self.tree_exp_params.model().rowCount()):
             item_paramtype = self.tree_exp_params.model().item(i)
@@ -1560,7 +1612,10 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         start_y = self.confocal_rngy[0]
         stop_y = self.confocal_rngy[-1]
 
-        self.qtimg_confocal.setImage(self.confocal_pl[:, :, 0])
+        self.confocal_hist.reset(self.confocal_pl[:, :, 0])
+        self.hlw_confocal.setHistogram(*self.confocal_hist.histogram(), levels=self.confocal_hist.levels())
+        self.qtimg_confocal.setImage(self.confocal_pl[:, :, 0], autoLevels=False,
+                                     levels=self.hlw_confocal.region.getRegion())
         # self.hlw_confocal.setImageItem(self.qtimg_confocal)
 
         for name in ['confocal']:
@@ -1584,7 +1639,11 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', RuntimeWarning)  # for ignoring warnings when plotting NaNs
 
-            self.qtimg_confocal.setImage(self.confocal_pl[:, :, zindex])
+            self.plt_confocal_scheduler.take()  # the whole frame is drawn now
+            self.confocal_hist.reset(self.confocal_pl[:, :, zindex])
+            self.hlw_confocal.setHistogram(*self.confocal_hist.histogram(), levels=self.confocal_hist.levels())
+            self.qtimg_confocal.setImage(self.confocal_pl[:, :, zindex], autoLevels=False,
+                                         levels=self.hlw_confocal.region.getRegion())
             # self.hlw_confocal.setImageItem(self.qtimg_confocal)
 
             if self.confocal_mode == 0:
@@ -1606,6 +1665,19 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
             self.label_filename.setText(filename)
             processEvents()
 
+    def confocal_refreshplot(self):
+        # plt_confocal_update_timer: map only the rows filled since the last redraw into the displayed frame
+        t0 = time.perf_counter()
+        dirty = self.plt_confocal_scheduler.take()
+        frame = self.qtimg_confocal.image
+        if 'pl' in dirty and frame is not None and frame.ndim == 2:
+            lo, hi = dirty['pl'] if dirty['pl'] is not None else (0, frame.shape[1])
+            self.confocal_hist.update(frame, lo, hi)
+            # re-renders the whole frame if autolevel moved the levels
+            self.hlw_confocal.setHistogram(*self.confocal_hist.histogram(), levels=self.confocal_hist.levels())
+            self.qtimg_confocal.update_rows(lo, hi)
+        self.plt_confocal_scheduler.frame_done(time.perf_counter() - t0)
+
     def confocal_set_autolevel(self, b):
         self.hlw_confocal.item.autoLevel = bool(b)
 
@@ -1627,10 +1699,21 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
     def confocal_confocalZ_del(self):
         self.table_confocalZ.removeRow(self.table_confocalZ.currentRow())
 
+    def confocal_get_nvlist(self):
+        # x, y of the NVs in table_nvlist for the 'nvlist' scan pattern, read here rather than from the scan thread
+        positions = []
+        for row in range(self.table_nvlist.rowCount()):
+            try:
+                positions.append([float(self.table_nvlist.item(row, 0).text()),
+                                  float(self.table_nvlist.item(row, 1).text())])
+            except (AttributeError, ValueError):
+                pass
+        self.thread_confocal.nvlist = positions
+
     def map_load(self):
         documents_path = os.path.expanduser(os.path.join('~', 'Documents', 'data_mat'))
         fd = QtGui.QFileDialog(directory=documents_path)
-        targetfile = fd.getOpenFileName(filter='mat files (*.mat)')
+        targetfile = fd.getOpenFileName(directory=file_utils.latest_data('PLxpos'), filter='mat files (*.mat)')
 
         targetfile = targetfile[0]
         if targetfile != '':
@@ -1793,6 +1876,13 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         self.map_updatecursor()
         self.update_params_table()
 
+    def tracker_feedforward(self, xpos, ypos, zpos):
+        # Move to the position predicted by the drift model (Tracker.feedforward)
+        self.dbl_tracker_xpos.setValue(xpos)
+        self.dbl_tracker_ypos.setValue(ypos)
+        self.dbl_tracker_zpos.setValue(zpos)
+        self.tracker_drive()
+
     def tracker_home(self):
         self.dbl_tracker_xpos.setValue(0)
         self.dbl_tracker_ypos.setValue(0)
@@ -1955,6 +2045,7 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         self.chkbx_newctr_2d.setVisible(False)
         self.chkbx_2dexp_meander.setVisible(False)
         self.chkbx_PLE_fast.setVisible(False)
+        self.chkbx_esr_fastlist.setVisible(False)
 
         self.chkbx_inv.setChecked(False)
         self.chkbx_inv2.setChecked(False)
@@ -1966,6 +2057,9 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
             self.thread_sweep.isPLE = False
             self.thread_sweep.use_wm = False
             self.exp_params['Pulse'] = {}
+            self.chkbx_esr_fastlist.setVisible(True)
+            self.chkbx_esr_fastlist.setEnabled(True)
+            self.chkbx_esr_fastlist.setChecked(False)
         elif exp_name == 'PLE_CW':
             self.thread_sweep.use_pb = False
             self.thread_sweep.isPLE = True
@@ -2335,26 +2429,49 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
             processEvents()
 
+    def sweep_esr_refreshplots(self):
+        # plt_esr_update_timer: redraw only what the sweep wrote since the last redraw
+        t0 = time.perf_counter()
+        dirty = self.plt_esr_scheduler.take()
+        if dirty:
+            self.sweep_esr_drawplots(dirty)
+        self.update_params_table()
+        self.plt_esr_scheduler.frame_done(time.perf_counter() - t0)
+
     def sweep_esr_updateplots(self):
+        # redraw everything, e.g. after initplots and at the end of the sweep
+        self.plt_esr_scheduler.take()
         self.update_params_table()
+        self.sweep_esr_drawplots()
+        processEvents()
+
+    def sweep_esr_drawplots(self, dirty=None):
+        # dirty: PlotScheduler.take() of the esrtrace_* arrays to redraw, None for all of them. The 1d curves are
+        # redrawn whole, the 2d images only map the rows in the marked range
+        def changed(*names):
+            return dirty is None or any(name in dirty for name in names)
 
         with warnings.catch_warnings():
             warnings.simplefilter('ignore', RuntimeWarning)  # for ignoring warnings when plotting NaNs
 
             if not self.thread_sweep.is2D:    # 1d scan
-                if not self.thread_sweep.use_pb:
-                    self.curve_pl.setData(self.esr_rngx, self.esrtrace_pl)
-                else:
+                if changed('pl'):
                     self.curve_pl.setData(self.esr_rngx, self.esrtrace_pl)
 
+                if self.thread_sweep.use_pb:
                     if not self.thread_sweep.newctr:
-                        self.curve_ref.setData(self.esr_rngx, self.esrtrace_ref)
-                        self.curve_sig.setData(self.esr_rngx, self.esrtrace_sig)
+                        if changed('ref'):
+                            self.curve_ref.setData(self.esr_rngx, self.esrtrace_ref)
+                        if changed('sig'):
+                            self.curve_sig.setData(self.esr_rngx, self.esrtrace_sig)
                         if self.thread_sweep.isINV2:
-                            self.curve_pl2.setData(self.esr_rngx, self.esrtrace_pl2)
-                            self.curve_ref2.setData(self.esr_rngx, self.esrtrace_ref2)
-                            self.curve_sig2.setData(self.esr_rngx, self.esrtrace_sig2)
-                    else:  # new counter gating
+                            if changed('pl2'):
+                                self.curve_pl2.setData(self.esr_rngx, self.esrtrace_pl2)
+                            if changed('ref2'):
+                                self.curve_ref2.setData(self.esr_rngx, self.esrtrace_ref2)
+                            if changed('sig2'):
+                                self.curve_sig2.setData(self.esr_rngx, self.esrtrace_sig2)
+                    elif changed('newctr'):  # new counter gating
                         numctr = self.esrtrace_newctr.shape[0]
                         if numctr > 7:
                             numctr = 7
@@ -2370,14 +2487,29 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
                 if self.thread_sweep.use_pb:
                     datatypes.extend(['sig', 'ref'])
+                    if self.thread_sweep.isINV2:
+                        datatypes.extend(['pl2', 'sig2', 'ref2'])
 
+                hlws = []
                 for datatype in datatypes:
-                    qtimg = getattr(self, 'qtimg_%s' % datatype)
-                    data = getattr(self, 'esrtrace_%s' % datatype)
-                    qtimg.setImage(data)
-                    processEvents()
+                    if changed(datatype):
+                        qtimg = getattr(self, 'qtimg_%s' % datatype)
+                        data = getattr(self, 'esrtrace_%s' % datatype)
+                        rows = dirty[datatype] if dirty is not None else None
+                        if rows is None or qtimg.image is None or qtimg.image.shape != data.shape \
+                                or not np.may_share_memory(qtimg.image, data):
+                            # the levels come from the histogram widget, no need for ImageItem to scan the image
+                            qtimg.setImage(data, autoLevels=dirty is None or qtimg.levels is None)
+                        else:
+                            # only map the rows of var2 that the sweep wrote since the last redraw
+                            qtimg.update_rows(*rows)
+                            hlw = self.hlw_main if datatype in ['pl', 'pl2'] else self.hlw_raw
+                            if hlw not in hlws:
+                                hlws.append(hlw)
 
-            processEvents()
+                # once per histogram instead of once per image; re-renders the images if the levels moved
+                for hlw in hlws:
+                    hlw.imageChanged(autoLevel=True)
 
     def sweep_ple_initplots(self):
         self.sweep_clear_plots()
@@ -3052,6 +3184,9 @@ class MainExp_GUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
         self.export_gui_settings()
 
+        # write the saves that are still waiting
+        self.save_queue.stop()
+
         if hasattr(self, 'video_test_timer'):
             self.video_test_timer.stop()
 
@@ -457,6 +457,7 @@ class CustomLUTWidget(pg.GraphicsView):
 class CustomLUTItem(pg.HistogramLUTItem):
     def __init__(self, image=None, fillHistogram=True):
         self.autoLevel = True
+        self.external_histogram = False  # histogram and levels come from setHistogram() instead of the image
         super().__init__(image=image, fillHistogram=fillHistogram)
         self.vb.setMinimumWidth(10)  # width of the actual histogram
         self.vb.setMaximumWidth(15)  # width of the actual histogram
@@ -528,7 +529,19 @@ class CustomLUTItem(pg.HistogramLUTItem):
         self.sigLevelsChanged.emit(self)
         self.update()
 
+    def setHistogram(self, bins, counts, levels):
+        # histogram computed elsewhere (e.g. live_image.RowHistogram), levels: (min, max) for autoLevel
+        if bins is None:
+            return
+        self.plot.setData(bins, counts)
+        if self.autoLevel and levels[0] is not None:
+            self.region.setRegion(levels)
+        self.updateImageRegion()
+
     def imageChanged(self, autoLevel=False, autoRange=False):
+        if self.external_histogram:
+            return
+
         targetHistogramSize = 100
         if type(self.imageItem) is not list:
             h = self.imageItem().getHistogram(targetHistogramSize=targetHistogramSize)
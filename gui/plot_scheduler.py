@@ -0,0 +1,57 @@
+import threading
+
+
+class PlotScheduler:
+    '''Redraw bookkeeping for the live sweep plots.
+    The sweep thread marks the arrays it wrote with mark(); the GUI timer only redraws what take() returns. The timer
+    interval follows the measured redraw time, so that plotting uses at most max_load of the GUI thread and the
+    wait_for_mainexp handshakes of the sweep are not delayed by a backlog of redraws.'''
+
+    def __init__(self, timer, max_load=0.25, max_interval=5000):
+        self.timer = timer
+        self.max_load = max_load
+        self.max_interval = max_interval
+        self.base_interval = 0
+
+        self.lock = threading.Lock()
+        self.dirty = {}  # name -> (lo, hi) filled along the last axis since the last redraw, None for the whole array
+
+        self.frame_cost = 0.0  # running average of the redraw time (s)
+        self.frames = 0
+
+    def start(self, interval):
+        self.base_interval = interval
+        self.frame_cost = 0.0
+        self.frames = 0
+        self.timer.start(interval)
+
+    def stop(self):
+        self.timer.stop()
+
+    def mark(self, names, lo=None, hi=None):
+        # Called from the sweep thread. lo, hi: index range along the last axis (points in 1D, rows in 2D)
+        with self.lock:
+            for name in names:
+                if lo is None or (name in self.dirty and self.dirty[name] is None):
+                    self.dirty[name] = None
+                elif name in self.dirty:
+                    self.dirty[name] = (min(self.dirty[name][0], lo), max(self.dirty[name][1], hi))
+                else:
+                    self.dirty[name] = (lo, hi)
+
+    def take(self):
+        with self.lock:
+            dirty = self.dirty
+            self.dirty = {}
+        return dirty
+
+    def frame_done(self, dt):
+        if self.frames == 0:
+            self.frame_cost = dt
+        else:
+            self.frame_cost = 0.8 * self.frame_cost + 0.2 * dt
+        self.frames += 1
+
+        interval = int(min(self.max_interval, max(self.base_interval, 1000 * self.frame_cost / self.max_load)))
+        if self.timer.isActive() and abs(interval - self.timer.interval()) > 0.1 * self.timer.interval():
+            self.timer.setInterval(interval)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
+import hashlib
+from collections import OrderedDict
 
 if __name__ == '__main__':
     import GPIBdev # use when running this as a main
@@ -33,8 +35,12 @@ class N9310A(GPIBdev.GPIBdev):
             print('Freq Range Error! Tried to set to %f' % freq)
         else:
             self.gpib_write(':FREQ:CW %.6f Hz' % freq)
+            self.cache_set('freq', freq, self.query_freq)
 
     def get_freq(self):
+        return self.cache_get('freq', self.query_freq)
+
+    def query_freq(self):
         return float(self.gpib_query(':FREQ:CW?'))
 
     def set_pow(self, pow):
@@ -43,8 +49,12 @@ class N9310A(GPIBdev.GPIBdev):
             print('Power Range Error! Tried to set to %f' % pow)
         else:
             self.gpib_write(':AMPL:CW %f' % pow)
+            self.cache_set('pow', pow, self.query_pow)
 
     def get_pow(self):
+        return self.cache_get('pow', self.query_pow)
+
+    def query_pow(self):
         return float(self.gpib_query(':AMPL:CW?'))
 
     def set_mod(self, b):
@@ -52,8 +62,12 @@ class N9310A(GPIBdev.GPIBdev):
 
     def set_output(self, b):
         self.gpib_write(':RFO:STAT %d' % b)
+        self.cache_set('output', int(b), self.query_output)
 
     def get_output(self):
+        return self.cache_get('output', self.query_output)
+
+    def query_output(self):
         return int(self.gpib_query(':RFO:STAT?'))
 
     def set_alc(self, b):
@@ -67,8 +81,12 @@ class N9310A(GPIBdev.GPIBdev):
 
     def set_iqmod(self, b):
         self.gpib_write(':IQ:STAT %d' % b)
+        self.cache_set('iqmod', int(b), self.query_iqmod)
 
     def get_iqmod(self):
+        return self.cache_get('iqmod', self.query_iqmod)
+
+    def query_iqmod(self):
         return int(self.gpib_query(':IQ:STAT?'))
 
 
@@ -84,6 +102,7 @@ class E8257D(GPIBdev.GPIBdev):
         self.pow_max = -5
         self.freq_min = 100e3
         self.freq_max = 20e9
+        self.freq_list_max = 1601  # maximum number of points for set_freq_list()
 
         self.set_output(0)
 
@@ -93,18 +112,64 @@ class E8257D(GPIBdev.GPIBdev):
             print('Freq Range Error! Tried to set to %f' % freq)
         else:
             self.gpib_write('SOUR:FREQ %.6f' % freq)
+            self.cache_set('freq', freq, self.query_freq)
 
     def get_freq(self):
+        return self.cache_get('freq', self.query_freq)
+
+    def query_freq(self):
         return float(self.gpib_query('SOUR:FREQ?'))
 
+    def freq_list_error(self, freqs):
+        # why freqs cannot be loaded by set_freq_list(), '' if they can
+        freqs = list(freqs)
+        if not len(freqs) or len(freqs) + 1 > self.freq_list_max:
+            return 'Freq List Error! %d points is more than %d' % (len(freqs), self.freq_list_max)
+        elif min(freqs) < self.freq_min or max(freqs) > self.freq_max:
+            return 'Freq Range Error! Tried to set list from %f to %f' % (min(freqs), max(freqs))
+        return ''
+
+    def set_freq_list(self, freqs):
+        # Load a frequency list and step through it with the external trigger. The first trigger goes to freqs[0].
+        # Returns False if the list cannot be loaded.
+        freqs = list(freqs)
+        error = self.freq_list_error(freqs)
+        if error:
+            print(error)
+            return False
+        else:
+            # repeat the first point so that the source sits there until the first trigger
+            freqs = [freqs[0]] + freqs
+
+            self.gpib_write('SOUR:FREQ:MODE CW')
+            self.gpib_write('LIST:TYPE LIST')
+            self.gpib_write('LIST:FREQ ' + ','.join(['%.6f' % f for f in freqs]))
+            self.gpib_write('LIST:POW %f' % self.get_pow())  # a single power applies to all the points
+            self.gpib_write('LIST:TRIG:SOUR EXT')
+            self.gpib_write('TRIG:SOUR IMM')
+            self.gpib_write('INIT:CONT OFF')
+            self.gpib_write('SOUR:FREQ:MODE LIST')
+            self.gpib_write('INIT')
+            self.cache_clear('freq')  # the list sets the frequency
+            return True
+
+    def set_freq_cw(self):
+        # Leave list mode
+        self.gpib_write('SOUR:FREQ:MODE CW')
+        self.cache_clear('freq')
+
     def set_pow(self, pow):
         # set generator power in dBm
         if (pow < self.pow_min) or (pow > self.pow_max):
             print('Power Range Error! Tried to set to %f' % pow)
         else:
             self.gpib_write('SOUR:POW %f' % pow)
+            self.cache_set('pow', pow, self.query_pow)
 
     def get_pow(self):
+        return self.cache_get('pow', self.query_pow)
+
+    def query_pow(self):
         return float(self.gpib_query('SOUR:POW?'))
 
     def set_mod(self, b):
@@ -135,8 +200,46 @@ class AWG33622A(GPIBdev.GPIBdev):
         self.vmin = -0.354
         self.vmax = +0.354
 
+        # Waveforms in the volatile memory of each channel: hash of the DAC data -> (name, points), least recently
+        # used first. A waveform is uploaded once, then switching to it is a select command.
+        self.wfm_library = {1: OrderedDict(), 2: OrderedDict()}
+        self.wfm_max = 32  # waveforms per channel
+        self.wfm_capacity = {1: None, 2: None}  # points per channel, read after clearing the memory
+        self.wfm_stats = [0, 0, 0]  # uploads, selects of uploaded waveforms, clears
+
+        # last value written for each setting, so that repeated settings are not sent again
+        self.state = {}
+        self.reconnected = False  # set by gpib_connect(), cleared by reset_state()
+
+    def gpib_connect(self, **kwargs):
+        # the AWG might have been power cycled: nothing that was sent before can be assumed
+        super().gpib_connect(**kwargs)
+        self.reset_state()
+        self.reconnected = True
+
+    def reset_state(self):
+        # forget the settings and the waveform library, e.g. after a reconnect or a reset of the instrument
+        self.forget_state()
+        for ch in self.wfm_library:
+            self.wfm_library[ch].clear()
+            self.wfm_capacity[ch] = None
+        self.reconnected = False
+
+    def set_state(self, header, value):
+        # send 'header value' unless it is the last value sent
+        if self.state.get(header) != value:
+            self.gpib_write('%s %s' % (header, value))
+            self.state[header] = value
+
+    def forget_state(self, *headers):
+        # settings that were changed as a side effect, all of them if no headers are given
+        if not headers:
+            self.state = {}
+        for header in headers:
+            self.state.pop(header, None)
+
     def set_func(self, ch, fun):
-        self.gpib_write('SOUR%d:FUNC %s' % (ch, fun))
+        self.set_state('SOUR%d:FUNC' % ch, fun)
 
     def set_alias(self, pb_chan):
         self.alias = pb_chan
@@ -147,54 +250,111 @@ class AWG33622A(GPIBdev.GPIBdev):
     def set_amplitude(self, ch, amp):
         self.set_limits()
         self.gpib_write('SOUR%d:VOLT %.3f' % (ch, amp))
+        self.forget_state('SOUR%d:VOLT:LOW' % ch, 'SOUR%d:VOLT:HIGH' % ch)
 
     def set_dc(self, ch, v):
         self.gpib_write('SOUR%d:VOLT:OFFS %.3f' % (ch, v))
+        self.forget_state('SOUR%d:VOLT:LOW' % ch, 'SOUR%d:VOLT:HIGH' % ch)
 
     def set_amplitude_wfm(self, ch, low, high):
         # self.set_limits()
         if low == 0 and high == 0:
-            self.gpib_write('SOUR%d:VOLT:LOW MIN' % (ch))
-            self.gpib_write('SOUR%d:VOLT:HIGH MAX' % (ch))
+            self.set_state('SOUR%d:VOLT:LOW' % ch, 'MIN')
+            self.set_state('SOUR%d:VOLT:HIGH' % ch, 'MAX')
         else:
-            self.gpib_write('SOUR%d:VOLT:LOW %.3f' % (ch, low))
-            self.gpib_write('SOUR%d:VOLT:HIGH %.3f' % (ch, high))
+            self.set_state('SOUR%d:VOLT:LOW' % ch, '%.3f' % low)
+            self.set_state('SOUR%d:VOLT:HIGH' % ch, '%.3f' % high)
 
     def set_output(self, b):
         self.gpib_write('OUTP1 %d' % b)
         self.gpib_write('OUTP2 %d' % b)
 
     def set_gated(self, ch, b):
-        self.gpib_write('SOUR%d:BURS:STAT %d' % (ch, b))
+        self.set_state('SOUR%d:BURS:STAT' % ch, '%d' % b)
         if bool(b):
-            self.gpib_write('SOUR%d:BURS:MODE GAT' % ch)
-            self.gpib_write('SOUR%d:BURS:SOUR EXT' % ch)
+            self.set_state('SOUR%d:BURS:MODE' % ch, 'GAT')
+            self.set_state('SOUR%d:BURS:SOUR' % ch, 'EXT')
 
     def set_triggered(self, ch, b):
-        self.gpib_write('SOUR%d:BURS:STAT %d' % (ch, b))
+        self.set_state('SOUR%d:BURS:STAT' % ch, '%d' % b)
         if bool(b):
-            self.gpib_write('SOUR%d:BURS:MODE TRIG' % ch)
-            self.gpib_write('SOUR%d:BURS:NCYC 1' % ch)
-            self.gpib_write('TRIG%d:SOUR EXT' % ch)
+            self.set_state('SOUR%d:BURS:MODE' % ch, 'TRIG')
+            self.set_state('SOUR%d:BURS:NCYC' % ch, '1')
+            self.set_state('TRIG%d:SOUR' % ch, 'EXT')
 
     def set_wfm(self, ch, wfm, sampl=250e6):
+        # wfm is a list of float, normalized to 1. It is uploaded unless it is already in the library of the channel,
+        # and the settings that have not changed are skipped, so that switching waveforms is usually one command.
+        dac = self.wfm_dac(wfm)
+        key = hashlib.sha1(dac.tobytes()).hexdigest()
+        library = self.wfm_library[ch]
+        if key in library:
+            library.move_to_end(key)
+            self.wfm_stats[1] += 1
+        elif not self.wfm_upload(ch, key, dac):
+            return False
+
+        self.set_state('SOUR%d:FUNC:ARB' % ch, library[key][0])
         self.set_func(ch, 'ARB')
-        self.gpib_write('SOUR%d:FUNC:ARB:SRAT %d' % (ch, sampl))
-        self.gpib_write('SOUR%d:FUNC:ARB:FILT OFF' % ch)
+        self.set_state('SOUR%d:FUNC:ARB:SRAT' % ch, '%d' % sampl)
+        self.set_state('SOUR%d:FUNC:ARB:FILT' % ch, 'OFF')
         self.set_triggered(ch, 1)
-
-        self.gpib_write('SOUR%d:DATA:VOL:CLE' % ch)
-
-        wfm_array = np.array(wfm)
-
-        header = 'SOUR%d:DATA:ARB wfm%d, ' % (ch, ch)
-
-        self.gpib_write('FORMat:BORDer SWAP')
-
+        return True
+
+    @staticmethod
+    def wfm_dac(wfm):
+        # DAC codes, +-32767 for +-1: half the bytes of float32
+        wfm = np.asarray(wfm, dtype=float)
+        peak = np.max(np.abs(wfm)) if wfm.size else 0.0
+        if not peak <= 1 + 1e-9:
+            raise ValueError('AWG waveform exceeds the normalization: |wfm| = %g > 1' % peak)
+        return np.round(np.clip(wfm, -1, 1) * 32767).astype(np.int16)
+
+    def wfm_upload(self, ch, key, dac):
+        library = self.wfm_library[ch]
+        if self.wfm_capacity[ch] is None:
+            self.wfm_clear(ch)
+        used = sum(points for _, points in library.values())
+        if len(library) >= self.wfm_max or used + len(dac) > self.wfm_capacity[ch]:
+            # the volatile memory can only be cleared as a whole, so the eviction of the least recently used
+            # waveform drops the rest of the library as well
+            self.wfm_clear(ch)
+
+        name = 'W%s' % key[:11]  # up to 12 characters, starting with a letter
+        self.set_state('FORM:BORD', 'SWAP')
+        error = self.get_error()
+        if error:
+            print('AWG error before uploading to ch%d:' % ch)
+            print(error)
         # this function takes care of the binary block header by itself
-        self.inst.write_binary_values(header, wfm_array)
-
-        self.gpib_write('SOUR%d:FUNC:ARB wfm%d' % (ch, ch))
+        self.gpib_call(lambda: self.inst.write_binary_values('SOUR%d:DATA:ARB:DAC %s, ' % (ch, name), dac,
+                                                             datatype='h', is_big_endian=False))
+        error = self.get_error()
+        if error:
+            # not in memory (e.g. memory full or bad length), so it must not be selected later
+            print('AWG ch%d waveform upload failed:' % ch)
+            print(error)
+            return False
+        library[key] = (name, len(dac))
+        self.wfm_stats[0] += 1
+        return True
+
+    def wfm_clear(self, ch):
+        # empty the volatile memory of channel ch, which also deselects its waveform
+        self.gpib_write('SOUR%d:DATA:VOL:CLE' % ch)
+        self.forget_state('SOUR%d:FUNC:ARB' % ch, 'SOUR%d:FUNC' % ch)
+        self.wfm_library[ch].clear()
+        self.wfm_stats[2] += 1
+        try:
+            self.wfm_capacity[ch] = int(float(self.gpib_query('SOUR%d:DATA:VOL:FREE?' % ch)))
+        except (TypeError, ValueError):
+            self.wfm_capacity[ch] = 0
+        if self.wfm_capacity[ch] <= 0:
+            self.wfm_capacity[ch] = 4 * 2 ** 20  # standard memory of the 33622A
+
+    def print_io_stats(self):
+        super().print_io_stats()
+        print('%s waveforms: %d uploads, %d selects, %d clears' % ((self.dev,) + tuple(self.wfm_stats)))
 
     def set_wfm_dual(self, wfm1, wfm2, sampl=250e6):
         # wfm is a list of float, normalized to 1
@@ -216,7 +376,7 @@ class AWG33622A(GPIBdev.GPIBdev):
         if len(wfm_list) != len(reps_list):
             print('error')  # todo
         else:
-            awg.gpib_write('DATA:VOLatile:CLE')
+            self.wfm_clear(1)
 
             for seq in range(len(wfm_list)):
                 # <arb name>,<repeat count>,<play control>,<marker mode>,<marker point>
@@ -228,7 +388,7 @@ class AWG33622A(GPIBdev.GPIBdev):
                 marker_point = 10
 
                 # load waveform into memory
-                awg.gpib_write('MMEM:LOAD:DATA "%s"' % wfm)
+                self.gpib_write('MMEM:LOAD:DATA "%s"' % wfm)
                 seq_cmd += ',"%s",%d,%s,%s,%d' % (wfm, rep_count, play_control, marker_mode, marker_point)
 
             char_count = len(seq_cmd)
@@ -239,7 +399,7 @@ class AWG33622A(GPIBdev.GPIBdev):
     def get_error(self):
         err = self.gpib_query('SYST:ERR?')
 
-        if '+0' in err:
+        if not isinstance(err, str) or '+0' in err:  # -1 if not connected
             return ''
         else:
             error_all = ''
@@ -253,6 +413,10 @@ class AWG33622A(GPIBdev.GPIBdev):
                 print('More than %d error messages occurred. You are probably doing something stupid...' % max_err)
             return error_all
 
+    def get_error_async(self):
+        # Future of get_error() after the queued commands, so that more commands can be queued in the meantime
+        return self.io_submit('call', self.get_error)
+
     def set_view(self, mode):
         # mode: STANdard|TEXT|GRAPh|DUAL
         self.gpib_write('DISP:VIEW %s' % mode)
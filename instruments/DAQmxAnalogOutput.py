@@ -131,12 +131,9 @@ class GalvoPiezo(DAQmxChannel.DAQmxChannel):
     def set_voltages(self, vx, vy, vz, autostart=0):
         # this function should not be called from outside
         # check if piezo is getting negative voltage and replace with 0
-        replaceval = False
-        for ind in range(len(vz)):
-            if vz[ind] < 0:
-                vz[ind] = 0
-                replaceval = True
-        if replaceval:
+        vz = np.asarray(vz, dtype=np.float64)
+        if np.any(vz < 0):
+            vz = np.maximum(vz, 0)
             print('below piezo range, replacing negative vals with 0')
 
         if not (len(vx) == len(vy) and len(vx) == len(vz)):
@@ -144,10 +141,29 @@ class GalvoPiezo(DAQmxChannel.DAQmxChannel):
         else:
             timeout = -1
             writeval = ctypes.c_int32()
-            v_concat = np.float64(np.append(np.append(vx, vy), vz))
+            v_concat = np.concatenate([np.asarray(vx, dtype=np.float64), np.asarray(vy, dtype=np.float64), vz])
             pydaqmx.DAQmxWriteAnalogF64(self.th, len(vx), autostart, timeout, pydaqmx.DAQmx_Val_GroupByChannel, v_concat, writeval, None)
             self.lastSweepVoltage = [vx[-1], vy[-1], vz[-1]]
 
+    def set_trajectory(self, pos, autostart=0):
+        '''
+        pos: (3, n) array of x, y, z positions in microns, e.g. scan_patterns.ScanPattern.trajectory().
+        Converted to voltages in one step and written as a single contiguous float64 buffer.
+        '''
+        v = np.asarray(pos, dtype=np.float64) * np.reshape(np.float64(self.volt_per_micron), (3, 1)) + \
+            np.reshape(np.float64(self.offset), (3, 1))
+        if np.any(v[2] < 0):
+            v[2] = np.maximum(v[2], 0)
+            print('below piezo range, replacing negative vals with 0')
+        v = np.ascontiguousarray(v)
+
+        self.lastSweepPosition = self.currentPosition
+        timeout = -1
+        writeval = ctypes.c_int32()
+        pydaqmx.DAQmxWriteAnalogF64(self.th, v.shape[1], autostart, timeout, pydaqmx.DAQmx_Val_GroupByChannel,
+                                    v.reshape(-1), writeval, None)
+        self.lastSweepVoltage = list(v[:, -1])
+
     def set_position(self, ax, p):
         '''
         p should be a list of the positions
@@ -275,6 +291,21 @@ class Galvo(DAQmxChannel.DAQmxChannel):
             pydaqmx.DAQmxWriteAnalogF64(self.th, len(vx), autostart, timeout, pydaqmx.DAQmx_Val_GroupByChannel, v_concat, writeval, None)
             self.lastSweepVoltage = [vx[-1], vy[-1]]
 
+    def set_trajectory(self, pos, autostart=0):
+        '''
+        pos: (3, n) array of x, y, z positions in microns. z is ignored.
+        '''
+        v = np.asarray(pos, dtype=np.float64)[:2] * np.reshape(np.float64(self.volt_per_micron)[:2], (2, 1)) + \
+            np.reshape(np.float64(self.offset)[:2], (2, 1))
+        v = np.ascontiguousarray(v)
+
+        self.lastSweepPosition = self.currentPosition
+        timeout = -1
+        writeval = ctypes.c_int32()
+        pydaqmx.DAQmxWriteAnalogF64(self.th, v.shape[1], autostart, timeout, pydaqmx.DAQmx_Val_GroupByChannel,
+                                    v.reshape(-1), writeval, None)
+        self.lastSweepVoltage = list(v[:, -1])
+
     def set_position(self, ax, p):
         '''
         p should be a list of the positions
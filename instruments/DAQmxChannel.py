@@ -2,10 +2,16 @@ import PyDAQmx as pydaqmx
 import numpy as np
 import ctypes
 import time
+from collections import OrderedDict
+
+from instruments import wait_utils
 
 
 class DAQmxChannel:
 
+    # attributes that describe the configuration of the task, saved and restored with the pooled tasks
+    pooled_attrs = ['clock_src', 'clock_edge', 'trig_src', 'trig_edge', 'isTimed', 'read_all_samples']
+
     def __init__(self, dev, test=0):
 
         self.dev = dev
@@ -21,6 +27,16 @@ class DAQmxChannel:
         self.isTimed = False
         self.read_all_samples = False
 
+        self.t_start = 0.0  # time.perf_counter() when the task was last started
+        self.wait_overhead = 0.0  # time waited past the expected end in the last wait_until_done_thd
+
+        # Configured tasks that are kept around and switched with use_config() instead of reset() and reconfiguring
+        self.task_pool = OrderedDict()  # key -> (TaskHandle, pooled_attrs)
+        self.task_pool_size = 8
+        self.task_key = None  # key of the pooled task in self.th, None if self.th is not pooled
+        self.config_stats = OrderedDict()  # key -> [switches, time switching, creations, time creating]
+        self.reset_stats = [0, 0.0]  # [resets, time resetting]
+
     def create_task(self):
 
         self.th = pydaqmx.TaskHandle()
@@ -63,39 +79,127 @@ class DAQmxChannel:
         pydaqmx.DAQmxSetStartTrigRetriggerable(self.th, b)
 
     def start(self):
+        self.t_start = time.perf_counter()
         pydaqmx.DAQmxStartTask(self.th)
 
     def stop(self):
         pydaqmx.DAQmxStopTask(self.th)
-        pydaqmx.DAQmxTaskControl(self.th,pydaqmx.DAQmx_Val_Task_Unreserve)
+        if self.task_key is None:
+            pydaqmx.DAQmxTaskControl(self.th,pydaqmx.DAQmx_Val_Task_Unreserve)
+        # A pooled task stays committed until release_task() so that the next start() is cheap
 
     def wait_until_done(self):
         pydaqmx.DAQmxWaitUntilTaskDone(self.th, -1)
 
     def wait_until_done_thd(self, thd):
-        daqmx_running = 1
-        while daqmx_running != 0 and not thd.cancel:
-            try:
-                daqmx_running = pydaqmx.DAQmxWaitUntilTaskDone(self.th, 0)
-            except:
-                time.sleep(0.01)
-
-        if thd.cancel:
+        # Sleep through the expected duration of the task and only poll near the end
+        cancelled, self.wait_overhead = wait_utils.wait_adaptive(lambda: not self.is_task_done(),
+                                                                 self.expected_duration(), thd, self.t_start)
+        if cancelled:
             return 1
         else:
             return 0
 
-    # def is_task_done(self):
-        # int32 DAQmxIsTaskDone (TaskHandle taskHandle, bool32 *isTaskDone);
+    def is_task_done(self):
+        done = ctypes.c_uint32()
+        pydaqmx.DAQmxIsTaskDone(self.th, ctypes.byref(done))
+        return bool(done.value)
+
+    def expected_duration(self):
+        # Time from start() until the task is done, if known. Subclasses with a fixed duration override this.
+        return 0.0
 
     def clear_task(self):
         pydaqmx.DAQmxClearTask(self.th)
+        if self.task_key is not None:
+            self.task_pool.pop(self.task_key, None)
+            self.task_key = None
 
     def reset(self):
-        self.clear_task()
+        t_start = time.perf_counter()
+        self.release_task()
         self.create_task()
 
         self.isTimed = False
+        self.reset_stats[0] += 1
+        self.reset_stats[1] += time.perf_counter() - t_start
+
+    def use_config(self, key, configure=None):
+        '''Switch to the pooled task for key, a hashable description of the configuration.
+        The first time key is used, a new task is created and configure(self) sets it up (clocks, triggers, sources).
+        Afterwards the same committed task is reused, so switching only costs a stop/unreserve instead of clearing,
+        recreating and reconfiguring the task. The task should not be reconfigured outside of configure().
+        Returns True if the task was already in the pool.'''
+        t_start = time.perf_counter()
+        created = False
+        if key != self.task_key:
+            self.release_task()
+            if key in self.task_pool:
+                self.th, attrs = self.task_pool[key]
+                for k, v in attrs.items():
+                    setattr(self, k, v)
+                self.task_pool.move_to_end(key)
+            else:
+                self.create_task()
+                self.isTimed = False
+                if configure is not None:
+                    configure(self)
+                pydaqmx.DAQmxTaskControl(self.th, pydaqmx.DAQmx_Val_Task_Verify)
+                self.task_pool[key] = (self.th, self.get_pooled_attrs())
+                created = True
+
+                while len(self.task_pool) > self.task_pool_size:
+                    _, (th, _) = self.task_pool.popitem(last=False)
+                    pydaqmx.DAQmxClearTask(th)
+
+            self.task_key = key
+            try:
+                pydaqmx.DAQmxTaskControl(self.th, pydaqmx.DAQmx_Val_Task_Commit)
+            except pydaqmx.DAQmxFunctions.DAQError:
+                pass  # the resources are busy. start() will reserve them as usual.
+
+        stats = self.config_stats.setdefault(key, [0, 0.0, 0, 0.0])
+        if created:
+            stats[2] += 1
+            stats[3] += time.perf_counter() - t_start
+        else:
+            stats[0] += 1
+            stats[1] += time.perf_counter() - t_start
+
+        return not created
+
+    def release_task(self):
+        # Stop and unreserve the pooled task and keep it in the pool, or clear the task if it is not pooled.
+        # Either way there is no task in self.th afterwards until create_task() or use_config().
+        if self.task_key is None:
+            if self.th is not None:
+                self.clear_task()
+        else:
+            pydaqmx.DAQmxStopTask(self.th)
+            pydaqmx.DAQmxTaskControl(self.th, pydaqmx.DAQmx_Val_Task_Unreserve)
+            self.task_pool[self.task_key] = (self.th, self.get_pooled_attrs())
+            self.task_key = None
+        self.th = None
+
+    def get_pooled_attrs(self):
+        return dict((k, getattr(self, k)) for k in self.pooled_attrs if hasattr(self, k))
+
+    def clear_pool(self):
+        self.release_task()
+        self.create_task()
+        self.isTimed = False
+        for th, _ in self.task_pool.values():
+            pydaqmx.DAQmxClearTask(th)
+        self.task_pool.clear()
+
+    def print_config_stats(self):
+        # Time spent switching between pooled tasks compared to the time spent on reset()
+        if self.reset_stats[0]:
+            print('%s: %d resets, %.3f ms each' % (self.dev, self.reset_stats[0],
+                                                    self.reset_stats[1] / self.reset_stats[0] * 1e3))
+        for key, stats in self.config_stats.items():
+            print('%s %s: %d switches, %.3f ms each; created in %.3f ms' % (
+                self.dev, str(key), stats[0], stats[1] / max(stats[0], 1) * 1e3, stats[3] / max(stats[2], 1) * 1e3))
 
     # def __del__(self):
         # pydaqmx.DAQmxClearTask(self.th)
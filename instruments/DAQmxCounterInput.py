@@ -12,6 +12,14 @@ class DAQmxCounterInput(DAQmxChannel.DAQmxChannel):
         super().__init__(dev)
 
         self.ext_src = ''
+
+        # Reusable buffers for read_counts/read_diff, so that continuous reads do not allocate on every call
+        self.read_buffer = np.zeros(0, dtype=np.uint32)
+        self.diff_buffer = np.zeros(0, dtype=np.uint32)
+        self.read_chunk = 1000000  # most samples to ask for in one read of a continuous acquisition
+        self.last_count = None  # last cumulative count read by read_diff
+        self.samples_read = 0  # samples read by read_diff since reset_diff
+
         self.create_task()
 
     def create_task(self):
@@ -33,27 +41,73 @@ class DAQmxCounterInput(DAQmxChannel.DAQmxChannel):
         return val.value
 
     def get_counts(self, n, timeout=-1):
-        n = np.uint32(n)
-
         if self.clock_src == '':
             print('sample clock has not been set')
             return []
         else:
-            readarray = np.zeros(n, dtype=np.uint32)
-            readval = ctypes.c_int32()
-
-            if not self.read_all_samples:
-                pydaqmx.DAQmxReadCounterU32(self.th, n, timeout, readarray, n, readval, None)
-                if readval.value != n:
-                    print('could not read all the values')
-            else:
-                # Read all possible samples up to n samples
-                pydaqmx.DAQmxReadCounterU32(self.th, -1, timeout, readarray, n, readval, None)
-                if readval.value != n:
-                    # this is okay for the case of forced readout, just trim the readarray accordingly
-                    readarray = readarray[:readval.value]
+            return self.read_counts(n, timeout).copy()
+
+    def read_counts(self, n, timeout=-1):
+        '''Same as get_counts, but reads into a preallocated buffer and returns a view of it.
+        The view is overwritten by the next read_counts/read_diff.'''
+        n = np.uint32(n)
+
+        if self.clock_src == '':
+            print('sample clock has not been set')
+            return self.read_buffer[:0]
+
+        if len(self.read_buffer) < n:
+            self.read_buffer = np.zeros(n, dtype=np.uint32)
+        readarray = self.read_buffer[:n]
+        readval = ctypes.c_int32()
 
+        if not self.read_all_samples:
+            pydaqmx.DAQmxReadCounterU32(self.th, n, timeout, readarray, n, readval, None)
+            if readval.value != n:
+                print('could not read all the values')
             return readarray
+        else:
+            # Read all possible samples up to n samples
+            pydaqmx.DAQmxReadCounterU32(self.th, -1, timeout, readarray, n, readval, None)
+            # this is okay for the case of forced readout, just trim the readarray accordingly
+            return readarray[:readval.value]
+
+    def reset_diff(self, last_count=None):
+        # Start a new differenced readout. Without last_count, the first sample read is the starting count.
+        self.last_count = last_count
+        self.samples_read = 0
+
+    def read_diff(self, n, timeout=-1):
+        '''Read up to n samples with read_counts and return the counts in each sample period as a view of a
+        preallocated buffer (overwritten by the next read). The last cumulative count is carried over between reads,
+        so consecutive reads give a continuous trace. Right after reset_diff() the first sample is only used as the
+        starting count.'''
+        ctr_raw = self.read_counts(n, timeout)
+        k = len(ctr_raw)
+        self.samples_read += k
+
+        if len(self.diff_buffer) < k:
+            self.diff_buffer = np.zeros(max(k, len(self.read_buffer)), dtype=np.uint32)
+        if k == 0:
+            return self.diff_buffer[:0]
+
+        # uint32 subtraction takes care of the counter rolling over
+        if self.last_count is None:
+            ctr_diff = self.diff_buffer[:k - 1]
+            np.subtract(ctr_raw[1:], ctr_raw[:-1], out=ctr_diff)
+        else:
+            ctr_diff = self.diff_buffer[:k]
+            np.subtract(ctr_raw[:1], np.uint32(self.last_count), out=ctr_diff[:1])
+            np.subtract(ctr_raw[1:], ctr_raw[:-1], out=ctr_diff[1:])
+        self.last_count = ctr_raw[-1]
+
+        return ctr_diff
+
+    def get_avail_samples(self):
+        # number of samples in the buffer that can be read without waiting
+        val = ctypes.c_uint32()
+        pydaqmx.DAQmxGetReadAvailSampPerChan(self.th, ctypes.byref(val))
+        return val.value
 
     def set_pause_trigger(self, src):
         pydaqmx.DAQmxSetDigLvlPauseTrigSrc(self.th, src)
@@ -8,6 +8,8 @@ from instruments import DAQmxChannel
 
 class DAQmxCounterOutput(DAQmxChannel.DAQmxChannel):
 
+    pooled_attrs = DAQmxChannel.DAQmxChannel.pooled_attrs + ['freq']
+
     def __init__(self, dev, freq=1000):
         super().__init__(dev)
         self.freq = freq
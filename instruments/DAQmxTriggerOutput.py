@@ -8,6 +8,8 @@ from instruments import DAQmxChannel
 
 class DAQmxTriggerOutput(DAQmxChannel.DAQmxChannel):
 
+    pooled_attrs = DAQmxChannel.DAQmxChannel.pooled_attrs + ['trigtime']
+
     def __init__(self, dev, trigtime=0.001):
         super().__init__(dev)
         self.trigtime = trigtime
@@ -19,6 +21,14 @@ class DAQmxTriggerOutput(DAQmxChannel.DAQmxChannel):
 
         pydaqmx.DAQmxCreateCOPulseChanTime(self.th, self.dev, '', pydaqmx.DAQmx_Val_Seconds, pydaqmx.DAQmx_Val_Low, 10e-6, 10e-6, self.trigtime)
 
+    def expected_duration(self):
+        # initial delay and low time of 10 us each, then the pulse
+        return 20e-6 + self.trigtime
+
     def set_time(self,t):
-        self.trigtime = t
-        self.reset()
\ No newline at end of file
+        # One pooled task per pulse width, e.g. the sweep gate and the tracker PL gate
+        key = ('trigtime', t)
+        if key != self.task_key:
+            self.release_task()
+            self.trigtime = t  # create_task() uses it if the task is not in the pool yet
+            self.use_config(key)
\ No newline at end of file
@@ -1,5 +1,9 @@
 import pyvisa as vs
 import warnings
+import threading
+import queue
+import time
+from concurrent.futures import Future
 
 # Uncomment to enable exhaustive pyvisa debug output.
 # vs.log_to_screen()
@@ -9,6 +13,30 @@ class GPIBdev:
     def __init__(self, dev, **kwargs):
         self.dev = dev
         self.connected = False
+
+        # All the I/O goes through a queue to one worker thread per instrument, so that commands from different
+        # threads (GUI, sweeps, tracker) do not interleave, and checks can run while the instrument is idle.
+        self.io_queue = queue.Queue()
+        self.io_thread = None
+        self.io_lock = threading.Lock()
+        self.write_async = False  # True: gpib_write returns before the command is sent, see gpib_sync()
+        self.io_stats = {}  # 'write'/'query'/'read'/'call' -> [count, total time (s), max time (s)]
+
+        # Write-through cache of the values set through cache_set() (e.g. set_freq), so that the getters do not need
+        # a query after every set. cache_verify() reads the values that were set since the last check back from the
+        # instrument, all of them after a single *OPC?. The worker also does that by itself when the queue has been
+        # idle for verify_delay, at most once every verify_period (None: only cache_verify()).
+        self.cache_enable = True
+        self.cache_lock = threading.Lock()
+        self.cache = {}  # key -> value
+        self.cache_version = {}  # key -> number of sets, to skip checks that a newer set has overtaken
+        self.cache_unverified = {}  # key -> (query function, tolerance)
+        self.verify_delay = 0.2  # s
+        self.verify_period = 10.0  # s
+        self.verify_last = 0.0  # time.perf_counter() of the last check
+        self.cache_stats = [0, 0, 0]  # hits, verified, mismatches
+        self.cache_mismatch_log = []  # [(time.time(), key, value that was set, value read back)]
+
         rm = vs.ResourceManager()
 
         try:
@@ -24,8 +52,30 @@ class GPIBdev:
             self.connected = True
         except:
             warnings.warn('Dev %s not found.' % self.dev)
+        self.cache_clear()  # the instrument might have been reset in the meantime
 
     def gpib_write(self, str):
+        future = self.io_submit('write', self.io_write, str)
+        if self.write_async:
+            future.add_done_callback(self.io_warn)
+        else:
+            future.result()
+
+    def gpib_query(self, str):
+        return self.io_submit('query', self.io_query, str).result()
+
+    def gpib_read(self):
+        return self.io_submit('read', self.io_read).result()
+
+    def gpib_call(self, func, *args):
+        # run func(*args) (e.g. self.inst.write_binary_values) on the worker, in order with the queued commands
+        return self.io_submit('call', func, *args).result()
+
+    def gpib_sync(self):
+        # wait until the queued commands are sent and the instrument has executed them
+        return self.gpib_query('*OPC?')
+
+    def io_write(self, str):
         if self.connected:
             self.inst.write(str)
         else:
@@ -35,14 +85,158 @@ class GPIBdev:
             except:
                 warnings.warn('Cannot write to the instrument %s.' % self.dev)
 
-    def gpib_query(self, str):
+    def io_query(self, str):
         if self.connected:
             return self.inst.query(str)
         else:
             return -1
 
-    def gpib_read(self):
+    def io_read(self):
         if self.connected:
             return self.inst.read()
         else:
-            return -1
\ No newline at end of file
+            return -1
+
+    def io_submit(self, kind, func, *args):
+        # queue func(*args) and return a Future of its result
+        future = Future()
+        if threading.current_thread() is self.io_thread:
+            # already on the worker (e.g. a query of a cache check), queueing would deadlock
+            self.io_run(kind, func, args, future)
+            return future
+
+        with self.io_lock:
+            if self.io_thread is None or not self.io_thread.is_alive():
+                self.io_thread = threading.Thread(target=self.io_worker, name='GPIBdev %s' % self.dev, daemon=True)
+                self.io_thread.start()
+        self.io_queue.put((kind, func, args, future))
+        return future
+
+    def io_worker(self):
+        while True:
+            try:
+                kind, func, args, future = self.io_queue.get(timeout=self.verify_delay)
+            except queue.Empty:
+                if self.cache_unverified and self.verify_period is not None and \
+                        time.perf_counter() - self.verify_last >= self.verify_period:
+                    self.verify_cache(idle=True)
+                continue
+            if future.set_running_or_notify_cancel():
+                self.io_run(kind, func, args, future)
+
+    def io_run(self, kind, func, args, future):
+        t0 = time.perf_counter()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        dt = time.perf_counter() - t0
+
+        stats = self.io_stats.setdefault(kind, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += dt
+        stats[2] = max(stats[2], dt)
+
+    def io_warn(self, future):
+        # errors of writes that nobody waits for
+        if future.exception() is not None:
+            warnings.warn('Cannot write to the instrument %s: %s' % (self.dev, future.exception()))
+
+    def cache_set(self, key, val, query, tol=None):
+        '''Record that val was written for key. query() reads the value back from the instrument for the deferred
+        check, tol is the allowed absolute difference (default: relative 1e-6, e.g. for rounding by the instrument).'''
+        with self.cache_lock:
+            self.cache[key] = val
+            self.cache_version[key] = self.cache_version.get(key, 0) + 1
+            self.cache_unverified[key] = (query, tol)
+
+    def cache_get(self, key, query):
+        # the cached value of key, or query() the instrument if there is none
+        with self.cache_lock:
+            if self.cache_enable and key in self.cache:
+                self.cache_stats[0] += 1
+                return self.cache[key]
+            version = self.cache_version.get(key, 0)
+
+        val = query()
+        with self.cache_lock:
+            if self.cache_version.get(key, 0) == version:
+                self.cache[key] = val
+        return val
+
+    def cache_clear(self, key=None):
+        # forget the cached values (e.g. after a command that changes them as a side effect), all if key is None
+        with self.cache_lock:
+            keys = list(self.cache) if key is None else [key]
+            for k in keys:
+                self.cache.pop(k, None)
+                self.cache_unverified.pop(k, None)
+                self.cache_version[k] = self.cache_version.get(k, 0) + 1
+
+    def cache_verify(self):
+        '''Read back the values that were set since the last check, after the queued commands. Returns the
+        mismatches [(key, value that was set, value read back)]; the cache then holds the values read back.'''
+        return self.io_submit('call', self.verify_cache).result()
+
+    def verify_cache(self, idle=False):
+        # runs on the worker. idle: stop as soon as there are new commands, the rest is checked later
+        self.verify_last = time.perf_counter()
+        mismatches = []
+        with self.cache_lock:
+            pending = self.cache_unverified
+            self.cache_unverified = {}
+            versions = {key: self.cache_version.get(key, 0) for key in pending}
+
+        try:
+            self.io_query('*OPC?')  # the instrument has executed all the writes
+        except Exception as e:
+            warnings.warn('%s: *OPC? failed: %s' % (self.dev, e))
+
+        keys = list(pending)
+        for i, key in enumerate(keys):
+            if idle and not self.io_queue.empty():
+                # new commands have priority, check the rest later
+                with self.cache_lock:
+                    for k in keys[i:]:
+                        if k not in self.cache_unverified and self.cache_version.get(k, 0) == versions[k]:
+                            self.cache_unverified[k] = pending[k]
+                return mismatches
+
+            query, tol = pending[key]
+
+            try:
+                val = query()
+            except Exception as e:
+                warnings.warn('%s: cannot read back %s: %s' % (self.dev, key, e))
+                continue
+
+            with self.cache_lock:
+                if self.cache_version.get(key, 0) != versions[key]:
+                    continue  # set again in the meantime, the new value will be checked
+                cached = self.cache.get(key)
+                self.cache_stats[1] += 1
+                if not self.values_match(cached, val, tol):
+                    self.cache_stats[2] += 1
+                    self.cache_mismatch_log.append((time.time(), key, cached, val))
+                    mismatches.append((key, cached, val))
+                    warnings.warn('%s: %s is %s, but %s was set' % (self.dev, key, str(val), str(cached)))
+                self.cache[key] = val
+        return mismatches
+
+    @staticmethod
+    def values_match(a, b, tol=None):
+        try:
+            a, b = float(a), float(b)
+        except (TypeError, ValueError):
+            return a == b
+        if tol is None:
+            tol = 1e-6 * max(abs(a), abs(b)) + 1e-12
+        return abs(a - b) <= tol
+
+    def print_io_stats(self):
+        # time spent on each kind of I/O, and the queries saved by the cache
+        for kind, stats in self.io_stats.items():
+            print('%s %s: %d, %.3f ms each, %.3f ms max' % (self.dev, kind, stats[0],
+                                                           stats[1] / max(stats[0], 1) * 1e3, stats[2] * 1e3))
+        if any(self.cache_stats):
+            print('%s cache: %d hits, %d verified, %d mismatches' % ((self.dev,) + tuple(self.cache_stats)))
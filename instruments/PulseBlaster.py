@@ -5,6 +5,8 @@ Packaging pulse blaster functions into a class
 
 import ctypes
 
+from instruments import PulseBlasterSim
+
 
 def enum(**enums):
     """Helper function to create instructions container"""
@@ -15,13 +17,18 @@ class PBESRPro:
     constants={}
     PULSE_PROGRAM = 0
     
-    def __init__(self):
+    def __init__(self, sim=False):
         # load the spinapi which contains all the C functions
-        try:
-            self.spinapi = ctypes.CDLL("spinapi64")
-        except:
-            print("Failed to load spinapi library")
-            pass
+        # sim=True uses a simulated board instead, e.g. for testing pulse sequences without the hardware
+        self.sim = sim
+        if sim:
+            self.spinapi = PulseBlasterSim.SpinAPISim()
+        else:
+            try:
+                self.spinapi = ctypes.CDLL("spinapi64")
+            except:
+                print("Failed to load spinapi library")
+                pass
         
         # populate the constants
         self.constants = {'ns': 1.0, 'us': 1000.0, 'ms': 1000000.0}
@@ -40,45 +47,46 @@ class PBESRPro:
             RTI = 9
             )
             
-        # set the return and input argument types
-        self.spinapi.pb_get_version.restype = (ctypes.c_char_p)
-        self.spinapi.pb_get_error.restype = (ctypes.c_char_p)
-        self.spinapi.pb_read_status.restype = (ctypes.c_int)
+        if not sim:
+            # set the return and input argument types
+            self.spinapi.pb_get_version.restype = (ctypes.c_char_p)
+            self.spinapi.pb_get_error.restype = (ctypes.c_char_p)
+            self.spinapi.pb_read_status.restype = (ctypes.c_int)
 
 
-        self.spinapi.pb_count_boards.restype = (ctypes.c_int)
+            self.spinapi.pb_count_boards.restype = (ctypes.c_int)
 
-        self.spinapi.pb_init.restype = (ctypes.c_int)
+            self.spinapi.pb_init.restype = (ctypes.c_int)
 
-        self.spinapi.pb_select_board.argtype = (ctypes.c_int)
-        self.spinapi.pb_select_board.restype = (ctypes.c_int)
+            self.spinapi.pb_select_board.argtype = (ctypes.c_int)
+            self.spinapi.pb_select_board.restype = (ctypes.c_int)
 
-        self.spinapi.pb_set_debug.argtype = (ctypes.c_int)
-        self.spinapi.pb_set_debug.restype = (ctypes.c_int)
+            self.spinapi.pb_set_debug.argtype = (ctypes.c_int)
+            self.spinapi.pb_set_debug.restype = (ctypes.c_int)
 
-        self.spinapi.pb_set_defaults.restype = (ctypes.c_int)
+            self.spinapi.pb_set_defaults.restype = (ctypes.c_int)
 
-        self.spinapi.pb_core_clock.argtype = (ctypes.c_double)
-        self.spinapi.pb_core_clock.restype = (ctypes.c_int)
+            self.spinapi.pb_core_clock.argtype = (ctypes.c_double)
+            self.spinapi.pb_core_clock.restype = (ctypes.c_int)
 
-        self.spinapi.pb_start_programming.argtype = (ctypes.c_int)
-        self.spinapi.pb_start_programming.restype = (ctypes.c_int)
+            self.spinapi.pb_start_programming.argtype = (ctypes.c_int)
+            self.spinapi.pb_start_programming.restype = (ctypes.c_int)
 
-        self.spinapi.pb_stop_programming.restype = (ctypes.c_int)
+            self.spinapi.pb_stop_programming.restype = (ctypes.c_int)
 
-        self.spinapi.pb_start.restype = (ctypes.c_int)
-        self.spinapi.pb_stop.restype = (ctypes.c_int)
-        self.spinapi.pb_reset.restype = (ctypes.c_int)
-        self.spinapi.pb_close.restype = (ctypes.c_int)
+            self.spinapi.pb_start.restype = (ctypes.c_int)
+            self.spinapi.pb_stop.restype = (ctypes.c_int)
+            self.spinapi.pb_reset.restype = (ctypes.c_int)
+            self.spinapi.pb_close.restype = (ctypes.c_int)
 
-        self.spinapi.pb_inst_pbonly64.argtype = (
-            ctypes.c_uint,      # flags
-            ctypes.c_int,       # inst
-            ctypes.c_int,       # inst_data
-            ctypes.c_double,    # length (double)
-            )
+            self.spinapi.pb_inst_pbonly64.argtype = (
+                ctypes.c_uint,      # flags
+                ctypes.c_int,       # inst
+                ctypes.c_int,       # inst_data
+                ctypes.c_double,    # length (double)
+                )
 
-        self.spinapi.pb_inst_pbonly64.restype = (ctypes.c_int)
+            self.spinapi.pb_inst_pbonly64.restype = (ctypes.c_int)
 
     def pb_get_version(self):
         """Return library version as UTF-8 encoded string."""
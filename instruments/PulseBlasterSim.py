@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated spinapi library for running PulseBlaster programs without the hardware.
+Records the instructions, evaluates the LOOP/END_LOOP/BRANCH/STOP flow and builds the output timeline.
+"""
+
+import time
+import numpy as np
+
+
+# pb_read_status() bits
+STATUS_STOPPED = 1
+STATUS_RESET = 2
+STATUS_RUNNING = 4
+STATUS_WAITING = 8
+
+# op codes, same as PBESRPro.inst_set
+CONTINUE = 0
+STOP = 1
+LOOP = 2
+END_LOOP = 3
+JSR = 4
+RTS = 5
+BRANCH = 6
+LONG_DELAY = 7
+WAIT = 8
+RTI = 9
+
+
+def _value(x):
+    # arguments may come wrapped in ctypes types
+    return x.value if hasattr(x, 'value') else x
+
+
+def parse_program(program):
+    '''Build a tree of the program flow.
+    Returns (nodes, branch) where nodes is a list of instruction indices and ('loop', n, nodes) tuples, and
+    branch is True if the program ends with a BRANCH back to the first instruction (i.e. runs forever).'''
+
+    def parse_block(i, loop_start=None):
+        nodes = []
+        while i < len(program):
+            flags, op_code, inst_data, length = program[i]
+            if op_code == CONTINUE or op_code == LONG_DELAY:
+                nodes.append(i)
+                i += 1
+            elif op_code == LOOP:
+                # the LOOP instruction is the first instruction of the loop body
+                children, i_next = parse_block(i + 1, loop_start=i)
+                nodes.append(('loop', int(inst_data), [i] + children))
+                i = i_next
+            elif op_code == END_LOOP:
+                if loop_start is None or int(inst_data) != loop_start:
+                    raise RuntimeError('END_LOOP at instruction %d does not match a LOOP' % i)
+                nodes.append(i)
+                return nodes, i + 1
+            elif op_code == STOP or op_code == BRANCH:
+                if loop_start is not None:
+                    raise RuntimeError('STOP or BRANCH inside a LOOP is not supported')
+                if op_code == BRANCH and int(inst_data) != 0:
+                    raise RuntimeError('Only BRANCH to the first instruction is supported')
+                nodes.append(i)
+                return nodes, op_code
+            else:
+                raise RuntimeError('Unsupported command: JSR, RTS, WAIT, RTI not implemented')
+
+        if loop_start is not None:
+            raise RuntimeError('LOOP at instruction %d does not have END_LOOP' % loop_start)
+        return nodes, STOP  # running past the last instruction
+
+    nodes, end = parse_block(0)
+    return nodes, end == BRANCH
+
+
+def node_duration(program, nodes):
+    '''Total duration (ns) of a list of nodes from parse_program()'''
+    duration = 0.0
+    for node in nodes:
+        if isinstance(node, tuple):
+            duration += node[1] * node_duration(program, node[2])
+        else:
+            flags, op_code, inst_data, length = program[node]
+            if op_code == LONG_DELAY:
+                duration += length * inst_data
+            else:
+                duration += length
+    return duration
+
+
+def node_timeline(program, nodes, max_events):
+    '''Unrolled (flags, lengths) arrays of a list of nodes from parse_program(). Loops are expanded with np.tile.'''
+    flags_list = []
+    lengths_list = []
+    n_events = 0
+    for node in nodes:
+        if isinstance(node, tuple):
+            f, l = node_timeline(program, node[2], max_events)
+            if len(f) * node[1] + n_events > max_events:
+                raise MemoryError('Timeline is longer than %d events' % max_events)
+            f = np.tile(f, node[1])
+            l = np.tile(l, node[1])
+        else:
+            flags, op_code, inst_data, length = program[node]
+            if op_code == LONG_DELAY:
+                length = length * inst_data
+            f = np.array([flags], dtype=np.int64)
+            l = np.array([length], dtype=float)
+        flags_list.append(f)
+        lengths_list.append(l)
+        n_events += len(f)
+
+    if not flags_list:
+        return np.array([], dtype=np.int64), np.array([], dtype=float)
+    return np.concatenate(flags_list), np.concatenate(lengths_list)
+
+
+class SpinAPISim:
+    '''Drop-in replacement for the spinapi64 library used by PBESRPro'''
+
+    def __init__(self, realtime=True, max_events=10000000):
+        # realtime: pb_read_status() reports running until the simulated duration has passed
+        self.realtime = realtime
+        self.max_events = max_events
+
+        self.clock = 500.0  # MHz
+        self.programming = False
+        self.program = []  # [(flags, op_code, inst_data, length in ns)]
+        self.status = STATUS_STOPPED
+        self.t_start = 0.0
+        self.t_duration = 0.0  # duration of the running program in s
+        self.n_programmed = 0  # number of times the board was programmed, useful for profiling
+
+    def pb_get_version(self):
+        return b'simulated'
+
+    def pb_get_error(self):
+        return b''
+
+    def pb_count_boards(self):
+        return 1
+
+    def pb_init(self):
+        return 0
+
+    def pb_select_board(self, board_number):
+        return 0
+
+    def pb_set_debug(self, debug):
+        return 0
+
+    def pb_set_defaults(self):
+        return 0
+
+    def pb_core_clock(self, clock):
+        self.clock = _value(clock)
+        return 0
+
+    def pb_start_programming(self, target):
+        self.programming = True
+        self.program = []
+        return 0
+
+    def pb_stop_programming(self):
+        self.programming = False
+        self.n_programmed += 1
+        return 0
+
+    def pb_inst_pbonly64(self, flags, inst, inst_data, length):
+        if not self.programming:
+            raise RuntimeError('pb_start_programming() was not called')
+        self.program.append((int(_value(flags)), int(_value(inst)), int(_value(inst_data)), float(_value(length))))
+        return len(self.program) - 1
+
+    def pb_start(self):
+        self.status = STATUS_RUNNING
+        self.t_duration = self.duration() * 1e-9
+        self.t_start = time.perf_counter()
+        return 0
+
+    def pb_stop(self):
+        self.status = STATUS_STOPPED
+        return 0
+
+    def pb_reset(self):
+        self.status = STATUS_RESET
+        return 0
+
+    def pb_close(self):
+        return 0
+
+    def pb_read_status(self):
+        if self.status == STATUS_RUNNING:
+            if not self.realtime or time.perf_counter() - self.t_start >= self.t_duration:
+                self.status = STATUS_STOPPED
+        return self.status
+
+    def duration(self):
+        '''Duration of the loaded program in ns, inf if it ends with BRANCH'''
+        nodes, branch = parse_program(self.program)
+        if branch:
+            return np.inf
+        return node_duration(self.program, nodes)
+
+    def timeline(self, n_branch=1):
+        '''Unroll the loaded program.
+        Returns (t, flags): the start time (ns) of each change in the output flags and the flags from then on.
+        The last entry of t is the end of the program. A program ending with BRANCH is unrolled n_branch times.'''
+        nodes, branch = parse_program(self.program)
+        flags, lengths = node_timeline(self.program, nodes, self.max_events)
+        if branch:
+            flags = np.tile(flags, n_branch)
+            lengths = np.tile(lengths, n_branch)
+
+        t = np.concatenate(([0.0], np.cumsum(lengths)))
+        if not len(flags):
+            return t, flags
+
+        # merge consecutive instructions with the same output
+        change = np.concatenate(([True], flags[1:] != flags[:-1]))
+        return np.append(t[:-1][change], t[-1]), flags[change]
+
+    def edges(self, n_bits=24, n_branch=1):
+        '''Edge list of the loaded program: structured array of (time in ns, channel, level) sorted by time'''
+        t, flags = self.timeline(n_branch)
+        if not len(flags):
+            return np.zeros(0, dtype=[('t', float), ('ch', np.int32), ('level', np.int8)])
+
+        bits = (flags[:, None] >> np.arange(n_bits)) & 1
+        # the outputs are all low before the program starts
+        changes = np.diff(np.vstack((np.zeros((1, n_bits), dtype=bits.dtype), bits)), axis=0)
+        i_event, ch = np.nonzero(changes)
+
+        edge_list = np.zeros(len(i_event), dtype=[('t', float), ('ch', np.int32), ('level', np.int8)])
+        edge_list['t'] = t[i_event]
+        edge_list['ch'] = ch
+        edge_list['level'] = bits[i_event, ch]
+        return edge_list
+
+    def channel_edges(self, ch, n_branch=1):
+        '''Rising and falling edge times (ns) of a single output bit'''
+        edge_list = self.edges(n_bits=ch + 1, n_branch=n_branch)
+        edge_list = edge_list[edge_list['ch'] == ch]
+        return edge_list['t'][edge_list['level'] == 1], edge_list['t'][edge_list['level'] == 0]
@@ -1,9 +1,13 @@
 import instruments as instr
+from instruments import wait_utils
 import numpy as np
 import math as math
 import time
 import os
 import warnings
+import collections
+import copy
+import threading
 
 
 # Default function for self.pulse_func to hook on to
@@ -19,10 +23,226 @@ def default_seq_time():
     return [[0, 0]]  # [time, n_loops] For storing sequence time and loop information
 
 
+def freeze_params(params):
+    # Convert a parameter dictionary into a hashable tuple for use as a cache key
+    frozen = []
+    for k, v in sorted(params.items()):
+        if isinstance(v, (list, tuple, np.ndarray)):
+            v = tuple(np.array(v).flatten().tolist())
+        frozen.append((k, v))
+    return tuple(frozen)
+
+
+def flag_masks(pb_dict):
+    # Bitmask of each flag and of the inverted bits from pb_dict = {'pbnum': [], 'key': [], 'inv': []}
+    # If a bit is listed more than once, the last entry wins.
+    bit_entry = {}
+    for i, num in enumerate(pb_dict['pbnum']):
+        bit_entry[num] = i
+
+    key_mask = {}
+    inv_mask = 0
+    for num, i in bit_entry.items():
+        key = pb_dict['key'][i]
+        key_mask[key] = key_mask.get(key, 0) | (1 << num)
+        if pb_dict['inv'][i]:
+            inv_mask |= 1 << num
+    return key_mask, inv_mask
+
+
+def awg_program_equal(awg1, awg2):
+    # Compare two lists of [wfm_ch1, wfm_ch2] waveforms
+    if awg1 is awg2:
+        return True
+    if awg1 is None or awg2 is None or len(awg1) != len(awg2):
+        return False
+    for wfms1, wfms2 in zip(awg1, awg2):
+        for wfm1, wfm2 in zip(wfms1, wfms2):
+            if not np.array_equal(wfm1, wfm2):
+                return False
+    return True
+
+
+def extend_falling_edges(wfm, pts_extend):
+    # Extend the tail of every pulse in wfm by pts_extend samples, holding the last value of the pulse.
+    # If the gap to the next pulse is shorter than pts_extend, the gap is filled only if the next pulse has the
+    # same value. Otherwise the processing stops at that edge, the same as the original sample-by-sample loop.
+    wfm = np.asarray(wfm)
+    n = len(wfm)
+    if n < 2:
+        return wfm
+
+    nonzero = wfm != 0
+    falling = np.flatnonzero(nonzero[:-1] & ~nonzero[1:])  # last sample of each pulse
+    if not len(falling):
+        return wfm
+    rising = np.flatnonzero(~nonzero[:-1] & nonzero[1:]) + 1  # first sample of each pulse
+
+    # first sample of the next pulse after each falling edge, n if there is none
+    next_idx = np.searchsorted(rising, falling, side='right')
+    next_start = np.append(rising, n)[next_idx]
+    gap = next_start - falling - 1
+
+    fits = (gap >= pts_extend) | (next_start == n)
+    fill_len = np.where(fits, np.minimum(pts_extend, gap), gap)
+
+    overlap = ~fits & (wfm[np.minimum(next_start, n - 1)] != wfm[falling])
+    if overlap.any():
+        print('blank time not long enough between changes')
+        # skip out at the first bad edge
+        last = np.argmax(overlap)
+        falling = falling[:last]
+        fill_len = fill_len[:last]
+
+    total = np.sum(fill_len)
+    if total:
+        # indices of all the filled samples, built run-length style
+        offsets = np.cumsum(fill_len) - fill_len
+        fill_idx = np.arange(total) - np.repeat(offsets, fill_len) + np.repeat(falling + 1, fill_len)
+        wfm[fill_idx] = np.repeat(wfm[falling], fill_len)
+
+    return wfm
+
+
+def extend_falling_edges_loop(wfm, pts_extend):
+    # Original sample-by-sample implementation of extend_falling_edges(). Kept as a reference for benchmarking.
+    i = 0
+
+    while i < len(wfm):
+        if wfm[i] != 0 and wfm[i + 1] == 0:
+            # falling edge. do something
+            if not wfm[i + 1:i + pts_extend + 1].any():
+                wfm[i + 1:i + pts_extend + 1] = wfm[i]
+                i = i + pts_extend + 1
+            else:
+                j = 0
+                while j < pts_extend and wfm[i + j + 1] == 0:
+                    j += 1
+                if wfm[i + j + 1] == wfm[i]:
+                    # this is okay. the IQ value are still the same
+                    wfm[i + 1:i + j + 1] = wfm[i]
+                    i = i + j + 1
+                else:
+                    print('blank time not long enough between changes')
+                    # error and skip out
+                    i = len(wfm)
+        else:
+            i += 1
+
+    return wfm
+
+
+def merge_runs(values, lengths):
+    # Drop empty runs and merge neighbouring runs with the same value
+    values = np.asarray(values, dtype=float)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    keep = lengths > 0
+    values = values[keep]
+    lengths = lengths[keep]
+    if not len(values):
+        return values, lengths
+
+    starts = np.flatnonzero(np.concatenate(([True], values[1:] != values[:-1])))
+    return values[starts], np.add.reduceat(lengths, starts)
+
+
+def extend_falling_edges_runs(values, lengths, pts_extend):
+    # Same as extend_falling_edges() but on a run-length waveform (values[k] repeated lengths[k] times).
+    # The runs must be merged with merge_runs() first. Returns the new lengths.
+    lengths = lengths.copy()
+    if len(values) < 2:
+        return lengths
+
+    # nonzero run followed by a zero run
+    falling = np.flatnonzero((values[:-1] != 0) & (values[1:] == 0))
+    if not len(falling):
+        return lengths
+
+    gap = lengths[falling + 1]
+    has_next = falling + 2 < len(values)
+
+    fits = (gap >= pts_extend) | ~has_next
+    fill_len = np.where(fits, np.minimum(pts_extend, gap), gap)
+
+    next_value = values[np.minimum(falling + 2, len(values) - 1)]
+    overlap = ~fits & (next_value != values[falling])
+    if overlap.any():
+        print('blank time not long enough between changes')
+        # skip out at the first bad edge
+        last = np.argmax(overlap)
+        falling = falling[:last]
+        fill_len = fill_len[:last]
+
+    lengths[falling] += fill_len
+    lengths[falling + 1] -= fill_len
+    return lengths
+
+
+def render_runs(values, lengths, downsamp_ratio=1, n_pad=0, out=None):
+    # Render a run-length waveform sampled every downsamp_ratio points, i.e. the same as
+    # np.repeat(values, lengths)[::downsamp_ratio], followed by n_pad zeros. The full resolution waveform is never
+    # built. If out is given, the waveform is written into this preallocated buffer (which must be large enough).
+    boundaries = np.cumsum(lengths)
+    # number of output samples up to each boundary is ceil(boundary / downsamp_ratio)
+    counts = np.diff(np.concatenate(([0], -(-boundaries // downsamp_ratio))))
+    n_pts = int(np.sum(counts))
+
+    if out is None:
+        out = np.zeros(n_pts + n_pad)
+    else:
+        out = out[:n_pts + n_pad]
+        out[n_pts:] = 0.0
+    out[:n_pts] = np.repeat(values, counts)
+    return out
+
+
+def benchmark_expand_awg_pulse(sizes=(10000, 100000, 1000000), n_repeat=5, pts_extend=100):
+    # Print the per-call time of extend_falling_edges() for dynamical-decoupling-like waveforms of different
+    # lengths, checking the output against the original loop.
+    rng = np.random.default_rng(0)
+    for size in sizes:
+        wfm = np.zeros(size)
+        # pulses of 20-60 ns separated by gaps of 100-400 ns
+        i = 32
+        while i < size - 600:
+            width = rng.integers(20, 60)
+            wfm[i:i + width] = rng.choice([-250.0, 250.0])
+            i += width + rng.integers(pts_extend, 4 * pts_extend)
+
+        t0 = time.perf_counter()
+        for _ in range(n_repeat):
+            wfm_fast = extend_falling_edges(wfm.copy(), pts_extend)
+        dt_fast = (time.perf_counter() - t0) / n_repeat
+
+        t0 = time.perf_counter()
+        wfm_loop = extend_falling_edges_loop(wfm.copy(), pts_extend)
+        dt_loop = time.perf_counter() - t0
+
+        # same waveform as run-length segments
+        edges = np.flatnonzero(np.diff(wfm)) + 1
+        starts = np.concatenate(([0], edges))
+        values = wfm[starts]
+        lengths = np.diff(np.concatenate((starts, [size])))
+
+        t0 = time.perf_counter()
+        for _ in range(n_repeat):
+            values_merged, lengths_merged = merge_runs(values, lengths)
+            lengths_ext = extend_falling_edges_runs(values_merged, lengths_merged, pts_extend)
+            wfm_runs = render_runs(values_merged, lengths_ext)
+        dt_runs = (time.perf_counter() - t0) / n_repeat
+
+        print('%8d samples: %8.3f ms per call, %8.3f ms per call on segments (loop %9.3f ms), identical output: %s'
+              % (size, dt_fast * 1e3, dt_runs * 1e3, dt_loop * 1e3,
+                 np.array_equal(wfm_fast, wfm_loop) and np.array_equal(wfm_runs, wfm_loop)))
+
+
 class PulseMaster(instr.PulseBlaster.PBESRPro):
 
-    def __init__(self, awg=[], pb_dict={}):
-        super().__init__()
+    def __init__(self, awg=[], pb_dict={}, sim=False):
+        super().__init__(sim)
+        self.awg = awg
+        self.loaded_program = None
+        self.loaded_awg = None
         self.pb_init()
         self.pb_core_clock(500 * self.constants['MHz'])
 
@@ -30,15 +250,29 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
         self.pb_dict = pb_dict
         self.tracker_laser = ['green']
 
+        # Compiled programs: the instructions are recorded in inst_list and only pushed to the board in
+        # stop_programming() if they differ from what is already loaded. set_program() keeps an LRU cache of
+        # compiled programs keyed by the pulse parameters so that repeated sweep points skip the rebuild.
+        self.inst_list = []  # [(flags, op_code, inst_data, length in ns)]
+        self.awg_program = None  # [[wfm_ch1, wfm_ch2]] for each awg, or None if the awg is not used
+        self.program_cache = collections.OrderedDict()
+        self.program_cache_size = 32
+        self.program_cache_lock = threading.Lock()  # compile_program() may run on a worker thread
+        self.defer_load = False  # (True) stop_programming() only records the program, e.g. in compile_program()
+
+        # Lookup tables for get_flag_num() when pb_dict is set
+        self.flag_key_mask, self.flag_inv_mask = flag_masks(self.pb_dict) if self.pb_dict else ({}, 0)
+        self.flag_num_cache = collections.OrderedDict()  # frozenset(flag_list): flag_num
+        self.flag_num_cache_size = 256
+
         self.pulse_list = default_pulse_list()
         self.update_pulse_list()
         self.pulse_func = pb_default
         self.pulse_name = 'default'
 
         # Store the references to AWGs so that they can be programmed
-        self.awg = awg
         for awgnum in range(len(self.awg)):
-            setattr(self, 'awg_wfm%d' % awgnum, [np.array([]), np.array([])])
+            setattr(self, 'awg_wfm%d' % awgnum, [])  # [(value_i, value_q, n_samples)]
         self.awg_enable = False
         self.awg_srate = 250e6
         self.custom_readout = False
@@ -70,6 +304,8 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
 
         self.inst_num = 0  # Keep track of instruction number
         self.seq_time = default_seq_time()
+        self.t_start = 0.0  # time.perf_counter() when the board was last started
+        self.wait_overhead = 0.0  # time waited past the expected end of the sequence in the last wait_until_finished
 
         self.params = self.default_params()
         self.isINV = False
@@ -80,11 +316,15 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
 
     def set_pb_dict(self, d):
         self.pb_dict = d
+        self.flag_key_mask, self.flag_inv_mask = flag_masks(d) if d else ({}, 0)
+        self.flag_num_cache.clear()
+        self.clear_program_cache()
 
     # Get all the pulse list from the different python files
     # todo: add option to disable some files and migrate file locations to exp_config
     def update_pulse_list(self, log=False):
         self.pulse_list = default_pulse_list()
+        self.clear_program_cache()  # pulse definitions might have changed
         # Assume the mainexp is running in the root directory
         pb_func_dir = os.path.join(os.getcwd(), 'pb_functions')
 
@@ -157,10 +397,104 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
             print('Key '+key+' not found!')
 
     def set_program(self, autostart=True, infinite=False):
-        if not self.newctr:
-            self.set_program_oldctr(autostart, infinite)
+        if self.params_readoutcal_enable:
+            for key in self.readout_params.keys():
+                self.readout_params[key] = self.params[key]
+
+        key = self.program_key(infinite)
+        with self.program_cache_lock:
+            program = self.program_cache.get(key)
+            if program is not None:
+                self.program_cache.move_to_end(key)
+
+        if program is not None:
+            # Same parameters as a previous call, skip the sequence builder
+            self.seq_time = [list(t) for t in program['seq_time']]
         else:
-            self.set_program_newctr(autostart, infinite)
+            defer_load = self.defer_load
+            self.defer_load = True
+            try:
+                if not self.newctr:
+                    self.set_program_oldctr(autostart=False, infinite=infinite)
+                else:
+                    self.set_program_newctr(autostart=False, infinite=infinite)
+            finally:
+                self.defer_load = defer_load
+            program = self.compiled_program()
+
+            with self.program_cache_lock:
+                self.program_cache[key] = program
+                while len(self.program_cache) > self.program_cache_size:
+                    self.program_cache.popitem(last=False)
+
+        if not self.defer_load:
+            self.load_program(program)
+        if autostart:
+            self.start()
+
+    def compile_program(self, params=None, infinite=False):
+        '''Build the program for params (default: self.params) into the program cache without touching the hardware
+        or the state of this object. Used to prepare the next sweep point on a worker thread.'''
+        pm = copy.copy(self)
+        pm.params = dict(self.params if params is None else params)
+        pm.readout_params = dict(self.readout_params)
+        pm.flag_num_cache = collections.OrderedDict()  # get_flag_num reorders the cache, do not share it across threads
+        for awgnum in range(len(self.awg)):
+            setattr(pm, 'awg_wfm%d' % awgnum, [])
+        pm.defer_load = True
+        pm.set_program(autostart=False, infinite=infinite)
+        return pm.seq_time
+
+    def program_key(self, infinite=False):
+        # pulse_func rather than pulse_name: a failed set_pulse() changes one but not the other
+        return (self.pulse_func, freeze_params(self.params), freeze_params(self.readout_params),
+                self.isINV, self.isINV2, self.newctr, infinite, self.awg_enable, self.custom_readout,
+                self.params_readoutcal_enable, self.awg_srate)
+
+    def clear_program_cache(self):
+        with self.program_cache_lock:
+            self.program_cache.clear()
+
+    def compiled_program(self):
+        return {'inst': tuple(self.inst_list),
+                'awg': self.awg_program,
+                'seq_time': [list(t) for t in self.seq_time]}
+
+    def load_program(self, program):
+        # Only talk to the hardware if the program differs from what is already loaded
+        if any(getattr(awg, 'reconnected', False) for awg in self.awg):
+            self.invalidate_loaded_program()
+        if self.loaded_program is None or program['inst'] != self.loaded_program['inst']:
+            self.pb_start_programming(self.PULSE_PROGRAM)
+            for inst in program['inst']:
+                self.pb_inst_pbonly64(*inst)
+            self.pb_stop_programming()
+
+        if program['awg'] is not None and not awg_program_equal(program['awg'], self.loaded_awg):
+            self.load_awg(program['awg'])
+
+        self.loaded_program = program
+
+    def invalidate_loaded_program(self):
+        # Force the next program to be written to the hardware, e.g. after the board or awg has been reset
+        self.loaded_program = None
+        self.loaded_awg = None
+        for awg in self.awg:
+            if hasattr(awg, 'reset_state'):
+                awg.reset_state()
+
+    def pb_init(self):
+        # (re)connecting to the board, e.g. after pb_close()
+        self.invalidate_loaded_program()
+        return super().pb_init()
+
+    def pb_reset(self):
+        self.invalidate_loaded_program()
+        return super().pb_reset()
+
+    def pb_close(self):
+        self.invalidate_loaded_program()
+        return super().pb_close()
 
     def set_program_oldctr(self, autostart=True, infinite=False):
         '''
@@ -354,7 +688,7 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
                     self.add_inst(['green'], self.inst_set.STOP, 0, 1e-6)
 
         if self.awg_enable:
-            self.set_awg(delay=time_dark+awg_offset)
+            self.awg_program = self.compile_awg(delay=time_dark+awg_offset)
 
         # Make sure PB stops correctly in the case where user does not end with BRANCH or STOP. Useful for PLE Pulsed
         self.add_inst([], self.inst_set.STOP, 0, 1e-6)
@@ -600,19 +934,33 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
                     self.add_inst(['green'], self.inst_set.STOP, 0, 1e-6)
 
             if self.awg_enable:
-                self.set_awg(delay=time_dark + awg_offset)
+                self.awg_program = self.compile_awg(delay=time_dark + awg_offset)
 
         self.stop_programming()
         if autostart:
             self.start()
 
     def set_awg(self, delay=0.0):
+        self.load_awg(self.compile_awg(delay))
+
+    def compile_awg(self, delay=0.0):
+        awg_program = []
         for num in range(len(self.awg)):
-            awg_wfm = getattr(self, 'awg_wfm%d' % num)
+            # segments of (value_i, value_q, n_samples) at 1 GS/s
+            awg_wfm = np.array(getattr(self, 'awg_wfm%d' % num), dtype=float).reshape(-1, 3)
             awg_amplitude = 350.0  # mV
 
-            wfm1_norm = self.awg_norm_pulse(awg_wfm[0], awg_amplitude, delay)
-            wfm2_norm = self.awg_norm_pulse(awg_wfm[1], awg_amplitude, delay)
+            lengths = awg_wfm[:, 2].astype(np.int64)
+            wfm1_norm = self.awg_norm_pulse(awg_wfm[:, 0], lengths, awg_amplitude, delay)
+            wfm2_norm = self.awg_norm_pulse(awg_wfm[:, 1], lengths, awg_amplitude, delay)
+            awg_program.append([wfm1_norm, wfm2_norm])
+        return awg_program
+
+    def load_awg(self, awg_program):
+        failed = False
+        for num in range(len(self.awg)):
+            [wfm1_norm, wfm2_norm] = awg_program[num]
+            awg_amplitude = 350.0  # mV
 
             self.awg[num].set_output(0)
 
@@ -621,21 +969,24 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
             ch2_min = min(wfm2_norm) * awg_amplitude / 1000.0
             ch2_max = max(wfm2_norm) * awg_amplitude / 1000.0
 
-            if not (ch1_min == 0 and ch1_max == 0):
-                self.awg[num].set_wfm(1, wfm1_norm, sampl=self.awg_srate)
+            use_wfm1 = not (ch1_min == 0 and ch1_max == 0)
+            if use_wfm1 and not self.awg[num].set_wfm(1, wfm1_norm, sampl=self.awg_srate):
+                use_wfm1 = False  # not uploaded: output DC instead of whatever was selected before
+                failed = True
+            if use_wfm1:
                 self.awg[num].set_amplitude_wfm(1, ch1_min, ch1_max)
                 self.awg[num].set_triggered(1, 1)
             else:  # just set DC
                 self.awg[num].set_triggered(1, 0)  # cannot burst DC
                 self.awg[num].set_func(1, 'DC')
                 self.awg[num].set_dc(1, 0.0)
-            error = self.awg[num].get_error()
-            if error:
-                print('AWG%d, ch%d error:' % (num + 1, 1))
-                print(error)
+            errors = [self.awg[num].get_error_async()]  # checked while channel 2 is programmed
 
-            if not (ch2_min == 0 and ch2_max == 0):
-                self.awg[num].set_wfm(2, wfm2_norm, sampl=self.awg_srate)
+            use_wfm2 = not (ch2_min == 0 and ch2_max == 0)
+            if use_wfm2 and not self.awg[num].set_wfm(2, wfm2_norm, sampl=self.awg_srate):
+                use_wfm2 = False  # not uploaded: output DC instead of whatever was selected before
+                failed = True
+            if use_wfm2:
                 self.awg[num].set_amplitude_wfm(2, ch2_min, ch2_max)
                 self.awg[num].set_triggered(2, 1)
             else:  # just set DC
@@ -646,73 +997,57 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
             if not (ch1_min == 0 and ch1_max == 0) or not (ch2_min == 0 and ch2_max == 0):
                 self.awg[num].set_view('DUAL')
 
-            error = self.awg[num].get_error()
-            if error:
-                print('AWG%d, ch%d error:' % (num + 1, 2))
-                print(error)
+            errors.append(self.awg[num].get_error_async())
+
+            for ch, error in enumerate(errors):
+                error = error.result()
+                if error:
+                    print('AWG%d, ch%d error:' % (num + 1, ch + 1))
+                    print(error)
+                    failed = True
 
             self.awg[num].set_output(1)
 
-    def awg_norm_pulse(self, wfm, awg_amplitude, delay=0.0):
+        self.loaded_awg = awg_program if not failed else None  # try again the next time
+
+    def awg_norm_pulse(self, values, lengths, awg_amplitude, delay=0.0):
+        # values, lengths: run-length waveform with 1 ns resolution
 
         pts_delay = int(round(delay*1e9))
 
-        wfm = np.append(np.array([0.0]*(32+pts_delay)), wfm)  # guarantees the waveform starts at zero with at least 32 points
-        wfm = np.append(wfm, np.array([0.0]*32*4))  # guarantees the waveform ends at zero with at least 32 points
+        # guarantees the waveform starts at zero with at least 32 points and ends at zero with at least 32 points
+        values = np.concatenate(([0.0], values, [0.0]))
+        lengths = np.concatenate(([32+pts_delay], lengths, [32*4]))
 
         awg_preedge = self.readout_params['awg_preedge']
         awg_postedge = self.readout_params['awg_postedge']
 
-        wfm = self.expand_awg_pulse(wfm, awg_preedge, awg_postedge)
+        wfm = self.expand_awg_pulse(values, lengths, awg_preedge, awg_postedge)
 
-        wfm_norm = wfm / awg_amplitude
-        return wfm_norm
+        wfm /= awg_amplitude
+        return wfm
 
-    def expand_awg_pulse(self, wfm, t_pre, t_post):
-        # take a numpy array with 1 GS/s sampling rate, extend each pulse tails by 100 ns (10 samples)
+    def expand_awg_pulse(self, values, lengths, t_pre, t_post):
+        # take a run-length waveform with 1 GS/s sampling rate, extend each pulse tails by t_pre + t_post
         # raise error if there is any overlap
-        # downsample to the correct srate at the end
+        # render at the awg_srate at the end
 
         srate = 1e9
         pts_pre = round(t_pre * srate)
         pts_extend = round((t_pre + t_post) * srate)
 
-        i = 0
+        values, lengths = merge_runs(values, lengths)
+        lengths = extend_falling_edges_runs(values, lengths, pts_extend)
 
-        while i < len(wfm):
-            if wfm[i] != 0 and wfm[i + 1] == 0:
-                # falling edge. do something
-                if not wfm[i + 1:i + pts_extend + 1].any():
-                    wfm[i + 1:i + pts_extend + 1] = wfm[i]
-                    i = i + pts_extend + 1
-                else:
-                    j = 0
-                    while j < pts_extend and wfm[i + j + 1] == 0:
-                        j += 1
-                    if wfm[i + j + 1] == wfm[i]:
-                        # this is okay. the IQ value are still the same
-                        wfm[i + 1:i + j + 1] = wfm[i]
-                        i = i + j + 1
-                    else:
-                        print('blank time not long enough between changes')
-                        # error and skip out
-                        i = len(wfm)
+        if pts_pre > 0:
+            if len(values) and values[0] == 0 and lengths[0] >= pts_pre:
+                lengths[0] -= pts_pre
             else:
-                i += 1
-
-        # print(len(wfm))
-        if not wfm[0:pts_pre].any():
-            wfm = wfm[pts_pre:]
-        else:
-            print('waveform does not have enough zeros at the beginning')
-        # print(len(wfm))
+                print('waveform does not have enough zeros at the beginning')
 
-        # now downsample the waveform to the awg_srate
+        # now render the waveform directly at the awg_srate
         downsamp_ratio = round(1e9/self.awg_srate)
-        wfm = wfm[::downsamp_ratio]
-        wfm = np.append(wfm, np.array([0.0]*32))
-
-        return wfm
+        return render_runs(values, lengths, downsamp_ratio, n_pad=32)
 
     def test(self):
         self.start_programming()
@@ -737,6 +1072,17 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
         self.stop_programming()
         self.start()
 
+    def set_cw_alternate(self, flags_a, flags_b, period=20e-6, deadtime=1e-6):
+        # Repeats flags_a and flags_b for half of period each, e.g. to gate two counters with MW off and on.
+        # The counter flags (ctr*) are left out for the first deadtime of each half while the MW switches.
+        half = period / 2
+        self.start_programming()
+        for i, flags in enumerate([flags_a, flags_b]):
+            self.add_inst([f for f in flags if not f.startswith('ctr')], self.inst_set.CONTINUE, 0, deadtime)
+            self.add_inst(flags, self.inst_set.CONTINUE if i == 0 else self.inst_set.BRANCH, 0, half - deadtime)
+        self.stop_programming()
+        self.start()
+
     def set_cw_mw(self):
         self.start_programming()
         self.add_inst(['green', 'mw1'], self.inst_set.CONTINUE, 0, 1e-6)
@@ -746,8 +1092,8 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
 
     def set_static(self, pbflags_dec):
         self.start_programming()
-        self.pb_inst_pbonly64(pbflags_dec, self.inst_set.CONTINUE, 0, 1000)
-        self.pb_inst_pbonly64(pbflags_dec, self.inst_set.BRANCH, 0, 1000)
+        self.record_inst(pbflags_dec, self.inst_set.CONTINUE, 0, 1000)
+        self.record_inst(pbflags_dec, self.inst_set.BRANCH, 0, 1000)
         self.stop_programming()
         self.start()
 
@@ -760,9 +1106,11 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
                     print('Pulse Duration too short!')
                     print(inst_length*1e9,flag_list,op_code)
                     raise ValueError('PulseBlaster instruction shorter than 10 ns')
-                self.inst_num = self.pb_inst_pbonly64(flag_num, op_code, int(inst_data), inst_length * 1e9)
+                self.inst_num = self.record_inst(flag_num, op_code, int(inst_data), inst_length * 1e9)
 
-                if op_code == self.inst_set.CONTINUE:
+                if len(self.seq_time) == 1 and self.seq_time[0][1] in [self.inst_set.STOP, self.inst_set.BRANCH]:
+                    pass  # The program has already ended. This instruction is never reached, e.g. a second STOP.
+                elif op_code == self.inst_set.CONTINUE:
                     self.seq_time[-1][0] += inst_length
                 elif op_code == self.inst_set.LOOP:
                     self.seq_time.append([inst_length, int(inst_data)])
@@ -786,6 +1134,11 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
             # add_inst_awg calls back to this add_inst with awgblank=False
             return self.add_inst_awg([], [], inst_length, customflags=flag_list, op_code=op_code, inst_data=inst_data)
 
+    def record_inst(self, flag_num, op_code, inst_data, inst_length_ns):
+        # Same signature as pb_inst_pbonly64. Returns the instruction number.
+        self.inst_list.append((flag_num, op_code, inst_data, inst_length_ns))
+        return len(self.inst_list) - 1
+
     def add_inst_awg(self, awglist, awgval, inst_length, customflags=None, op_code=None, inst_data=None, awgonly=False):
         '''
         awglist: a list containing the AWG names
@@ -823,11 +1176,9 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
                         mwname = self.awg[awgnum].alias.replace('awg', 'mw')
                         if mwname not in flag_list:
                             flag_list.append(mwname)
-                    awg_wfm[0] = np.append(awg_wfm[0], np.array([awgval[index][0]] * awg_pts))
-                    awg_wfm[1] = np.append(awg_wfm[1], np.array([awgval[index][1]] * awg_pts))
+                    awg_wfm.append((awgval[index][0], awgval[index][1], awg_pts))
                 else:
-                    awg_wfm[0] = np.append(awg_wfm[0], np.array([0] * awg_pts))
-                    awg_wfm[1] = np.append(awg_wfm[1], np.array([0] * awg_pts))
+                    awg_wfm.append((0, 0, awg_pts))
 
             if not awgonly:
                 if op_code is None or inst_data is None:
@@ -837,7 +1188,7 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
 
     def clear_inst_awg(self):
         for awgnum in range(len(self.awg)):
-            setattr(self, 'awg_wfm%d' % awgnum, [np.array([]), np.array([])])
+            setattr(self, 'awg_wfm%d' % awgnum, [])  # [(value_i, value_q, n_samples)]
 
     def get_flag_num(self, flag_list, add=False):
         if not self.pb_dict:
@@ -867,56 +1218,79 @@ class PulseMaster(instr.PulseBlaster.PBESRPro):
             if 'ctr3' in flag_list:
                 flag_num += pow(2, 11)
         else:
-            _pbnum = self.pb_dict['pbnum']
-            _key = self.pb_dict['key']
-            _inv = self.pb_dict['inv']
-
-            if flag_list:
-                unknown_flags = [flag for flag in flag_list if flag and flag not in _key]
-                if unknown_flags:
-                    print('Unknown flags: check pb_dict.csv')
-                    print(unknown_flags)
-
-            # This is written in a very dumb way. If anyone reads this, please try to clean it up. -Peace 09/19/17
-            # create an array of zeros up to the max digit
-            reversed_bin = [0] * (np.max(_pbnum) + 1)
-            # for any bit defined in the dict, set that bit
-            for i, num in enumerate(_pbnum):
-                # bit value = (key in flaglist) XOR inv
-                reversed_bin[num] = int(bool(_key[i] in flag_list) != bool(_inv[i]))
-
-            pb_bin = reversed_bin[::-1]  # reverse the bits
-            pb_bin = map(str, pb_bin)  # convert to string
-            pb_bin = ''.join(pb_bin)
-
-            flag_num = int(pb_bin, 2)
+            flags = frozenset(flag_list)
+            flag_num = self.flag_num_cache.get(flags)
+            if flag_num is not None:
+                self.flag_num_cache.move_to_end(flags)
+                return flag_num
+
+            unknown_flags = [flag for flag in flag_list if flag and flag not in self.flag_key_mask]
+            if unknown_flags:
+                print('Unknown flags: check pb_dict.csv')
+                print(unknown_flags)
+
+            # bit value = (key in flag_list) XOR inv
+            flag_num = self.flag_inv_mask
+            for flag in flags:
+                flag_num ^= self.flag_key_mask.get(flag, 0)
+
+            self.flag_num_cache[flags] = flag_num
+            if len(self.flag_num_cache) > self.flag_num_cache_size:
+                self.flag_num_cache.popitem(last=False)
         return flag_num
 
+    def check_seq_time(self, rtol=1e-9):
+        # Compare seq_time with the duration of the program evaluated by the simulated board
+        if not self.sim:
+            raise RuntimeError('check_seq_time() requires PulseMaster(sim=True)')
+
+        sim_time = self.spinapi.duration() * 1e-9
+        if self.seq_time[0][1] == self.inst_set.BRANCH:
+            seq_time = np.inf
+        else:
+            seq_time = self.seq_time[0][0]
+
+        if not (sim_time == seq_time or math.isclose(sim_time, seq_time, rel_tol=rtol)):
+            warnings.warn('seq_time %e s does not match the simulated duration %e s' % (seq_time, sim_time))
+        return [seq_time, sim_time]
+
+    def is_running(self):
+        return self.pb_read_status() == 4
+
+    def expected_duration(self):
+        # Duration of the loaded sequence from seq_time. inf if it runs forever.
+        if self.seq_time[0][1] == self.inst_set.BRANCH:
+            return np.inf
+        return self.seq_time[0][0]
+
     def wait_until_finished(self):
-        while self.pb_read_status() == 4:  # while PulseBlaster is running
-            time.sleep(0.1)
+        self.wait_until_finished_thd(None)
 
     def wait_until_finished_thd(self, thread_esr):
-        while self.pb_read_status() == 4 and not thread_esr.cancel:  # while PulseBlaster is running
-            time.sleep(0.1)
-        if thread_esr.cancel:
+        # Sleep through the sequence and only poll the board near the expected end
+        cancelled, self.wait_overhead = wait_utils.wait_adaptive(self.is_running, self.expected_duration(),
+                                                                 thread_esr, self.t_start)
+        if cancelled:
             return 1
         else:
             return 0
 
     def start_programming(self):
-        self.pb_start_programming(self.PULSE_PROGRAM)
         self.seq_time = default_seq_time()
         self.inst_num = 0
+        self.inst_list = []
+        self.awg_program = None
 
     def stop_programming(self):
-        self.pb_stop_programming()
         if len(self.seq_time) > 1:
             with warnings.catch_warnings():
                 warnings.simplefilter('always')
                 warnings.warn('There is a LOOP that does not have END_LOOP!')
+        if not self.defer_load:
+            self.load_program(self.compiled_program())
 
     def start(self):
+        self.t_start = time.perf_counter()
         self.pb_start()
 
     def stop(self):
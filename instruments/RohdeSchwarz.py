@@ -12,6 +12,7 @@ class GenericSource(GPIBdev.GPIBdev):
         self.pow_max = None
         self.freq_min = None
         self.freq_max = None
+        self.freq_list_max = 2000  # maximum number of points for set_freq_list(). 0 if list mode is not available
 
         self.ch = ch
         self.set_ch(ch)
@@ -43,6 +44,42 @@ class GenericSource(GPIBdev.GPIBdev):
         else:
             self.gpib_write('SOUR%d:POW %.2f' % (self.ch, p))
 
+    def freq_list_error(self, freqs):
+        # why freqs cannot be loaded by set_freq_list(), '' if they can
+        freqs = list(freqs)
+        if not len(freqs) or len(freqs) + 1 > self.freq_list_max:
+            return 'Freq List Error! %d points is more than %d' % (len(freqs), self.freq_list_max)
+        elif min(freqs) < self.freq_min or max(freqs) > self.freq_max:
+            return 'Freq Range Error! Tried to set list from %f to %f' % (min(freqs), max(freqs))
+        return ''
+
+    def set_freq_list(self, freqs):
+        # Load a frequency list and step through it with the external trigger. The first trigger goes to freqs[0].
+        # Returns False if the list cannot be loaded.
+        freqs = list(freqs)
+        error = self.freq_list_error(freqs)
+        if error:
+            print(error)
+            return False
+        else:
+            # repeat the first point so that the source sits there until the first trigger
+            freqs = [freqs[0]] + freqs
+            p = float(self.gpib_query('SOUR%d:POW?' % self.ch))
+
+            self.gpib_write('SOUR%d:FREQ:MODE CW' % self.ch)
+            self.gpib_write('SOUR%d:LIST:SEL "fastlist"' % self.ch)
+            self.gpib_write('SOUR%d:LIST:FREQ ' % self.ch + ','.join(['%.6f' % f for f in freqs]))
+            self.gpib_write('SOUR%d:LIST:POW ' % self.ch + ','.join(['%.2f' % p] * len(freqs)))
+            self.gpib_write('SOUR%d:LIST:MODE STEP' % self.ch)
+            self.gpib_write('SOUR%d:LIST:TRIG:SOUR EXT' % self.ch)
+            # Wait for the list to be learned before the first trigger
+            self.gpib_query('SOUR%d:FREQ:MODE LIST; *OPC?' % self.ch)
+            return True
+
+    def set_freq_cw(self):
+        # Leave list mode
+        self.gpib_write('SOUR%d:FREQ:MODE CW' % self.ch)
+
     def set_mod(self, b):
         # set_mod not available for RhodeSchwarz. Need to define a function for compatibility with mainexp
         pass
@@ -219,6 +256,7 @@ class SML03(GenericSource):
         self.pow_max = 15
         self.freq_min = 9e3
         self.freq_max = 3.3e9
+        self.freq_list_max = 0  # list mode is not implemented for SML03
 
     def gpib_connect(self):
         super().gpib_connect(write_termination='\n', read_termination='\n', timeout=5000)
@@ -16,6 +16,7 @@ class SDG6022X_RF(GPIBdev.GPIBdev):
         self.pow_max = 33
         self.freq_min = 1.
         self.freq_max = 200.e6
+        self.freq_list_max = 0  # no list mode, fast list sweeps fall back to stepping set_freq()
 
         self.gpib_write('C1:BSWV WVTP,SINE')
         self.set_output(0)
@@ -27,6 +28,7 @@ class SDG6022X_RF(GPIBdev.GPIBdev):
             print('Freq Range Error! Tried to set to %f' % freq)
         else:
             self.gpib_write('C1:BSWV FRQ,%d' % freq)
+            self.cache_set('freq', freq, self.query_freq, tol=1.0)  # set in whole Hz
 
     def set_pow(self, pow):
         # set generator power in dBm
@@ -36,8 +38,12 @@ class SDG6022X_RF(GPIBdev.GPIBdev):
             # Assume 50 Ohm load
             pow_Vpp = np.sqrt(np.power(10,pow/10)*1e-3*50)
             self.gpib_write('C1:BSWV AMP, %.3f' % pow_Vpp)
+            self.cache_set('pow', pow, self.query_pow, tol=0.05)  # Vpp is set in mV
 
     def get_pow(self):
+        return self.cache_get('pow', self.query_pow)
+
+    def query_pow(self):
         retval = self.gpib_query('C1:BSWV?')
         start = retval.find('AMP,')+4
         end = retval.find('V,AMPVRMS')
@@ -46,6 +52,9 @@ class SDG6022X_RF(GPIBdev.GPIBdev):
         return pow_dbm
 
     def get_freq(self):
+        return self.cache_get('freq', self.query_freq)
+
+    def query_freq(self):
         retval = self.gpib_query('C1:BSWV?')
         start = retval.find('FRQ,') + 4
         end = retval.find('HZ,')
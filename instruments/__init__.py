@@ -4,6 +4,7 @@ from . import Agilent
 from . import Bristol
 from . import DAQmxAnalogInput
 from . import DAQmxAnalogOutput
+from . import wait_utils
 from . import DAQmxChannel
 from . import DAQmxCounterOutput
 from . import DAQmxCounterInput
@@ -17,6 +18,7 @@ from . import Ophir
 from . import phidgets
 from . import princetoninstruments
 from . import picam_types
+from . import PulseBlasterSim
 from . import PulseBlaster
 from . import PulseMaster
 from . import RohdeSchwarz
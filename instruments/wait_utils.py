@@ -0,0 +1,31 @@
+import time
+import math
+
+
+def wait_adaptive(is_running, t_expected, thd=None, t_start=None, t_early=0.002, poll_min=1e-4, poll_max=0.01,
+                  sleep_max=0.1):
+    '''Wait until is_running() returns False.
+    Sleeps without polling until t_early before the expected end (t_start + t_expected), then polls starting every
+    poll_min seconds and doubling up to poll_max. thd.cancel is checked at least every sleep_max seconds.
+    Returns (cancelled, overhead) where overhead is the time spent waiting past the expected end.'''
+    if t_start is None:
+        t_start = time.perf_counter()
+    if not math.isfinite(t_expected):
+        t_expected = 0.0  # e.g. an infinite sequence. Poll from the start.
+    t_end = t_start + t_expected
+
+    def cancelled():
+        return thd is not None and thd.cancel
+
+    while not cancelled():
+        dt = t_end - t_early - time.perf_counter()
+        if dt <= 0:
+            break
+        time.sleep(min(dt, sleep_max))
+
+    poll = poll_min
+    while not cancelled() and is_running():
+        time.sleep(poll)
+        poll = min(2*poll, poll_max)
+
+    return cancelled(), max(0.0, time.perf_counter() - t_end)
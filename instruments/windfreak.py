@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
+
 from instruments import GPIBdev
 # import GPIBdev # use when running this as a main
 
@@ -13,6 +15,7 @@ class SynthHD(GPIBdev.GPIBdev):
         self.pow_max = 20.  # Ophir can handle 10 dBm
         self.freq_min = 53.0e6
         self.freq_max = 13.9e9
+        self.freq_list_max = 100000  # the hardware sweep only supports evenly spaced frequencies
 
         self.gpib_write('c1')
         self.gpib_write('x0')
@@ -32,6 +35,51 @@ class SynthHD(GPIBdev.GPIBdev):
             self.gpib_write('l{0:5.7f}'.format(freq*1e-6))
             self.gpib_write('u{0:5.7f}'.format(freq*1e-6))
 
+    def freq_list_step(self, freqs):
+        freqs = np.array(freqs, dtype=float)
+        return (freqs[-1] - freqs[0]) / (len(freqs) - 1) if len(freqs) > 1 else 0.0
+
+    def freq_list_error(self, freqs):
+        # why freqs cannot be swept by set_freq_list(), '' if they can
+        freqs = np.array(freqs, dtype=float)
+        step = self.freq_list_step(freqs)
+        if len(freqs) < 2 or step <= 0 or not np.allclose(np.diff(freqs), step, rtol=1e-6, atol=1.0):
+            return 'Freq List Error! SynthHD can only sweep evenly spaced increasing frequencies'
+        elif len(freqs) + 1 > self.freq_list_max:
+            return 'Freq List Error! %d points is more than %d' % (len(freqs), self.freq_list_max)
+        elif freqs[0] - step < self.freq_min or freqs[-1] > self.freq_max:
+            return 'Freq Range Error! Tried to set list from %f to %f' % (freqs[0], freqs[-1])
+        return ''
+
+    def set_freq_list(self, freqs):
+        # Step through evenly spaced frequencies with the external trigger. The first trigger goes to freqs[0].
+        # Returns False if the frequencies cannot be swept.
+        freqs = np.array(freqs, dtype=float)
+        step = self.freq_list_step(freqs)
+        error = self.freq_list_error(freqs)
+        if error:
+            print(error)
+            return False
+        else:
+            # start one step below so that the first trigger steps onto freqs[0]
+            self.gpib_write('g0')
+            self.gpib_write('X0')  # linear sweep
+            self.gpib_write('^1')  # sweep up
+            self.gpib_write('l{0:5.7f}'.format((freqs[0] - step)*1e-6))
+            self.gpib_write('u{0:5.7f}'.format(freqs[-1]*1e-6))
+            self.gpib_write('s{0:5.7f}'.format(step*1e-6))
+            self.gpib_write('w2')  # trigger single frequency step
+            self.gpib_write('g1')
+            return True
+
+    def set_freq_cw(self):
+        # Leave sweep mode
+        self.gpib_write('g0')
+        self.gpib_write('w0')
+        freq = self.get_freq()
+        self.gpib_write('l{0:5.7f}'.format(freq*1e-6))
+        self.gpib_write('u{0:5.7f}'.format(freq*1e-6))
+
     def set_pow(self, pow):
         # set generator power in dBm
         pow = float(pow)
@@ -0,0 +1,232 @@
+import numpy as np
+
+
+class ScanPattern:
+    '''Trajectory of a hardware-timed galvo/piezo scan, one sample per clock tick.
+
+    pos: (3, n) float64 x, y, z positions (um), C-contiguous so that it can be written to the DAQ as is.
+    pixel: (n,) flat index into an image of shape (len(xvals), len(yvals)) (like confocal_pl) of the pixel that
+        sample i measures, -1 for flyback, settling and transit samples. The counts of sample i are the counts between
+        clock ticks i and i + 1, so a scan takes n + 1 ticks (see trajectory()).
+    segments: stop sample indices of the chunks to read at once (e.g. one scan line each)'''
+
+    def __init__(self, pos, pixel, shape, segments):
+        self.pos = np.ascontiguousarray(pos, dtype=np.float64)
+        self.pixel = np.asarray(pixel, dtype=np.int64)
+        self.shape = tuple(shape)
+        self.segments = np.asarray(segments, dtype=np.int64)
+
+    def __len__(self):
+        return self.pos.shape[1]
+
+    def numsamples(self):
+        # number of clock ticks, including the one that ends the last sample
+        return len(self) + 1
+
+    def trajectory(self):
+        # positions for the DAQ, with the last position repeated to park while the last sample is counted
+        traj = np.empty((3, len(self) + 1))
+        traj[:, :-1] = self.pos
+        traj[:, -1] = self.pos[:, -1]
+        return traj
+
+    def reversed(self):
+        # the same scan run backwards, to alternate directions between frames without a jump
+        n = len(self)
+        starts = np.concatenate([[0], self.segments[:-1]])
+        return ScanPattern(self.pos[:, ::-1], self.pixel[::-1], self.shape, np.sort(n - starts))
+
+    def approach(self, p0, num):
+        # the same scan, starting with num samples that move from p0 (e.g. the end of the previous z slice)
+        if num <= 0:
+            return self
+        return ScanPattern(np.hstack([linear_path(p0, self.pos[:, 0], num), self.pos]),
+                           np.concatenate([np.full(num, -1, dtype=np.int64), self.pixel]),
+                           self.shape, self.segments + num)
+
+    def accumulate(self, counts, start, frame_sum, frame_hits):
+        '''Add the counts of samples start:start + len(counts) to the frame_sum and frame_hits images.
+        Returns the range of image rows (y indices) that were touched, (lo, hi), or None.'''
+        pix = self.pixel[start:start + len(counts)]
+        valid = pix >= 0
+        if not np.any(valid):
+            return None
+        pix = pix[valid]
+        np.add.at(frame_sum.reshape(-1), pix, counts[valid])
+        np.add.at(frame_hits.reshape(-1), pix, 1)
+        rows = pix % self.shape[1]
+        return rows.min(), rows.max() + 1
+
+
+def get_z(z, x, y):
+    # z: a number, or a function z(x, y) (e.g. a focus surface) evaluated on arrays
+    if callable(z):
+        return np.broadcast_to(z(x, y), np.shape(x)).astype(np.float64)
+    return np.full(np.shape(x), z, dtype=np.float64)
+
+
+def linear_path(p0, p1, num):
+    # num points strictly between p0 and p1 (3-vectors), as a (3, num) array
+    frac = np.arange(1, num + 1) / (num + 1)
+    return np.asarray(p0)[:, None] + (np.asarray(p1) - np.asarray(p0))[:, None] * frac
+
+
+def grid_pixels(xvals, yvals, x, y):
+    # flat pixel index of the grid point nearest to (x, y), -1 outside of the grid
+    nx, ny = len(xvals), len(yvals)
+    ix = np.round((x - xvals[0]) / ((xvals[-1] - xvals[0]) / max(nx - 1, 1) or 1)).astype(np.int64)
+    iy = np.round((y - yvals[0]) / ((yvals[-1] - yvals[0]) / max(ny - 1, 1) or 1)).astype(np.int64)
+    inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    return np.where(inside, ix * ny + iy, -1)
+
+
+def lines(xvals, yvals, ix, iy, z, settle=0, flyback=0):
+    '''Scan lines: line k measures the pixels ix[k, :] at row iy[k] (index arrays into xvals, yvals).
+    Each line starts with settle samples at its first point, and flyback samples move from the end of the previous
+    line to the start of the line.'''
+    xvals = np.asarray(xvals, dtype=np.float64)
+    yvals = np.asarray(yvals, dtype=np.float64)
+    nlines, npix = ix.shape
+    ny = len(yvals)
+    iy = np.broadcast_to(np.asarray(iy)[:, None], ix.shape)
+
+    x = xvals[ix]
+    y = yvals[iy]
+    block = flyback + settle + npix
+
+    pos = np.empty((3, nlines, block))
+    pixel = np.full((nlines, block), -1, dtype=np.int64)
+
+    pos[0, :, flyback + settle:] = x
+    pos[1, :, flyback + settle:] = y
+    pos[0, :, flyback:flyback + settle] = x[:, :1]
+    pos[1, :, flyback:flyback + settle] = y[:, :1]
+    pixel[:, flyback + settle:] = ix * ny + iy
+
+    if flyback:
+        frac = np.arange(1, flyback + 1) / (flyback + 1)
+        for axis, vals in [(0, x), (1, y)]:
+            prev_end = np.concatenate([vals[:1, 0], vals[:-1, -1]])
+            pos[axis, :, :flyback] = prev_end[:, None] + (vals[:, :1] - prev_end[:, None]) * frac
+    pos[2] = get_z(z, pos[0], pos[1])
+
+    pos = pos.reshape(3, -1)
+    pixel = pixel.reshape(-1)
+    segments = (np.arange(nlines) + 1) * block
+    if flyback:
+        # the first line does not need to fly back
+        pos = pos[:, flyback:]
+        pixel = pixel[flyback:]
+        segments = segments - flyback
+    return ScanPattern(pos, pixel, (len(xvals), ny), segments)
+
+
+def raster(xvals, yvals, z, flyback=0, settle=0):
+    # every line from xvals[0] to xvals[-1]; flyback samples bring the beam back between lines
+    nx, ny = len(xvals), len(yvals)
+    ix = np.broadcast_to(np.arange(nx), (ny, nx))
+    return lines(xvals, yvals, ix, np.arange(ny), z, settle=settle, flyback=flyback)
+
+
+def meander(xvals, yvals, z, settle=0):
+    # lines alternate directions, so there is no flyback
+    nx, ny = len(xvals), len(yvals)
+    ix = np.empty((ny, nx), dtype=np.int64)
+    ix[0::2] = np.arange(nx)
+    ix[1::2] = np.arange(nx)[::-1]
+    return lines(xvals, yvals, ix, np.arange(ny), z, settle=settle)
+
+
+def spiral(xvals, yvals, z, settle=0):
+    '''Archimedean spiral from the center of the grid out to its corners, with one pixel pitch between turns and
+    between samples. Samples outside of the grid are not assigned to a pixel.'''
+    xvals = np.asarray(xvals, dtype=np.float64)
+    yvals = np.asarray(yvals, dtype=np.float64)
+    nx, ny = len(xvals), len(yvals)
+    dx = abs(xvals[-1] - xvals[0]) / max(nx - 1, 1)
+    dy = abs(yvals[-1] - yvals[0]) / max(ny - 1, 1)
+    pitch = min(d for d in [dx, dy] if d > 0) if max(dx, dy) > 0 else 1.0
+    cx, cy = (xvals[0] + xvals[-1]) / 2, (yvals[0] + yvals[-1]) / 2
+    rmax = np.hypot(xvals[-1] - xvals[0], yvals[-1] - yvals[0]) / 2
+
+    # r = a * theta, arc length ~ a * theta^2 / 2: equal steps in arc length
+    a = pitch / (2 * np.pi)
+    length = a * (rmax / a) ** 2 / 2
+    s = np.arange(int(np.ceil(length / pitch)) + 1) * pitch
+    theta = np.sqrt(2 * s / a)
+    x = cx + a * theta * np.cos(theta)
+    y = cy + a * theta * np.sin(theta)
+
+    x = np.concatenate([np.full(settle, x[0]), x])
+    y = np.concatenate([np.full(settle, y[0]), y])
+    pixel = grid_pixels(xvals, yvals, x, y)
+    pixel[:settle] = -1
+
+    pos = np.vstack([x, y, get_z(z, x, y)])
+    segments = np.append(np.arange(settle + nx, len(x), nx), len(x))
+    return ScanPattern(pos, pixel, (nx, ny), segments)
+
+
+def lissajous(xvals, yvals, z, fx=None, fy=None, numpnts=None, settle=0):
+    '''Lissajous figure over the grid: x and y are sinusoids with fx and fy periods per frame. Pixels that the
+    figure does not pass are not measured, pixels that it passes several times are averaged.'''
+    xvals = np.asarray(xvals, dtype=np.float64)
+    yvals = np.asarray(yvals, dtype=np.float64)
+    nx, ny = len(xvals), len(yvals)
+    if fy is None:
+        fy = max(nx // 2, 1)
+    if fx is None:
+        fx = fy + 1
+    if numpnts is None:
+        numpnts = 2 * nx * ny
+
+    t = np.arange(numpnts) / numpnts * 2 * np.pi
+    cx, cy = (xvals[0] + xvals[-1]) / 2, (yvals[0] + yvals[-1]) / 2
+    x = cx + (xvals[-1] - xvals[0]) / 2 * np.sin(fx * t + np.pi / 2)
+    y = cy + (yvals[-1] - yvals[0]) / 2 * np.sin(fy * t)
+
+    x = np.concatenate([np.full(settle, x[0]), x])
+    y = np.concatenate([np.full(settle, y[0]), y])
+    pixel = grid_pixels(xvals, yvals, x, y)
+    pixel[:settle] = -1
+
+    pos = np.vstack([x, y, get_z(z, x, y)])
+    segments = np.append(np.arange(settle + nx, len(x), nx), len(x))
+    return ScanPattern(pos, pixel, (nx, ny), segments)
+
+
+def roi(xvals, yvals, z, centers, size, settle=0, transit=0):
+    '''Meander sub-scans of size x size (um) around each of centers (rows of x, y or x, y, z, e.g. the nvlist) on
+    the xvals, yvals grid, instead of the whole rectangle. transit samples move between the regions, settle samples
+    start every line. Regions that are outside of the grid are skipped.'''
+    xvals = np.asarray(xvals, dtype=np.float64)
+    yvals = np.asarray(yvals, dtype=np.float64)
+    nx, ny = len(xvals), len(yvals)
+
+    pos = []
+    pixel = []
+    segments = []
+    n = 0
+    for center in np.atleast_2d(centers):
+        ix = np.nonzero(np.abs(xvals - center[0]) <= size / 2)[0]
+        iy = np.nonzero(np.abs(yvals - center[1]) <= size / 2)[0]
+        if not len(ix) or not len(iy):
+            continue
+
+        grid = np.empty((len(iy), len(ix)), dtype=np.int64)
+        grid[0::2] = ix
+        grid[1::2] = ix[::-1]
+        sub = lines(xvals, yvals, grid, iy, center[2] if len(center) > 2 and z is None else z, settle=settle)
+
+        if pos and transit:
+            pos.append(linear_path(pos[-1][:, -1], sub.pos[:, 0], transit))
+            pixel.append(np.full(transit, -1, dtype=np.int64))
+            n += transit
+        pos.append(sub.pos)
+        pixel.append(sub.pixel)
+        segments.append(sub.segments + n)
+        n += len(sub)
+
+    if not pos:
+        raise ValueError('None of the regions of interest are inside of the scan range')
+    return ScanPattern(np.hstack(pos), np.concatenate(pixel), (nx, ny), np.concatenate(segments))